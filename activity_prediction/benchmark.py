@@ -0,0 +1,223 @@
+import pandas as pd
+import numpy as np
+import tracemalloc
+import tempfile
+import json
+import time
+import sys
+import os
+import click
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "preprocessing")
+)
+
+import cleaning
+import clean_labels
+import helperfuns
+import merging
+import rolling_features
+import spectrogram_features
+import synthetic_data
+import training
+
+
+@click.command()
+@click.option(
+    "--scale",
+    "scales",
+    multiple=True,
+    default=["2x2", "10x7"],
+    show_default=True,
+    help="Scale of the synthetic data as '<number of participants>x<days>'. Can be used multiple times.",
+)
+@click.option(
+    "--work_dir",
+    default=None,
+    help="Path to the directory for the synthetic data. Defaults to a temporary directory that is deleted afterwards.",
+)
+@click.option(
+    "--memory/--no-memory",
+    default=True,
+    help="Flag for whether or not to also measure the peak memory of every stage (with tracemalloc, in a separate run of the stage so that the timings are not affected).",
+)
+@click.option(
+    "--save_path",
+    default=None,
+    help="Optional path for saving the benchmark results as a json file.",
+)
+def main(scales, work_dir, memory, save_path):
+    """Time and memory-profile the pipeline stages on synthetic data
+
+    For every scale, this generates a synthetic Fitabase export (see
+    synthetic_data.py) and benchmarks cleaning.clean, the rolling and
+    spectrogram feature builders, merging.merge_labels,
+    merging.merge_features and training.grouped_grid_search (with a
+    small grid and forest).
+    """
+    results = []
+    for scale in scales:
+        num_participants, days = [int(x) for x in scale.split("x")]
+        print(f"Benchmarking {num_participants} participants x {days} days.")
+        if work_dir:
+            scale_dir = os.path.join(work_dir, scale)
+            results += benchmark_scale(scale_dir, num_participants, days, memory)
+        else:
+            with tempfile.TemporaryDirectory() as scale_dir:
+                results += benchmark_scale(scale_dir, num_participants, days, memory)
+
+    results_df = pd.DataFrame(results)
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(results_df.to_string(index=False))
+
+    if save_path:
+        with open(save_path, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved the benchmark results to {save_path}.")
+
+
+def measure(func, memory):
+    """Run ``func()`` and measure its wall time (and peak memory)
+
+    :param func: function without arguments. It must not modify shared
+        inputs, because it runs twice if ``memory`` is True.
+    :param memory: whether to measure the peak memory allocated by
+        ``func`` in a second run with tracemalloc
+    :returns: a tuple (result, seconds, peak_mb), where ``peak_mb`` is
+        None if ``memory`` is False
+    """
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+
+    peak_mb = None
+    if memory:
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peak_mb = peak / 2**20
+
+    return (result, seconds, peak_mb)
+
+
+def benchmark_scale(scale_dir, num_participants, days, memory):
+    """Generate synthetic data at one scale and benchmark every stage
+
+    :returns: list of dicts with the keys "participants", "days",
+        "stage", "rows", "seconds" and "peak_mb"
+    """
+    export_dir, raw_labels_path = synthetic_data.generate(
+        scale_dir, num_participants=num_participants, days=days
+    )
+    clean_dir = os.path.join(scale_dir, "clean_data")
+    os.makedirs(clean_dir, exist_ok=True)
+    files = os.listdir(export_dir)
+
+    results = []
+
+    def record(stage, func, rows=None):
+        result, seconds, peak_mb = measure(func, memory)
+        rows = len(result) if rows is None and hasattr(result, "__len__") else rows
+        results.append(
+            {
+                "participants": num_participants,
+                "days": days,
+                "stage": stage,
+                "rows": rows,
+                "seconds": round(seconds, 4),
+                "peak_mb": None if peak_mb is None else round(peak_mb, 2),
+            }
+        )
+        return result
+
+    steps_df = record(
+        "cleaning.clean (steps)",
+        lambda: cleaning.clean(
+            export_dir=export_dir,
+            file_list=[f for f in files if "minuteStepsNarrow" in f],
+            datetime_col="ActivityMinute",
+            save_path=os.path.join(clean_dir, "steps_minutes_df.pickle"),
+        ),
+    )
+    hr_df = record(
+        "cleaning.clean (HR)",
+        lambda: cleaning.clean(
+            export_dir=export_dir,
+            file_list=[f for f in files if "heartrate_seconds" in f],
+            datetime_col="Time",
+            save_path=os.path.join(clean_dir, "hr_seconds_df.pickle"),
+        ),
+    )
+
+    labels_path = os.path.join(clean_dir, "labels_df.pickle")
+    clean_labels.clean_labels(raw_labels_path, labels_path)
+
+    steps_df = steps_df.sort_index()
+    hr_df = hr_df.sort_index()
+    steps_df = helperfuns.remove_zero_daily_steps(steps_df)
+
+    steps_features = record(
+        "rolling_features (steps)",
+        lambda: rolling_features.get_rolling_features(steps_df, "Steps", "10min"),
+    )
+    hr_features = record(
+        "rolling_features (HR)",
+        lambda: rolling_features.get_rolling_features(hr_df, "HR", "10min"),
+    )
+
+    def spectrogram(df, col, samples_per_sec):
+        features_dict = dict()
+        for participant_id in df.index.get_level_values(0).unique():
+            features_dict[participant_id], _ = (
+                spectrogram_features.get_participant_spectrogram_features(
+                    participant_df=df.loc[participant_id].copy(),
+                    time_delta_threshold=pd.Timedelta("1D"),
+                    spectrogram_col=col,
+                    spectrogram_samples_per_sec=samples_per_sec,
+                    spectrogram_window_size=int(10 * 60 * samples_per_sec),
+                    spectrogram_overlap_size=0,
+                )
+            )
+        return pd.concat(features_dict)
+
+    record(
+        "spectrogram_features (steps)",
+        lambda: spectrogram(
+            steps_df, "Steps", spectrogram_features.STEPS_SAMPLES_PER_SEC
+        ),
+    )
+    record(
+        "spectrogram_features (HR)",
+        lambda: spectrogram(hr_df, "Value", spectrogram_features.HR_SAMPLES_PER_SEC),
+    )
+
+    hr_features.index.rename(["Id", "Time"], inplace=True)
+    steps_features.index.rename(["Id", "Time"], inplace=True)
+    merged = record(
+        "merging.merge_labels",
+        lambda: merging.merge_labels(hr_features.copy(), labels_path=labels_path),
+    )
+    merged = record(
+        "merging.merge_features",
+        lambda: merging.merge_features(merged, steps_features, tolerance="1min"),
+    )
+
+    merged.set_index(["Id", "Time"], inplace=True)
+    merged = merged[merged["Arm"] != "combined"]
+    X = merged.drop(["Steps", "Value", "Arm"], axis=1)
+    y = merged["Arm"]
+    n_splits = min(3, X.index.get_level_values(0).nunique())
+    record(
+        "training.grouped_grid_search",
+        lambda: training.grouped_grid_search(
+            X, y, {"max_features": ["sqrt"]}, n_splits, n_estimators=20
+        ),
+        rows=len(X),
+    )
+
+    return results
+
+
+if __name__ == "__main__":
+    main()
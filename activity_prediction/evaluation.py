@@ -0,0 +1,292 @@
+import pandas as pd
+import numpy as np
+import json
+import os
+import click
+from joblib import Parallel, delayed
+from tqdm import tqdm
+
+from predict import load_estimator, iter_feature_chunks
+
+
+@click.command()
+@click.option(
+    "--model_path",
+    help="Path to the pickle file containing the grid search results saved by training.py, or path to the directory containing a random forest exported by exporting.py.",
+)
+@click.option(
+    "--features_path",
+    help="Path to the pickle file containing the merged dataframe with all features (with indices ('Id', 'Time')), or path to a directory of such pickle files.",
+)
+@click.option(
+    "--split_path",
+    default="train_test_participants.json",
+    help="Path to the json file with the train-test split of participant IDs. The 'test' participants are evaluated.",
+)
+@click.option(
+    "--save_dir",
+    help="Path to the directory for saving the evaluation results (csv and json files).",
+)
+@click.option(
+    "--binary/--not-binary",
+    help="Only evaluate strength vs aerobic rows (as in training.py).",
+)
+@click.option(
+    "--chunk_size",
+    default=16,
+    type=int,
+    help="Number of participants to load and score at a time.",
+)
+@click.option(
+    "--n_jobs",
+    default=-1,
+    type=int,
+    help="Number of participants to score in parallel within a chunk. This corresponds to the ``n_jobs`` parameter in joblib.Parallel.",
+)
+@click.option(
+    "--n_bootstrap",
+    default=10000,
+    type=int,
+    help="Number of participant-level bootstrap resamples for the confidence intervals.",
+)
+@click.option(
+    "--confidence", default=0.95, type=float, help="Confidence level of the intervals."
+)
+@click.option("--seed", default=0, type=int, help="Random seed of the bootstrap.")
+def main(
+    model_path,
+    features_path,
+    split_path,
+    save_dir,
+    binary,
+    chunk_size,
+    n_jobs,
+    n_bootstrap,
+    confidence,
+    seed,
+):
+    """Evaluate a trained classifier on the held-out test participants
+
+    The test participants are scored in parallel (once), and a confusion
+    matrix is computed for every participant. All metrics are derived
+    from these confusion matrices:
+
+    \b
+    * per participant: number of rows, accuracy, macro F1 and per-class
+      F1 (per_participant.csv, confusion_matrices.csv)
+    * pooled over all test rows: accuracy, macro F1, per-class F1 and the
+      confusion matrix (pooled_confusion_matrix.csv)
+    * participant-level bootstrap confidence intervals of the pooled
+      metrics and of the mean per-participant macro F1 (summary.json)
+
+    A bootstrap resample of participants is represented by how often
+    each participant is drawn (multinomial weights), so the pooled
+    confusion matrices of all resamples are a single matrix product of
+    the weights and the per-participant confusion matrices. Nothing is
+    refit or rescored.
+    """
+    estimator = load_estimator(model_path)
+    if hasattr(estimator, "get_params") and "n_jobs" in estimator.get_params():
+        # parallelize across participants instead of across trees
+        estimator.set_params(n_jobs=1, verbose=0)
+
+    with open(split_path) as f:
+        test_ids = set(json.load(f)["test"])
+
+    print("Scoring the test participants.")
+    predictions = dict()
+    for chunk in tqdm(iter_feature_chunks(features_path, chunk_size)):
+        chunk_ids = [
+            i for i in chunk.index.get_level_values(0).unique() if i in test_ids
+        ]
+        results = Parallel(n_jobs=n_jobs, prefer="threads")(
+            delayed(predict_participant)(estimator, chunk.loc[[i]], binary)
+            for i in chunk_ids
+        )
+        for participant_id, (y_true, y_pred) in zip(chunk_ids, results):
+            if len(y_true) > 0:
+                predictions[participant_id] = (y_true, y_pred)
+
+    missing = test_ids - set(predictions)
+    if missing:
+        print(
+            f"{len(missing)} test participants have no rows to evaluate: {sorted(missing)}"
+        )
+    if not predictions:
+        raise click.ClickException(
+            f"There are no test participants with rows to evaluate ({split_path} has {len(test_ids)} test participants). splitting.py leaves the test split empty if there are too few eligible participants."
+        )
+    print(f"Evaluating {len(predictions)} test participants.")
+
+    id_list = sorted(predictions)
+    labels = sorted(
+        set(estimator.classes_).union(*[set(y) for y, _ in predictions.values()])
+    )
+    matrices = np.stack([confusion_matrix(*predictions[i], labels) for i in id_list])
+
+    os.makedirs(save_dir, exist_ok=True)
+
+    # per participant
+    per_participant_df = metrics_df(
+        matrices, labels, index=pd.Index(id_list, name="Id")
+    )
+    per_participant_df.to_csv(os.path.join(save_dir, "per_participant.csv"))
+    long_df = pd.DataFrame(
+        {
+            "Id": np.repeat(id_list, len(labels) ** 2),
+            "True": np.tile(np.repeat(labels, len(labels)), len(id_list)),
+            "Predicted": np.tile(labels, len(labels) * len(id_list)),
+            "Count": matrices.ravel(),
+        }
+    )
+    long_df.to_csv(os.path.join(save_dir, "confusion_matrices.csv"), index=False)
+
+    # pooled
+    pooled = matrices.sum(axis=0)
+    pd.DataFrame(
+        pooled,
+        index=pd.Index(labels, name="True"),
+        columns=pd.Index(labels, name="Predicted"),
+    ).to_csv(os.path.join(save_dir, "pooled_confusion_matrix.csv"))
+    pooled_metrics = metrics_df(pooled[None], labels, index=["pooled"]).iloc[0]
+
+    # participant-level bootstrap
+    boot = bootstrap_metrics(matrices, labels, n_bootstrap, seed)
+    alpha = (1 - confidence) / 2
+    summary = {
+        "participants": len(id_list),
+        "rows": int(pooled.sum()),
+        "confidence": confidence,
+        "n_bootstrap": n_bootstrap,
+        "metrics": dict(),
+    }
+    point_estimates = dict(pooled_metrics.drop("Rows"))
+    point_estimates["participant_mean_f1_macro"] = per_participant_df["f1_macro"].mean()
+    for name, value in point_estimates.items():
+        low, high = np.nanquantile(boot[name], [alpha, 1 - alpha])
+        summary["metrics"][name] = {
+            "estimate": float(value),
+            "ci_low": float(low),
+            "ci_high": float(high),
+        }
+    summary_path = os.path.join(save_dir, "summary.json")
+    with open(summary_path, "w") as f:
+        json.dump(summary, f, indent=2)
+
+    print(
+        pd.DataFrame(summary["metrics"]).T.to_string(float_format=lambda x: f"{x:.4f}")
+    )
+    print(f"Saved the evaluation results to {save_dir}.")
+
+
+def predict_participant(estimator, participant_df, binary=False):
+    """Predict the labels of one participant's rows
+
+    :param estimator: fitted scikit-learn classifier
+    :param participant_df: pandas dataframe with indices ("Id", "Time")
+        containing the features and the "Arm" label of a single
+        participant. Raw data ("Steps", "Value") columns are ignored and
+        rows with missing values are dropped (as in training.py).
+    :param binary: whether to only keep the "aerobic" and "strength"
+        rows, defaults to False
+    :returns: a tuple of numpy arrays (y_true, y_pred)
+    """
+    X = participant_df.drop(["Steps", "Value"], axis=1, errors="ignore")
+    if binary:
+        X = X[X["Arm"].isin(["aerobic", "strength"])]
+    X = X.dropna()
+    if X.empty:
+        return (np.array([]), np.array([]))
+
+    y_true = X.pop("Arm").values
+    if hasattr(estimator, "feature_names_in_"):
+        X = X[estimator.feature_names_in_]
+    return (y_true, estimator.predict(X))
+
+
+def confusion_matrix(y_true, y_pred, labels):
+    """Confusion matrix (rows: true labels, columns: predicted labels)
+
+    :returns: numpy array of shape (len(labels), len(labels))
+    """
+    index = {label: i for i, label in enumerate(labels)}
+    true_codes = np.array([index[y] for y in y_true])
+    pred_codes = np.array([index[y] for y in y_pred])
+    return np.bincount(
+        true_codes * len(labels) + pred_codes, minlength=len(labels) ** 2
+    ).reshape(len(labels), len(labels))
+
+
+def f1_scores(matrices):
+    """Per-class and macro F1 scores of (stacks of) confusion matrices
+
+    Like sklearn.metrics.f1_score, classes without any true or predicted
+    rows are left out of the macro average, and classes without true
+    positives have an F1 score of 0.
+
+    :param matrices: numpy array of shape (..., n_labels, n_labels)
+    :returns: a tuple of numpy arrays (per_class_f1, macro_f1) of shapes
+        (..., n_labels) and (...)
+    """
+    matrices = np.asarray(matrices, dtype=float)
+    tp = np.diagonal(matrices, axis1=-2, axis2=-1)
+    support = matrices.sum(axis=-1)
+    predicted = matrices.sum(axis=-2)
+    denominator = support + predicted
+    with np.errstate(invalid="ignore", divide="ignore"):
+        per_class = np.where(denominator > 0, 2 * tp / denominator, 0.0)
+        present = denominator > 0
+        macro = (per_class * present).sum(axis=-1) / present.sum(axis=-1)
+    return (per_class, macro)
+
+
+def metrics_df(matrices, labels, index):
+    """Rows, accuracy, macro F1 and per-class F1 of a stack of confusion
+    matrices as a dataframe (one row per matrix)"""
+    per_class, macro = f1_scores(matrices)
+    rows = matrices.sum(axis=(-2, -1))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        accuracy = np.trace(matrices, axis1=-2, axis2=-1) / rows
+    df = pd.DataFrame(
+        {"Rows": rows, "accuracy": accuracy, "f1_macro": macro}, index=index
+    )
+    for j, label in enumerate(labels):
+        df[f"f1_{label}"] = per_class[:, j]
+    return df
+
+
+def bootstrap_metrics(matrices, labels, n_bootstrap, seed=0):
+    """Participant-level bootstrap distributions of the metrics
+
+    :param matrices: numpy array of per-participant confusion matrices
+        with shape (n_participants, n_labels, n_labels)
+    :param labels: list of the labels
+    :param n_bootstrap: number of bootstrap resamples
+    :param seed: random seed, defaults to 0
+    :returns: dict of numpy arrays of length ``n_bootstrap`` for the
+        pooled "accuracy", "f1_macro" and "f1_<label>" metrics and the
+        "participant_mean_f1_macro"
+    """
+    n = len(matrices)
+    rng = np.random.default_rng(seed)
+    # how often each participant is drawn in each resample
+    weights = rng.multinomial(n, np.full(n, 1 / n), size=n_bootstrap)
+
+    pooled = (weights @ matrices.reshape(n, -1)).reshape(
+        n_bootstrap, len(labels), len(labels)
+    )
+    per_class, macro = f1_scores(pooled)
+    _, participant_macro = f1_scores(matrices)
+
+    boot = {
+        "accuracy": np.trace(pooled, axis1=-2, axis2=-1) / pooled.sum(axis=(-2, -1)),
+        "f1_macro": macro,
+        "participant_mean_f1_macro": weights @ participant_macro / n,
+    }
+    for j, label in enumerate(labels):
+        boot[f"f1_{label}"] = per_class[:, j]
+    return boot
+
+
+if __name__ == "__main__":
+    main()
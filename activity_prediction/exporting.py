@@ -0,0 +1,227 @@
+import pandas as pd
+import numpy as np
+import pickle
+import json
+import time
+import os
+import click
+
+# names of the flat node arrays in an exported forest; each is saved as
+# a separate .npy file so that it can be memory-mapped on load
+NODE_ARRAYS = ["children_left", "children_right", "feature", "threshold", "value"]
+
+
+@click.command()
+@click.option(
+    "--model_path",
+    help="Path to the pickle file containing the grid search results saved by training.py (or a fitted random forest).",
+)
+@click.option(
+    "--save_dir",
+    help="Path to the directory for saving the exported random forest (as flat .npy node arrays plus a metadata.json file).",
+)
+@click.option(
+    "--verify_features_path",
+    default=None,
+    help="Optional path to a pickle file with merged features (see preprocessing/merging.py). If given, the predictions of the exported forest are checked against the predictions of the original scikit-learn model on these features.",
+)
+def main(model_path, save_dir, verify_features_path):
+    """Export the best random forest of a grid search to a compact,
+    fast-loading format
+
+    The pickled grid search contains every refit, the cross-validation
+    results and all trees as Python objects. This script keeps only the
+    best estimator and stores its trees as a handful of flat NumPy
+    arrays (one entry per node across all trees), which are
+    memory-mapped by ``CompactForest.load``.
+    """
+    with open(model_path, "rb") as f:
+        model = pickle.load(f)
+    forest = getattr(model, "best_estimator_", model)
+
+    export_forest(forest, save_dir)
+    print(f"Saved the exported random forest to {save_dir}.")
+
+    start = time.perf_counter()
+    compact = CompactForest.load(save_dir)
+    print(f"Loaded the exported random forest in {time.perf_counter() - start:.4f}s.")
+
+    if verify_features_path:
+        with open(verify_features_path, "rb") as f:
+            X = pickle.load(f)
+        X = X.drop(["Steps", "Value", "Arm"], axis=1, errors="ignore").dropna()
+        if hasattr(compact, "feature_names_in_"):
+            X = X[compact.feature_names_in_]
+
+        expected = forest.predict_proba(X)
+        actual = compact.predict_proba(X)
+        assert np.allclose(expected, actual), "Exported forest probabilities differ."
+        assert all(forest.predict(X) == compact.predict(X))
+        print(f"Verified the exported predictions on {X.shape[0]} rows.")
+
+
+def export_forest(forest, save_dir):
+    """Save the trees of a fitted random forest classifier as flat node
+    arrays
+
+    The nodes of all trees are concatenated, and child node indices are
+    offset so that they index into the concatenated arrays. Leaf nodes
+    have ``children_left == -1``. ``value`` holds the normalized class
+    probabilities of each node.
+
+    :param forest: fitted sklearn.ensemble.RandomForestClassifier
+    :param save_dir: path to the directory for saving the node arrays
+        and metadata.json (created if it doesn't exist)
+    """
+    os.makedirs(save_dir, exist_ok=True)
+
+    arrays = {name: [] for name in NODE_ARRAYS}
+    offsets = [0]
+    max_depth = 0
+    for estimator in forest.estimators_:
+        tree = estimator.tree_
+        offset = offsets[-1]
+        is_leaf = tree.children_left == -1
+        arrays["children_left"].append(
+            np.where(is_leaf, -1, tree.children_left + offset)
+        )
+        arrays["children_right"].append(
+            np.where(is_leaf, -1, tree.children_right + offset)
+        )
+        arrays["feature"].append(np.where(is_leaf, 0, tree.feature))
+        arrays["threshold"].append(tree.threshold)
+
+        value = tree.value[:, 0, :]
+        normalizer = value.sum(axis=1, keepdims=True)
+        normalizer[normalizer == 0] = 1
+        arrays["value"].append(value / normalizer)
+
+        offsets.append(offset + tree.node_count)
+        max_depth = max(max_depth, tree.max_depth)
+
+    dtypes = {
+        "children_left": np.int32,
+        "children_right": np.int32,
+        "feature": np.int32,
+        "threshold": np.float64,
+        "value": np.float64,
+    }
+    for name in NODE_ARRAYS:
+        np.save(
+            os.path.join(save_dir, f"{name}.npy"),
+            np.concatenate(arrays[name]).astype(dtypes[name]),
+        )
+    np.save(os.path.join(save_dir, "roots.npy"), np.array(offsets[:-1], np.int32))
+
+    feature_names = getattr(forest, "feature_names_in_", None)
+    metadata = {
+        "classes": [str(c) for c in forest.classes_],
+        "n_features": int(forest.n_features_in_),
+        "feature_names": None if feature_names is None else list(feature_names),
+        "max_depth": int(max_depth),
+    }
+    with open(os.path.join(save_dir, "metadata.json"), "w") as f:
+        json.dump(metadata, f)
+
+
+class CompactForest:
+    """Random forest classifier loaded from flat node arrays (see
+    ``export_forest``)
+
+    Predictions traverse all trees at once with vectorized NumPy
+    indexing and match the predictions of the original
+    sklearn.ensemble.RandomForestClassifier.
+    """
+
+    def __init__(self, arrays, roots, metadata):
+        self.arrays = arrays
+        self.roots = roots
+        self.classes_ = np.array(metadata["classes"], dtype=object)
+        self.n_features_in_ = metadata["n_features"]
+        if metadata["feature_names"] is not None:
+            self.feature_names_in_ = np.array(metadata["feature_names"], dtype=object)
+        self.max_depth = metadata["max_depth"]
+
+    @classmethod
+    def load(cls, save_dir, mmap_mode="r"):
+        """Load an exported random forest
+
+        :param save_dir: path to the directory written by
+            ``export_forest``
+        :param mmap_mode: memory-map mode passed to numpy.load, defaults
+            to "r" (read-only memory map). Use None to read the arrays
+            into memory.
+        :returns: a CompactForest
+        """
+        arrays = {
+            name: np.load(os.path.join(save_dir, f"{name}.npy"), mmap_mode=mmap_mode)
+            for name in NODE_ARRAYS
+        }
+        roots = np.load(os.path.join(save_dir, "roots.npy"))
+        with open(os.path.join(save_dir, "metadata.json")) as f:
+            metadata = json.load(f)
+        return cls(arrays, roots, metadata)
+
+    def apply(self, X):
+        """Return the (global) leaf node index of every row in every tree
+
+        :param X: 2D array of features with ``n_features_in_`` columns
+        :returns: integer array of shape (n_rows, n_trees)
+        """
+        # same cast as scikit-learn, which compares float32 features
+        # against float64 thresholds
+        X = np.asarray(X, dtype=np.float32)
+        children_left = self.arrays["children_left"]
+        children_right = self.arrays["children_right"]
+        feature = self.arrays["feature"]
+        threshold = self.arrays["threshold"]
+
+        rows = np.arange(X.shape[0])[:, None]
+        nodes = np.broadcast_to(self.roots, (X.shape[0], len(self.roots))).copy()
+        for _ in range(self.max_depth):
+            left = children_left[nodes]
+            is_leaf = left == -1
+            if is_leaf.all():
+                break
+            go_left = X[rows, feature[nodes]] <= threshold[nodes]
+            nodes = np.where(
+                is_leaf, nodes, np.where(go_left, left, children_right[nodes])
+            )
+
+        return nodes
+
+    def predict_proba(self, X, chunk_size=None):
+        """Predict class probabilities (averaged across trees)
+
+        :param X: 2D array or pandas dataframe of features. The columns
+            of a dataframe are reordered to ``feature_names_in_``.
+        :param chunk_size: number of rows to traverse at a time. Defaults
+            to None, which bounds the size of the (rows x trees) node
+            index array to about 2**20 entries.
+        :returns: array of shape (n_rows, n_classes)
+        """
+        if isinstance(X, pd.DataFrame) and hasattr(self, "feature_names_in_"):
+            X = X[self.feature_names_in_]
+        X = np.asarray(X)
+        if chunk_size is None:
+            chunk_size = max(1, 2**20 // len(self.roots))
+
+        value = self.arrays["value"]
+        proba = np.empty((X.shape[0], len(self.classes_)))
+        for start in range(0, X.shape[0], chunk_size):
+            nodes = self.apply(X[start : start + chunk_size])
+            proba[start : start + chunk_size] = value[nodes].mean(axis=1)
+
+        return proba
+
+    def predict(self, X):
+        """Predict the class with the highest probability
+
+        :param X: see ``predict_proba``
+        :returns: array of class labels
+        """
+        return self.classes_[self.predict_proba(X).argmax(axis=1)]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+import pandas as pd
+import numpy as np
+import pickle
+import fnmatch
+import json
+import click
+from joblib import Parallel, delayed
+
+from predict import load_estimator
+from evaluation import confusion_matrix, f1_scores
+
+
+@click.command()
+@click.option(
+    "--model_path",
+    help="Path to the pickle file containing the grid search results saved by training.py, or path to the directory containing a random forest exported by exporting.py.",
+)
+@click.option(
+    "--features_path",
+    help="Path to the pickle file containing the merged dataframe with all features (with indices ('Id', 'Time')).",
+)
+@click.option(
+    "--split_path",
+    default="train_test_participants.json",
+    help="Path to the json file with the train-test split of participant IDs.",
+)
+@click.option(
+    "--participants",
+    default="test",
+    type=click.Choice(["test", "train"]),
+    help="Which participants of the split to compute the importances on.",
+)
+@click.option(
+    "--save_path",
+    help="Path for saving the importances as a csv file (one row per feature group).",
+)
+@click.option(
+    "--group",
+    "group_specs",
+    multiple=True,
+    help="Group of correlated columns that are permuted together, as NAME=PATTERN[,PATTERN...] with shell-style patterns, e.g. 'HR_rolling=HR_*'. Can be used multiple times. A column belongs to the first group that matches it, and columns that don't match any group are permuted on their own.",
+)
+@click.option(
+    "--binary/--not-binary",
+    help="Only use strength vs aerobic rows (as in training.py).",
+)
+@click.option(
+    "--n_repeats",
+    default=5,
+    type=int,
+    help="Number of permutations per feature group.",
+)
+@click.option(
+    "--max_rows_per_participant",
+    default=None,
+    type=int,
+    help="Optional number of rows to (randomly) sample from each participant, which bounds the scoring time of participants with a lot of data.",
+)
+@click.option(
+    "--n_jobs",
+    default=-1,
+    type=int,
+    help="Number of permutations to score in parallel. This corresponds to the ``n_jobs`` parameter in joblib.Parallel.",
+)
+@click.option("--seed", default=0, type=int, help="Random seed of the permutations.")
+def main(
+    model_path,
+    features_path,
+    split_path,
+    participants,
+    save_path,
+    group_specs,
+    binary,
+    n_repeats,
+    max_rows_per_participant,
+    n_jobs,
+    seed,
+):
+    """Grouped permutation importance of a trained classifier
+
+    The importance of a group of columns is the decrease of the (pooled)
+    macro F1 score when the values of the group are shuffled. Unlike the
+    impurity-based importances of the random forest, this isn't biased
+    toward the many correlated rolling and spectrogram columns, and
+    correlated columns can be grouped (see --group) so that one
+    permutation covers the whole group.
+
+    \b
+    * Rows are only shuffled within participants, so a permuted row
+      keeps the participant's distribution of the group's values and
+      only loses its alignment with the label.
+    * The columns of a group are shuffled with the same permutation, so
+      the correlations within the group are preserved.
+    * The features are converted once into a read-only float32 array
+      that is shared by all (threaded) scoring tasks. A task only copies
+      the rows of one participant at a time.
+
+    The csv file contains one row per group, sorted by the mean
+    importance.
+    """
+    estimator = load_estimator(model_path)
+    if hasattr(estimator, "get_params") and "n_jobs" in estimator.get_params():
+        # parallelize across permutations instead of across trees
+        estimator.set_params(n_jobs=1, verbose=0)
+
+    with open(split_path) as f:
+        id_list = json.load(f)[participants]
+
+    with open(features_path, "rb") as f:
+        df = pickle.load(f)
+    X, y, bounds = get_feature_buffer(
+        df,
+        id_list,
+        columns=getattr(estimator, "feature_names_in_", None),
+        binary=binary,
+        max_rows_per_participant=max_rows_per_participant,
+        seed=seed,
+    )
+    del df
+    columns = list(getattr(estimator, "feature_names_in_", X.columns))
+    groups = get_column_groups(columns, group_specs)
+    print(
+        f"Permuting {len(groups)} feature groups within {len(bounds) - 1} participants ({len(y)} rows)."
+    )
+
+    # row-major, so that the rows of a participant are one contiguous block
+    buffer = np.ascontiguousarray(X.values)
+    buffer.flags.writeable = False
+    del X
+    labels = sorted(set(estimator.classes_).union(y))
+
+    baseline = score_permutation(estimator, buffer, columns, y, bounds, labels)
+    tasks = [
+        (name, repeat, [columns.index(c) for c in group_columns])
+        for name, group_columns in groups.items()
+        for repeat in range(n_repeats)
+    ]
+    scores = Parallel(n_jobs=n_jobs, prefer="threads", verbose=1)(
+        delayed(score_permutation)(
+            estimator,
+            buffer,
+            columns,
+            y,
+            bounds,
+            labels,
+            permuted=permuted,
+            seed=[seed, k, repeat],
+        )
+        for k, (_, repeat, permuted) in enumerate(tasks)
+    )
+
+    scores_df = pd.DataFrame(
+        {"Group": [name for name, _, _ in tasks], "f1_macro": scores}
+    )
+    importances_df = scores_df.groupby("Group", sort=False)["f1_macro"].agg(
+        ["mean", "std"]
+    )
+    importances_df = pd.DataFrame(
+        {
+            "Columns": [len(groups[name]) for name in importances_df.index],
+            "importance_mean": baseline - importances_df["mean"],
+            "importance_std": importances_df["std"],
+            "f1_macro_permuted": importances_df["mean"],
+            "ColumnNames": [" ".join(groups[name]) for name in importances_df.index],
+        },
+        index=importances_df.index,
+    ).sort_values("importance_mean", ascending=False)
+
+    print(f"Baseline macro F1: {baseline:.4f}")
+    print(importances_df.drop(columns="ColumnNames").head(20).to_string())
+    importances_df.to_csv(save_path)
+    print(f"Saved the permutation importances to {save_path}.")
+
+
+def get_feature_buffer(
+    df, id_list, columns=None, binary=False, max_rows_per_participant=None, seed=0
+):
+    """Prepare the features and labels of some participants for scoring
+
+    As in training.py, raw data ("Steps", "Value") columns are dropped,
+    rows with missing values are dropped and "Arm" is the label.
+
+    :param df: merged features and labels with indices ("Id", "Time")
+    :param id_list: participant IDs to keep (IDs that aren't in ``df``
+        are ignored)
+    :param columns: feature columns in the order of the estimator.
+        Defaults to None, which keeps all feature columns.
+    :param binary: whether to only keep the "aerobic" and "strength"
+        rows, defaults to False
+    :param max_rows_per_participant: optional number of rows to sample
+        from each participant. Defaults to None, which keeps all rows.
+    :param seed: random seed of the row sampling, defaults to 0
+    :returns: a tuple (X, y, bounds): a float32 dataframe of features
+        sorted by participant, a numpy array of labels, and a numpy array
+        with the first row of each participant followed by ``len(X)``
+    """
+    ids = df.index.get_level_values(0)
+    df = df[ids.isin(id_list)]
+    df = df.drop(["Steps", "Value"], axis=1, errors="ignore")
+    if binary:
+        df = df[df["Arm"].isin(["aerobic", "strength"])]
+    df = df.dropna()
+    df = df.sort_index(level=0, kind="stable", sort_remaining=False)
+
+    codes = pd.factorize(df.index.get_level_values(0))[0]
+    bounds = np.r_[0, np.flatnonzero(np.diff(codes)) + 1, len(df)]
+    if max_rows_per_participant is not None:
+        rng = np.random.default_rng(seed)
+        rows = [
+            (
+                np.sort(
+                    rng.choice(end - start, max_rows_per_participant, replace=False)
+                )
+                + start
+                if end - start > max_rows_per_participant
+                else np.arange(start, end)
+            )
+            for start, end in zip(bounds[:-1], bounds[1:])
+        ]
+        bounds = np.r_[0, np.cumsum([len(r) for r in rows])]
+        df = df.iloc[np.concatenate(rows)] if rows else df
+
+    y = df.pop("Arm").values
+    if columns is not None:
+        df = df[list(columns)]
+    return (df.astype(np.float32), y, bounds)
+
+
+def get_column_groups(columns, group_specs=()):
+    """Group feature columns for permutation
+
+    :param columns: list of feature column names
+    :param group_specs: list of "NAME=PATTERN[,PATTERN...]" strings with
+        shell-style patterns (see fnmatch), e.g. "HR_rolling=HR_*". A
+        column belongs to the first group with a matching pattern.
+    :returns: dict of group names and lists of column names. Columns that
+        don't match any group are their own (single column) group.
+    """
+    specs = []
+    for spec in group_specs:
+        name, _, patterns = spec.partition("=")
+        if not patterns:
+            raise click.BadParameter(f"Expected NAME=PATTERN, got '{spec}'.")
+        specs.append((name, patterns.split(",")))
+
+    groups = {name: [] for name, _ in specs}
+    for column in columns:
+        for name, patterns in specs:
+            if any(fnmatch.fnmatchcase(column, p) for p in patterns):
+                groups[name].append(column)
+                break
+        else:
+            groups[column] = [column]
+
+    return {name: group for name, group in groups.items() if group}
+
+
+def score_permutation(
+    estimator, buffer, columns, y, bounds, labels, permuted=(), seed=0
+):
+    """Pooled macro F1 score after permuting columns within participants
+
+    :param estimator: fitted classifier
+    :param buffer: read-only 2D numpy array of features, sorted by
+        participant
+    :param columns: feature column names of ``buffer``
+    :param y: numpy array of labels
+    :param bounds: numpy array with the first row of each participant in
+        ``buffer`` followed by its number of rows
+    :param labels: sorted list of all labels
+    :param permuted: indices of the columns to permute together.
+        Defaults to (), which scores the unpermuted features.
+    :param seed: random seed (or seed sequence) of the permutations
+    :returns: the macro F1 score of the predictions of all rows
+    """
+    rng = np.random.default_rng(seed)
+    permuted = list(permuted)
+    pooled = np.zeros((len(labels), len(labels)), dtype=np.int64)
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        block = np.array(buffer[start:end])
+        if permuted:
+            order = rng.permutation(end - start)
+            block[:, permuted] = block[np.ix_(order, permuted)]
+        y_pred = estimator.predict(pd.DataFrame(block, columns=columns, copy=False))
+        pooled += confusion_matrix(y[start:end], y_pred, labels)
+
+    return float(f1_scores(pooled)[1])
+
+
+if __name__ == "__main__":
+    main()
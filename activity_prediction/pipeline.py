@@ -0,0 +1,488 @@
+import ast
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import click
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+PREPROCESSING_DIR = os.path.join(ROOT_DIR, "preprocessing")
+
+# default pipeline parameters; override any of them with --config
+DEFAULT_CONFIG = {
+    # relative to the preprocessing directory
+    "fitabase_export_dir": "Export-1-31-2020_2_57_pm/",
+    "labels_path": "labels/24HourFitnessUsage with Randomization Arms added.xlsx - STRONGD.csv",
+    # rolling_features.py
+    "window_size": "10min",
+    # spectrogram_features.py
+    "window_size_in_minutes": 10,
+    "overlap": False,
+    # merging.py: the features to merge (in this order) and the tolerance
+    "merge_features": ["hr_rolling", "steps_rolling"],
+    "tolerance": "1min",
+    "merged_name": "all_rolling_window=10min",
+    # training.py
+    "binary": False,
+}
+
+# files and directories that cleaning.py and merging.py save next to
+# every pickle file (see metadata.py and helperfuns.save_partitions), and
+# that cleaning.py saves next to the steps data only (see step_runs.py)
+SIDE_OUTPUTS = ["_metadata.json", "_partitions"]
+STEPS_SIDE_OUTPUTS = SIDE_OUTPUTS + ["_daily_totals.pickle", "_runs.pickle"]
+
+
+@click.command()
+@click.option(
+    "--config",
+    "config_path",
+    default=None,
+    help="Path to a json file that overrides any of the parameters in ``DEFAULT_CONFIG``.",
+)
+@click.option(
+    "--cache_dir",
+    default=os.path.join(ROOT_DIR, ".pipeline_cache"),
+    help="Path to the directory for the stage cache (content hashes and cached outputs).",
+)
+@click.option(
+    "--max_workers",
+    default=2,
+    type=int,
+    help="Maximum number of stages to run concurrently.",
+)
+@click.option(
+    "--force",
+    multiple=True,
+    help="Name of a stage to rerun even if its outputs are cached. Can be used multiple times.",
+)
+@click.option(
+    "--dry-run/--no-dry-run",
+    default=False,
+    help="Flag for only printing which stages would run (based on the current cache) without running them.",
+)
+def main(config_path, cache_dir, max_workers, force, dry_run):
+    """Run the preprocessing and training scripts as one cached pipeline
+
+    The stages (cleaning.py, clean_labels.py, spectrogram_features.py,
+    rolling_features.py, merging.py and training.py) form a DAG. Each
+    stage has a key that hashes its script, its parameters and the
+    contents of its inputs (which include the outputs of upstream
+    stages). A stage is skipped if it already ran with the same key: its
+    outputs are either still in place or restored from the cache.
+    Stages whose upstream stages are done run concurrently, e.g. the
+    spectrogram and rolling features.
+    """
+    config = dict(DEFAULT_CONFIG)
+    if config_path:
+        with open(config_path) as f:
+            config.update(json.load(f))
+
+    runner = PipelineRunner(build_stages(config), cache_dir)
+    runner.run(max_workers=max_workers, force=set(force), dry_run=dry_run)
+
+
+class Stage:
+    """One script invocation in the pipeline
+
+    :param name: unique name of the stage
+    :param script: path of the script, relative to ``cwd``
+    :param args: list of command line arguments for the script
+    :param cwd: working directory for running the script
+    :param inputs: list of file or directory paths (relative to
+        ``cwd``) that the stage reads
+    :param outputs: list of file or directory paths (relative to
+        ``cwd``) that the stage writes. Files in an output directory that
+        the stage didn't write are deleted when the outputs are restored
+        from the cache.
+    :param deps: names of the stages that must run first
+    """
+
+    def __init__(self, name, script, args, cwd, inputs=(), outputs=(), deps=()):
+        self.name = name
+        self.script = script
+        self.args = [str(a) for a in args]
+        self.cwd = cwd
+        self.inputs = [os.path.join(cwd, p) for p in inputs]
+        self.outputs = [os.path.join(cwd, p) for p in outputs]
+        self.deps = list(deps)
+
+    @property
+    def command(self):
+        return [sys.executable, self.script] + self.args
+
+
+def get_side_path(path, side):
+    """Path of a file or directory that a script saves next to a pickle
+    file, e.g. its metadata (see ``SIDE_OUTPUTS``)"""
+    return os.path.splitext(path)[0] + side
+
+
+def build_stages(config):
+    """Build the pipeline DAG for a set of parameters
+
+    :param config: dict of pipeline parameters (see ``DEFAULT_CONFIG``)
+    :returns: dict mapping stage names to Stage objects
+    """
+    steps_path = "clean_data/steps_minutes_df.pickle"
+    hr_path = "clean_data/hr_seconds_df.pickle"
+    labels_path = "clean_data/labels_df.pickle"
+    window = config["window_size"]
+    spectrogram_suffix = (
+        f"window={config['window_size_in_minutes']}min_overlap={config['overlap']}"
+    )
+    feature_paths = {
+        "hr_rolling": f"features/hr_rolling_features_df_window={window}.pickle",
+        "steps_rolling": f"features/steps_rolling_features_df_window={window}.pickle",
+        "hr_spectrogram": f"features/hr_spectrogram_features_df_{spectrogram_suffix}.pickle",
+        "steps_spectrogram": f"features/steps_spectrogram_features_df_{spectrogram_suffix}.pickle",
+    }
+    merged_path = f"features/merged/{config['merged_name']}.pickle"
+    merge_paths = [feature_paths[name] for name in config["merge_features"]]
+
+    stages = [
+        Stage(
+            "cleaning",
+            "cleaning.py",
+            ["--fitabase_export_dir", config["fitabase_export_dir"]]
+            + ["--save_dir", "clean_data/"],
+            cwd=PREPROCESSING_DIR,
+            inputs=[config["fitabase_export_dir"]],
+            outputs=[steps_path, hr_path]
+            + [get_side_path(steps_path, side) for side in STEPS_SIDE_OUTPUTS]
+            + [get_side_path(hr_path, side) for side in SIDE_OUTPUTS],
+        ),
+        Stage(
+            "clean_labels",
+            "clean_labels.py",
+            ["--labels_path", config["labels_path"], "--save_path", labels_path],
+            cwd=PREPROCESSING_DIR,
+            inputs=[config["labels_path"]],
+            outputs=[labels_path],
+        ),
+        Stage(
+            "spectrogram_features",
+            "spectrogram_features.py",
+            ["--cleaned_steps_path", steps_path, "--cleaned_hr_path", hr_path]
+            + ["--window_size_in_minutes", config["window_size_in_minutes"]]
+            + ["--overlap" if config["overlap"] else "--no-overlap"]
+            + ["--save_dir", "features/"],
+            cwd=PREPROCESSING_DIR,
+            inputs=[steps_path, hr_path],
+            outputs=[
+                feature_paths["steps_spectrogram"],
+                feature_paths["hr_spectrogram"],
+            ],
+            deps=["cleaning"],
+        ),
+        Stage(
+            "rolling_features",
+            "rolling_features.py",
+            ["--cleaned_steps_path", steps_path, "--cleaned_hr_path", hr_path]
+            + ["--window_size", window, "--save_dir", "features/"],
+            cwd=PREPROCESSING_DIR,
+            inputs=[steps_path, hr_path],
+            outputs=[feature_paths["steps_rolling"], feature_paths["hr_rolling"]],
+            deps=["cleaning"],
+        ),
+        Stage(
+            "merging",
+            "merging.py",
+            ["--tolerance", config["tolerance"]] + merge_paths + [merged_path],
+            cwd=PREPROCESSING_DIR,
+            inputs=merge_paths + [labels_path],
+            outputs=[merged_path]
+            + [get_side_path(merged_path, side) for side in SIDE_OUTPUTS],
+            deps=[
+                "clean_labels",
+                *(
+                    (
+                        "spectrogram_features"
+                        if "spectrogram" in name
+                        else "rolling_features"
+                    )
+                    for name in config["merge_features"]
+                ),
+            ],
+        ),
+        Stage(
+            "training",
+            "training.py",
+            ["--merged_features_path", os.path.join("preprocessing", merged_path)]
+            + ["--save_path", f"results/gridsearch_{config['merged_name']}.pickle"]
+            + ["--binary" if config["binary"] else "--not-binary"],
+            cwd=ROOT_DIR,
+            inputs=[
+                os.path.join("preprocessing", merged_path),
+                "train_test_participants.json",
+            ],
+            outputs=[f"results/gridsearch_{config['merged_name']}.pickle"],
+            deps=["merging"],
+        ),
+    ]
+    for stage in stages:
+        stage.deps = sorted(set(stage.deps))
+    return {stage.name: stage for stage in stages}
+
+
+def get_files(path):
+    """Paths of all files in a directory and its subdirectories (an
+    empty list if the directory doesn't exist)"""
+    return [
+        os.path.join(dirpath, filename)
+        for dirpath, _, filenames in sorted(os.walk(path))
+        for filename in sorted(filenames)
+    ]
+
+
+def get_local_modules(script_path):
+    """Find the source files of a script and the local modules that it
+    imports, directly or indirectly
+
+    Imports are resolved against the script's directory (the first entry
+    of ``sys.path`` when the script runs) and, for relative imports,
+    against the importing module's package. Imports that don't resolve
+    to a file there (e.g. pandas) are skipped. The imports are found
+    statically, so this includes imports inside functions and both
+    branches of ``try``/``except ImportError``.
+
+    :param script_path: path to a python script
+    :returns: sorted list of paths, including ``script_path``
+    """
+    root = os.path.dirname(os.path.abspath(script_path))
+
+    def resolve(base, dotted):
+        path = os.path.join(base, *dotted.split("."))
+        for candidate in [path + ".py", os.path.join(path, "__init__.py")]:
+            if os.path.isfile(candidate):
+                return [candidate]
+        return []
+
+    found = set()
+    todo = [os.path.abspath(script_path)]
+    while todo:
+        path = todo.pop()
+        if path in found:
+            continue
+        found.add(path)
+        with open(path) as f:
+            tree = ast.parse(f.read(), path)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                for alias in node.names:
+                    parts = alias.name.split(".")
+                    for i in range(1, len(parts) + 1):
+                        todo += resolve(root, ".".join(parts[:i]))
+            elif isinstance(node, ast.ImportFrom):
+                if node.level:
+                    base = os.path.dirname(path)
+                    for _ in range(node.level - 1):
+                        base = os.path.dirname(base)
+                else:
+                    base = root
+                module = node.module or ""
+                parts = module.split(".") if module else []
+                for i in range(1, len(parts) + 1):
+                    todo += resolve(base, ".".join(parts[:i]))
+                # "from package import module"
+                for alias in node.names:
+                    todo += resolve(base, ".".join(parts + [alias.name]))
+    return sorted(found)
+
+
+class PipelineRunner:
+    """Run the stages of a pipeline DAG with content-addressed caching
+
+    The cache directory contains:
+
+    * ``digests.json``: content digests of files, keyed by their path,
+      size and modification time, so that unchanged files are hashed
+      only once.
+    * ``stages/<key>.json``: the output digests of a stage run with this
+      key.
+    * ``objects/<digest>``: cached copies of the output files, used to
+      restore outputs that were overwritten by a run with different
+      parameters.
+    """
+
+    def __init__(self, stages, cache_dir):
+        self.stages = stages
+        self.cache_dir = cache_dir
+        os.makedirs(os.path.join(cache_dir, "stages"), exist_ok=True)
+        os.makedirs(os.path.join(cache_dir, "objects"), exist_ok=True)
+        self.keys = dict()  # keys of the stages that are running
+        self.rerun = set()  # stages that would run (for dry runs)
+        self.digests_path = os.path.join(cache_dir, "digests.json")
+        self.digests = dict()
+        if os.path.exists(self.digests_path):
+            with open(self.digests_path) as f:
+                self.digests = json.load(f)
+
+    def file_digest(self, path):
+        """SHA-256 digest of a file's contents (cached by path, size
+        and modification time)"""
+        stat = os.stat(path)
+        stat_key = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+        if stat_key not in self.digests:
+            sha = hashlib.sha256()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    sha.update(block)
+            self.digests[stat_key] = sha.hexdigest()
+        return self.digests[stat_key]
+
+    def path_digest(self, path):
+        """Digest of a file, or of all files (and their relative paths)
+        in a directory"""
+        if not os.path.isdir(path):
+            return self.file_digest(path)
+        sha = hashlib.sha256()
+        for dirpath, dirnames, filenames in sorted(os.walk(path)):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                file_path = os.path.join(dirpath, filename)
+                sha.update(os.path.relpath(file_path, path).encode())
+                sha.update(self.file_digest(file_path).encode())
+        return sha.hexdigest()
+
+    def stage_key(self, stage):
+        """Hash of a stage's command, source code and input contents
+
+        The source code is the stage's script and every local module that
+        it imports, directly or indirectly (see ``get_local_modules``).
+        """
+        sha = hashlib.sha256()
+        sha.update(json.dumps([stage.name, stage.script, stage.args]).encode())
+        for path in get_local_modules(os.path.join(stage.cwd, stage.script)):
+            sha.update(os.path.relpath(path, ROOT_DIR).encode())
+            sha.update(self.file_digest(path).encode())
+        for path in stage.inputs:
+            sha.update(path.encode())
+            sha.update(self.path_digest(path).encode())
+        return sha.hexdigest()
+
+    def is_cached(self, stage, key):
+        """Check whether a stage already ran with this key, restoring
+        its outputs from the object cache if necessary
+
+        :returns: True if all outputs are in place with the cached
+            contents
+        """
+        record_path = os.path.join(self.cache_dir, "stages", f"{key}.json")
+        if not os.path.exists(record_path):
+            return False
+        with open(record_path) as f:
+            outputs = json.load(f)
+
+        for path, digest in outputs.items():
+            if os.path.exists(path) and self.file_digest(path) == digest:
+                continue
+            cached = os.path.join(self.cache_dir, "objects", digest)
+            if not os.path.exists(cached):
+                return False
+            print(f"[{stage.name}] Restoring {path} from the cache.")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # keep the modification time, which the metadata and the
+            # partition manifests use to detect replaced pickle files
+            shutil.copy2(cached, path)
+
+        # files that another run wrote into an output directory
+        for path in stage.outputs:
+            for file_path in get_files(path):
+                if file_path not in outputs:
+                    print(f"[{stage.name}] Removing {file_path}.")
+                    os.remove(file_path)
+        return True
+
+    def store(self, stage, key):
+        """Record the outputs of a stage run and add them to the object
+        cache"""
+        outputs = dict()
+        for path in stage.outputs:
+            for file_path in get_files(path) if os.path.isdir(path) else [path]:
+                digest = self.file_digest(file_path)
+                cached = os.path.join(self.cache_dir, "objects", digest)
+                if not os.path.exists(cached):
+                    # not a hard link, which the scripts would overwrite
+                    # in place when they rerun
+                    shutil.copy2(file_path, cached)
+                outputs[file_path] = digest
+        with open(os.path.join(self.cache_dir, "stages", f"{key}.json"), "w") as f:
+            json.dump(outputs, f)
+
+    def run_stage(self, stage):
+        """Run a stage's script and fail if it doesn't succeed"""
+        for path in stage.outputs:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        print(f"[{stage.name}] Running: {' '.join(stage.command)}")
+        start = time.perf_counter()
+        subprocess.run(stage.command, cwd=stage.cwd, check=True)
+        print(f"[{stage.name}] Finished in {time.perf_counter() - start:.1f}s.")
+
+    def run(self, max_workers=2, force=(), dry_run=False):
+        """Run all stages in dependency order, skipping cached stages
+
+        :param max_workers: maximum number of stages to run concurrently
+        :param force: names of stages to rerun regardless of the cache
+        :param dry_run: only print which stages would run
+        """
+        done = set()
+        running = dict()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while len(done) < len(self.stages):
+                for name, stage in self.stages.items():
+                    if name in done or name in running.values():
+                        continue
+                    if not all(dep in done for dep in stage.deps):
+                        continue
+
+                    if dry_run and any(dep in self.rerun for dep in stage.deps):
+                        # the inputs will change, so the key is unknown
+                        print(f"[{name}] Would run (upstream stages run).")
+                        self.rerun.add(name)
+                        done.add(name)
+                        continue
+
+                    key = self.stage_key(stage)
+                    if name not in force and self.is_cached(stage, key):
+                        print(f"[{name}] Skipping (cached).")
+                        done.add(name)
+                        continue
+
+                    if dry_run:
+                        print(f"[{name}] Would run.")
+                        self.rerun.add(name)
+                        done.add(name)
+                        continue
+
+                    future = executor.submit(self.run_stage, stage)
+                    running[future] = name
+                    self.keys[name] = key
+
+                if not running:
+                    continue
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    future.result()  # re-raise errors of the stage
+                    self.store(self.stages[name], self.keys[name])
+                    done.add(name)
+
+                self.save_digests()
+
+        self.save_digests()
+
+    def save_digests(self):
+        """Persist the file digests, so that unchanged files are not
+        hashed again by the next run"""
+        with open(self.digests_path, "w") as f:
+            json.dump(self.digests, f)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+import pandas as pd
+import numpy as np
+import pickle
+import os
+import click
+from joblib import Parallel, delayed
+from tqdm import tqdm
+
+from exporting import CompactForest
+from preprocessing import helperfuns
+
+
+@click.command()
+@click.option(
+    "--model_path",
+    help="Path to the pickle file containing the grid search results saved by training.py, or path to the directory containing a random forest exported by exporting.py. The best estimator of the grid search is used for scoring.",
+)
+@click.option(
+    "--features_path",
+    help="Path to the pickle file containing the merged dataframe with all features (with indices ('Id', 'Time')), or path to a directory of such pickle files (e.g. one file per participant). If the pickle file was saved with per-participant partitions (see merging.py), or in the case of a directory, only ``--chunk_size`` participants are held in memory at a time.",
+)
+@click.option(
+    "--save_dir",
+    help="Path to the directory for saving the per-row class probabilities and the per-session labels (as two separate csv files).",
+)
+@click.option(
+    "--chunk_size",
+    default=1,
+    type=int,
+    help="Number of participants to score at a time.",
+)
+@click.option(
+    "--n_jobs",
+    default=-1,
+    type=int,
+    help="Number of participants to score in parallel within a chunk. This corresponds to the ``n_jobs`` parameter in joblib.Parallel.",
+)
+@click.option(
+    "--session_gap",
+    default="30min",
+    help="Consecutive rows of a participant that are further apart than this belong to separate sessions. This must use pandas's 'offset alias' syntax (see https://pandas.pydata.org/pandas-docs/stable/user_guide/timeseries.html#offset-aliases), e.g. '30min'.",
+)
+def main(model_path, features_path, save_dir, chunk_size, n_jobs, session_gap):
+    """Score merged features with a trained random forest
+
+    The features are streamed in chunks of ``chunk_size`` participants,
+    and the participants within a chunk are scored in parallel. The
+    results are appended to two csv files in ``save_dir``:
+
+    * ``row_probabilities.csv``: the class probabilities and the
+      predicted label for every (non-missing) row of features.
+    * ``session_labels.csv``: one row per session, i.e. per run of a
+      participant's rows without gaps larger than ``session_gap``. The
+      session label is the class with the highest mean probability
+      across the rows of the session.
+    """
+    estimator = load_estimator(model_path)
+    if hasattr(estimator, "get_params") and "n_jobs" in estimator.get_params():
+        # parallelize across participants instead of across trees
+        estimator.set_params(n_jobs=1, verbose=0)
+
+    rows_save_path = os.path.join(save_dir, "row_probabilities.csv")
+    sessions_save_path = os.path.join(save_dir, "session_labels.csv")
+    for path in [rows_save_path, sessions_save_path]:
+        if os.path.exists(path):
+            os.remove(path)
+
+    print("Scoring participants.")
+    session_gap = pd.Timedelta(session_gap)
+    for chunk in tqdm(iter_feature_chunks(features_path, chunk_size)):
+        results = Parallel(n_jobs=n_jobs, prefer="threads")(
+            delayed(score_participant)(estimator, participant_df, session_gap)
+            for _, participant_df in chunk.groupby(level="Id", sort=False)
+        )
+        for rows_df, sessions_df in results:
+            if rows_df is None:
+                continue
+            append_csv(rows_df, rows_save_path, index=True)
+            append_csv(sessions_df, sessions_save_path, index=False)
+
+    print(f"Saved the per-row class probabilities to {rows_save_path}.")
+    print(f"Saved the per-session labels to {sessions_save_path}.")
+
+
+def load_estimator(model_path):
+    """Load the estimator to use for scoring
+
+    :param model_path: path to a pickle file containing either a fitted
+        scikit-learn estimator or the fitted grid search (e.g.
+        ``GridSearchCV``) saved by training.py, or path to a directory
+        containing a random forest exported by exporting.py
+    :returns: the fitted estimator (the best estimator of a grid search)
+    """
+    if os.path.isdir(model_path):
+        return CompactForest.load(model_path)
+
+    with open(model_path, "rb") as f:
+        model = pickle.load(f)
+
+    return getattr(model, "best_estimator_", model)
+
+
+def iter_feature_chunks(features_path, chunk_size):
+    """Iterate over the merged features in chunks of participants
+
+    A pickle file is read from its per-participant partitions (see
+    ``helperfuns.save_partitions``) one chunk at a time. Without
+    partitions, the whole pickle file is loaded into memory.
+
+    :param features_path: path to a pickle file containing a pandas
+        dataframe with indices ("Id", "Time"), or path to a directory of
+        such pickle files
+    :param chunk_size: number of participants per chunk
+    :returns: generator of pandas dataframes, each containing all rows
+        of at most ``chunk_size`` participants
+    """
+    if not os.path.isdir(features_path):
+        manifest = helperfuns.read_manifest(features_path)
+        if manifest is not None:
+            id_list = manifest["participants"]
+            for i in range(0, len(id_list), chunk_size):
+                yield helperfuns.load_partitions(
+                    features_path, ids=id_list[i : i + chunk_size]
+                )
+            return
+
+        print(
+            f"Warning: {features_path} has no partitions, so all participants are loaded into memory at once. Run merging.py with --save_partitions to score one chunk of participants at a time."
+        )
+        with open(features_path, "rb") as f:
+            df = pickle.load(f)
+        id_list = list(df.index.get_level_values(0).unique())
+        for i in range(0, len(id_list), chunk_size):
+            yield df.loc[id_list[i : i + chunk_size]]
+        return
+
+    paths = sorted(
+        os.path.join(features_path, f)
+        for f in os.listdir(features_path)
+        if f.endswith(".pickle")
+    )
+    for i in range(0, len(paths), chunk_size):
+        dfs = []
+        for path in paths[i : i + chunk_size]:
+            with open(path, "rb") as f:
+                dfs.append(pickle.load(f))
+        yield pd.concat(dfs)
+
+
+def score_participant(estimator, participant_df, session_gap):
+    """Predict class probabilities for one participant and aggregate them
+    into sessions
+
+    :param estimator: fitted scikit-learn classifier
+    :param participant_df: pandas dataframe with indices ("Id", "Time")
+        containing the features of a single participant. Raw data
+        ("Steps", "Value") and label ("Arm") columns are ignored, and
+        rows with missing features are dropped.
+    :param session_gap: pandas.Timedelta. Consecutive rows that are
+        further apart than this belong to separate sessions.
+    :returns: a tuple of two pandas dataframes: (rows_df, sessions_df).
+        ``rows_df`` has the indices ("Id", "Time") and one probability
+        column per class plus a "Predicted" column. ``sessions_df`` has
+        one row per session with the columns "Id", "Start", "End",
+        "Rows", the mean probability per class, and "Predicted". Both
+        are None if the participant has no rows without missing
+        features.
+    """
+    X = participant_df.drop(["Steps", "Value", "Arm"], axis=1, errors="ignore")
+    X = X.dropna()
+    if X.empty:
+        return (None, None)
+    if hasattr(estimator, "feature_names_in_"):
+        X = X[estimator.feature_names_in_]
+
+    classes = list(estimator.classes_)
+    rows_df = pd.DataFrame(estimator.predict_proba(X), index=X.index, columns=classes)
+    rows_df["Predicted"] = np.array(classes)[rows_df[classes].values.argmax(axis=1)]
+
+    # start a new session whenever the gap to the previous row is too
+    # large
+    time = X.index.get_level_values("Time")
+    session = np.cumsum(np.diff(time.values, prepend=time.values[:1]) > session_gap)
+    grouped = rows_df[classes].groupby(session)
+    sessions_df = grouped.mean()
+    sessions_df.insert(0, "Rows", grouped.size().values)
+    sessions_df.insert(0, "End", time.to_series().groupby(session).max().values)
+    sessions_df.insert(0, "Start", time.to_series().groupby(session).min().values)
+    sessions_df.insert(0, "Id", X.index.get_level_values("Id")[0])
+    sessions_df["Predicted"] = np.array(classes)[
+        sessions_df[classes].values.argmax(axis=1)
+    ]
+
+    return (rows_df, sessions_df.reset_index(drop=True))
+
+
+def append_csv(df, path, index):
+    """Append a dataframe to a csv file, writing the header only if the
+    file doesn't exist yet"""
+    df.to_csv(path, mode="a", header=not os.path.exists(path), index=index)
+
+
+if __name__ == "__main__":
+    main()
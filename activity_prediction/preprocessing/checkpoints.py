@@ -0,0 +1,316 @@
+import pandas as pd
+import numpy as np
+import pickle
+import json
+import os
+
+import helperfuns
+import sharding
+import step_runs
+from metadata import read_metadata
+
+
+class FeatureCheckpoints:
+    """Per-participant checkpoints of the feature scripts
+
+    The features of every participant are saved as soon as they are
+    calculated (one pickle file per participant and output, e.g. "steps"
+    and "hr"), and a "manifest.json" file records the completed
+    participants and the parameters of the run. If the run is
+    interrupted, a rerun with the same parameters skips the completed
+    participants. Once all participants are completed, ``assemble``
+    streams the checkpoints into one dataframe per output.
+    """
+
+    def __init__(self, checkpoint_dir, params, resume=True):
+        """
+        :param checkpoint_dir: path to the directory of the checkpoints
+        :param params: json-serializable dict of the parameters (and
+            inputs, see ``input_signature``) of the run. Checkpoints of a
+            run with different parameters are discarded.
+        :param resume: whether to keep the existing checkpoints (with
+            the same parameters), defaults to True
+        """
+        self.checkpoint_dir = checkpoint_dir
+        self.manifest_path = os.path.join(checkpoint_dir, "manifest.json")
+        # round trip through json so that params compare equal to the
+        # params read from the manifest
+        self.params = json.loads(json.dumps(params))
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+        self.manifest = None
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            if not resume:
+                print(f"Discarding the checkpoints in {checkpoint_dir}.")
+            elif manifest["params"] != self.params:
+                print(
+                    f"The checkpoints in {checkpoint_dir} were created with different parameters or inputs, discarding them."
+                )
+            else:
+                self.manifest = manifest
+                print(
+                    f"Resuming from {len(manifest['completed'])} checkpointed participants in {checkpoint_dir}."
+                )
+            if self.manifest is None:
+                self._remove(manifest)
+
+        if self.manifest is None:
+            self.manifest = {"params": self.params, "completed": dict()}
+            self._write_manifest()
+
+    def _remove(self, manifest):
+        """Remove the checkpoint files listed in a manifest"""
+        for outputs in manifest["completed"].values():
+            for output in outputs.values():
+                path = os.path.join(self.checkpoint_dir, output["file"])
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _write_manifest(self):
+        # write to a temporary file first, so that an interruption
+        # can't leave a partially written manifest
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def is_complete(self, participant_id):
+        return participant_id in self.manifest["completed"]
+
+    def remaining(self, ids):
+        """The participants in ``ids`` that aren't checkpointed yet"""
+        return [i for i in ids if not self.is_complete(i)]
+
+    def save(self, participant_id, outputs):
+        """Checkpoint the features of one participant
+
+        :param participant_id: participant ID
+        :param outputs: dict of the output names (e.g. "steps" and "hr")
+            and pandas dataframes of the participant's features, indexed
+            by time only
+        """
+        completed = dict()
+        for name, df in outputs.items():
+            file_name = f"{participant_id}_{name}.pickle"
+            path = os.path.join(self.checkpoint_dir, file_name)
+            with open(path + ".tmp", "wb") as f:
+                pickle.dump(df, f)
+            os.replace(path + ".tmp", path)
+            completed[name] = {
+                "file": file_name,
+                "rows": len(df),
+                "columns": [str(c) for c in df.columns],
+                "dtypes": [str(d) for d in df.dtypes],
+                "index_dtype": str(df.index.dtype),
+            }
+
+        # only record the participant once all of its outputs are saved
+        self.manifest["completed"][participant_id] = completed
+        self._write_manifest()
+
+    def load(self, participant_id, name):
+        """Load the checkpointed features of one participant"""
+        file_name = self.manifest["completed"][participant_id][name]["file"]
+        with open(os.path.join(self.checkpoint_dir, file_name), "rb") as f:
+            return pickle.load(f)
+
+    def assemble(self, name, ids, index_names, input_path=None):
+        """Combine the checkpoints of all participants into one dataframe
+
+        This is equivalent to concatenating the checkpoints with
+        ``pd.concat``, but the combined columns are allocated up front
+        (from the row counts and dtypes in the manifest) and filled one
+        checkpoint at a time, so only one participant's checkpoint is in
+        memory besides the result.
+
+        :param name: name of the output, e.g. "steps"
+        :param ids: list of participant IDs, in the order of the rows of
+            the result. All of them must be checkpointed.
+        :param index_names: names of the (participant ID, time) index of
+            the result, e.g. ["Id", "Time"]
+        :param input_path: optional path of the cleaned data the
+            features were calculated from. If there are no checkpoints
+            with rows (e.g. for a shard without participants), the
+            index of the empty result has the index dtypes of its
+            metadata (see metadata.py). Defaults to None.
+        :returns: pandas dataframe of all participants' features
+        """
+        missing = self.remaining(ids)
+        if missing:
+            raise ValueError(f"Participants without checkpoints: {missing}")
+
+        outputs = [self.manifest["completed"][i][name] for i in ids]
+        # participants without rows don't contribute to the result
+        ids = [i for i, output in zip(ids, outputs) if output["rows"] > 0]
+        outputs = [output for output in outputs if output["rows"] > 0]
+        if not outputs:
+            return self._empty(name, index_names, input_path)
+
+        columns = outputs[0]["columns"]
+        for participant_id, output in zip(ids, outputs):
+            if output["columns"] != columns:
+                raise ValueError(
+                    f"The {name} features of participant {participant_id} have different columns than those of participant {ids[0]}."
+                )
+
+        rows = np.array([output["rows"] for output in outputs])
+        offsets = np.r_[0, np.cumsum(rows)]
+        dtypes = [
+            np.result_type(*[np.dtype(output["dtypes"][j]) for output in outputs])
+            for j in range(len(columns))
+        ]
+        data = [np.empty(offsets[-1], dtype=dtype) for dtype in dtypes]
+        time = np.empty(
+            offsets[-1],
+            dtype=np.result_type(*[np.dtype(o["index_dtype"]) for o in outputs]),
+        )
+
+        for k, participant_id in enumerate(ids):
+            df = self.load(participant_id, name)
+            if k == 0:
+                column_labels = df.columns
+            start, end = offsets[k], offsets[k + 1]
+            time[start:end] = df.index.values
+            for j in range(len(columns)):
+                data[j][start:end] = df.iloc[:, j].values
+            del df
+
+        index = pd.MultiIndex.from_arrays(
+            [np.repeat(np.array(ids, dtype=object), rows), time], names=index_names
+        )
+        assembled_df = pd.DataFrame(dict(enumerate(data)), index=index, copy=False)
+        assembled_df.columns = column_labels
+        return assembled_df
+
+    def _empty(self, name, index_names, input_path=None):
+        """Empty dataframe with the columns of the checkpoints (without
+        columns if there are no checkpoints, e.g. for a shard without
+        participants)"""
+        metadata = read_metadata(input_path) if input_path is not None else None
+        id_dtype, time_dtype = (
+            metadata["index_dtypes"]
+            if metadata is not None and "index_dtypes" in metadata
+            else (object, "datetime64[ns]")
+        )
+        ids = pd.Index([], dtype=id_dtype)
+        for participant_id in self.manifest["completed"]:
+            df = self.load(participant_id, name).iloc[:0]
+            df.index = pd.MultiIndex.from_arrays(
+                [ids, df.index.astype(time_dtype)], names=index_names
+            )
+            return df
+        return pd.DataFrame(
+            index=pd.MultiIndex.from_arrays(
+                [ids, pd.DatetimeIndex([], dtype=time_dtype)], names=index_names
+            )
+        )
+
+
+def input_signature(paths):
+    """Size and modification time of input files, for recognizing
+    checkpoints of outdated inputs
+
+    :param paths: list of paths to input files
+    :returns: dict of the paths and [size, mtime] lists
+    """
+    signature = dict()
+    for path in paths:
+        stat = os.stat(path)
+        signature[path] = [stat.st_size, stat.st_mtime]
+    return signature
+
+
+def load_remaining_data(
+    checkpoints, steps_path, hr_path, strict=False, shard=None, use_step_runs=False
+):
+    """Load the cleaned steps and HR data of the participants that
+    aren't checkpointed yet
+
+    Only the remaining participants are read if the cleaned data were
+    saved as per-participant partitions (see
+    ``helperfuns.save_partitions``). Otherwise all data are loaded.
+
+    :param checkpoints: FeatureCheckpoints of the run
+    :param strict: whether to verify the saved metadata of the cleaned
+        data (see ``helperfuns.load_data``), defaults to False
+    :param shard: optional shard (i, N) of the participants to process
+        (see sharding.py). Defaults to None, which processes all
+        participants.
+    :param use_step_runs: whether to load the run-length encoded steps
+        saved next to ``steps_path`` (see step_runs.py) instead of the
+        per-minute steps data, which are then not read at all. Defaults
+        to False.
+    :returns: a tuple (id_list, remaining_ids, steps_df, hr_df), where
+        ``id_list`` contains all participants (of the shard) in the
+        order of the assembled features, ``steps_df`` contains the step
+        runs if ``use_step_runs`` is True, and the dataframes are None
+        if no participants remain
+    """
+    # the participants are known up front from the partition manifests,
+    # or from the metadata (see metadata.py) if only a shard is needed
+    steps_manifest = helperfuns.read_manifest(steps_path)
+    hr_manifest = helperfuns.read_manifest(hr_path)
+    steps_metadata = read_metadata(steps_path)
+    participants = None
+    if steps_manifest is not None and hr_manifest is not None:
+        participants = steps_manifest["participants"]
+    elif use_step_runs and hr_manifest is not None:
+        participants = hr_manifest["participants"]
+    elif shard is not None and steps_metadata is not None:
+        participants = sorted(steps_metadata["participants"])
+
+    if participants is not None:
+        id_list = sharding.select_ids(participants, shard)
+        remaining_ids = checkpoints.remaining(id_list)
+        if not remaining_ids:
+            return (id_list, remaining_ids, None, None)
+        subset_ids = remaining_ids
+    else:
+        subset_ids = None
+
+    steps_df, hr_df = helperfuns.load_data(
+        steps_path=None if use_step_runs else steps_path,
+        hr_path=hr_path,
+        validate_ids=True,
+        sample_num=None,
+        subset_ids=subset_ids,
+        sort=True,
+        strict=strict,
+    )
+    if use_step_runs:
+        steps_df = step_runs.load_runs(steps_path, ids=subset_ids)
+        if steps_df is None:
+            raise FileNotFoundError(
+                f"There are no up-to-date step runs saved next to {steps_path} (see cleaning.py)."
+            )
+        print(
+            "Validating that the step runs and HR data have the same set of participant IDs."
+        )
+        hr_metadata = read_metadata(hr_path)
+        if subset_ids is not None:
+            hr_ids = set(subset_ids)
+        elif hr_metadata is not None:
+            hr_ids = set(hr_metadata["participants"])
+        else:
+            hr_ids = set(hr_df.index.get_level_values(0).unique())
+        assert set(steps_df.index.get_level_values(0).unique()) == hr_ids
+
+    if subset_ids is None:
+        steps_df = sharding.select_shard(steps_df, shard)
+        hr_df = sharding.select_shard(hr_df, shard)
+        id_list = list(steps_df.index.get_level_values(0).unique())
+        remaining_ids = checkpoints.remaining(id_list)
+
+    # Remove all step data on a day if the total number of steps is zero
+    # on that day
+    if use_step_runs:
+        steps_df = step_runs.remove_zero_daily_steps(steps_df)
+    else:
+        steps_df = helperfuns.remove_zero_daily_steps(
+            steps_df,
+            daily_totals=helperfuns.load_daily_step_totals(steps_path),
+        )
+
+    return (id_list, remaining_ids, steps_df, hr_df)
@@ -1,11 +1,33 @@
 import pandas as pd
 import pickle
-
-
-def main():
-    labels = pd.read_csv(
-        "labels/24HourFitnessUsage with Randomization Arms added.xlsx - STRONGD.csv"
-    )
+import click
+
+
+@click.command()
+@click.option(
+    "--labels_path",
+    default="labels/24HourFitnessUsage with Randomization Arms added.xlsx - STRONGD.csv",
+    help="Path to the csv file of the labels (the sessions of each participant).",
+)
+@click.option(
+    "--save_path",
+    default="clean_data/labels_df.pickle",
+    help="Path for saving the cleaned labels (pickle file).",
+)
+def main(labels_path, save_path):
+    """Clean and save the labels"""
+    clean_labels(labels_path, save_path)
+    print(f"Saved labels to {save_path}.")
+
+
+def clean_labels(labels_path, save_path):
+    """Clean the labels csv and save it as a pickle file
+
+    :param labels_path: path to the csv file of the labels
+    :param save_path: path for saving the cleaned labels, indexed by "Id"
+        and "Time"
+    """
+    labels = pd.read_csv(labels_path)
 
     # combine "Date" and "Time" columns and convert into one pandas datetime column called "Time"
     datetime = labels["Date"].str.cat(labels["Time"], sep=" ")
@@ -29,7 +51,7 @@ def main():
     labels.set_index(["Id", "Time"], inplace=True)
 
     # save
-    with open("clean_data/labels_df.pickle", "wb") as f:
+    with open(save_path, "wb") as f:
         pickle.dump(labels, f)
 
 
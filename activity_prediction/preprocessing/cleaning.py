@@ -1,9 +1,16 @@
 import pandas as pd
+import numpy as np
 import os
 from tqdm import tqdm
 import pickle
 import click
 
+import helperfuns
+import instrumentation
+import sharding
+import step_runs
+from metadata import save_metadata
+
 
 @click.command()
 @click.option(
@@ -14,7 +21,23 @@ import click
     "--save_dir",
     help="Path to the directory for saving the cleaned Fitabase/Fitbit data.",
 )
-def main(fitabase_export_dir, save_dir):
+@click.option(
+    "--report_path",
+    default=None,
+    help="Optional path for saving a json report with the wall time, CPU time, peak memory and row counts of each step.",
+)
+@click.option(
+    "--save_partitions/--no-save_partitions",
+    default=True,
+    help="Flag for whether or not to also save the cleaned data as one pickle file per participant (see helperfuns.save_partitions), so that helperfuns.load_data can read only the participants it needs.",
+)
+@click.option(
+    "--shard",
+    default=None,
+    callback=sharding.shard_callback,
+    help="Optional shard spec i/N for only cleaning the participants of shard i of N (see sharding.py). The outputs are saved with a '_shard-i-of-N' suffix.",
+)
+def main(fitabase_export_dir, save_dir, report_path, save_partitions, shard):
     """Clean and save HR (seconds) and steps (minutes) data exported
     from Fitabase/Fitbit."""
 
@@ -25,37 +48,76 @@ def main(fitabase_export_dir, save_dir):
         if os.path.isfile(os.path.join(fitabase_export_dir, f))
         and (("minuteStepsNarrow" in f) or ("heartrate_seconds" in f))
     ]
+    # an exported file of each kind, whose columns and dtypes are used
+    # for the (empty) outputs of a shard without participants
+    steps_dtype_file = min(
+        [f for f in steps_hr_files if "minuteStepsNarrow" in f], default=None
+    )
+    hr_dtype_file = min(
+        [f for f in steps_hr_files if "heartrate_seconds" in f], default=None
+    )
+    if steps_dtype_file is None or hr_dtype_file is None:
+        raise click.ClickException(
+            f"No steps (minuteStepsNarrow) or HR (heartrate_seconds) files in {fitabase_export_dir}."
+        )
+    # only keep the files of the participants in the shard
+    steps_hr_files = [
+        f for f in steps_hr_files if sharding.select_ids([f.split("_")[0]], shard)
+    ]
     steps_file_list = [f for f in steps_hr_files if "minuteStepsNarrow" in f]
     hr_file_list = [f for f in steps_hr_files if "heartrate_seconds" in f]
+    if not steps_hr_files:
+        print(f"No participants in shard {shard[0]}/{shard[1]}, saving empty data.")
 
     print("Steps:")
-    steps_save_path = os.path.join(save_dir, "steps_minutes_df.pickle")
+    steps_save_path = sharding.get_shard_path(
+        os.path.join(save_dir, "steps_minutes_df.pickle"), shard
+    )
     steps_df = clean(
         export_dir=fitabase_export_dir,
         file_list=steps_file_list,
         datetime_col="ActivityMinute",
         save_path=steps_save_path,
+        save_partitions=save_partitions,
+        dtype_file=steps_dtype_file,
     )
     print(f"Saved steps data to {steps_save_path}.")
 
     print("HR:")
-    hr_save_path = os.path.join(save_dir, "hr_seconds_df.pickle")
+    hr_save_path = sharding.get_shard_path(
+        os.path.join(save_dir, "hr_seconds_df.pickle"), shard
+    )
     hr_df = clean(
         export_dir=fitabase_export_dir,
         file_list=hr_file_list,
         datetime_col="Time",
         save_path=hr_save_path,
+        save_partitions=save_partitions,
+        dtype_file=hr_dtype_file,
     )
     print(f"Saved HR data to {hr_save_path}.")
 
+    instrumentation.write_report(report_path)
+
 
-def clean(export_dir, file_list, datetime_col, save_path):
+@instrumentation.timed("clean", rows=len)
+def clean(
+    export_dir,
+    file_list,
+    datetime_col,
+    save_path,
+    save_partitions=False,
+    dtype_file=None,
+):
     """Clean exported Fitabase/Fitbit data
-    
+
     This function reads exported Fitabase files as dataframes,
     concatenates these dataframes and cleans the resulting concatenated
-    dataframe.
-    
+    dataframe. The rows of each participant are sorted by time and rows
+    with the same timestamp are dropped (keeping the row of the first
+    file, in the order of the file names), so the cleaned dataframe is
+    sorted by participant ID and then time and its index is unique.
+
     :param export_dir: full path to directory containing exported
         Fitabase files
     :param file_list: list of filenames (nested under export_dir) to be
@@ -66,44 +128,174 @@ def clean(export_dir, file_list, datetime_col, save_path):
     :param datetime_col: name of column containing datetime values
     :param save_path: full path for saving the concatenated and cleaned
         dataframe as a pickle
+    :param save_partitions: whether to also save the cleaned dataframe
+        as one pickle file per participant (see
+        ``helperfuns.save_partitions``), defaults to False
+    :param dtype_file: optional filename (nested under export_dir) of
+        an exported file whose columns and dtypes are used if
+        file_list is empty, e.g. for a shard without participants. The
+        cleaned dataframe is then empty, defaults to None
     :returns: the concatenated and cleaned dataframe
+
+    The metadata of the cleaned dataframe (see metadata.py) are saved
+    next to ``save_path``. For step data, the run-length encoded steps
+    and the daily step totals are also saved next to ``save_path`` (see
+    ``step_runs.get_runs_path`` and ``helperfuns.get_daily_totals_path``).
     """
 
-    # concatenate all participants, index on participant and time
-    id_data_dict = dict()
+    # group the files by participant
+    participant_files = dict()
+    for f in sorted(file_list):
+        participant_files.setdefault(f.split("_")[0], []).append(f)
 
-    print("Concatenating.")
-    for f in tqdm(file_list):
-        participant_id = f.split("_")[0]
-        path = os.path.join(export_dir, f)
-        df = pd.read_csv(path)
-        id_data_dict[participant_id] = df
-
-    concat_df = pd.concat(id_data_dict)
-
-    print("Converting to datetime format.")
-    # convert to datetime type
-    concat_df[datetime_col] = pd.to_datetime(
-        concat_df[datetime_col], format="%m/%d/%Y %I:%M:%S %p"
-    )
+    # sort and deduplicate each participant's data once, so that the
+    # concatenated dataframe is sorted by participant and then time
+    print("Reading, sorting and deduplicating each participant's files.")
+    participant_dfs = []
+    duplicates = 0
+    for participant_id in tqdm(sorted(participant_files)):
+        participant_df, participant_duplicates = read_participant(
+            export_dir, participant_files[participant_id], datetime_col
+        )
+        participant_df.insert(0, "Id", participant_id)
+        participant_dfs.append(participant_df)
+        duplicates += participant_duplicates
+    if duplicates:
+        print(f"Dropped {duplicates} rows with duplicate timestamps.")
 
-    print("Reindexing.")
-    # reindex to (id, datetime)
-    concat_df.reset_index(inplace=True)
-    concat_df.rename(columns={"level_0": "Id"}, inplace=True)
-    concat_df.set_index(["Id", datetime_col], inplace=True)
-    concat_df.drop(columns="level_1", inplace=True)
+    if not participant_dfs:
+        if dtype_file is None:
+            raise ValueError("No files to clean and no dtype_file given.")
+        # the columns and dtypes of the exported files, without rows
+        empty_df, _ = read_participant(export_dir, [dtype_file], datetime_col, nrows=1)
+        empty_df.insert(0, "Id", dtype_file.split("_")[0])
+        participant_dfs.append(empty_df.iloc[:0])
 
-    # just in case, drop duplicates in the index
-    concat_df.index.drop_duplicates()
+    print("Concatenating.")
+    # index on participant and time
+    concat_df = pd.concat(participant_dfs, ignore_index=True)
+    del participant_dfs
+    concat_df.set_index(["Id", datetime_col], inplace=True)
 
     print("Saving.")
     # save
     with open(save_path, "wb") as f:
         pickle.dump(concat_df, f)
+    # records that the data are sorted and deduplicated, so that
+    # helperfuns.load_data doesn't sort them again
+    save_metadata(concat_df, save_path)
+
+    manifest_path = os.path.join(
+        helperfuns.get_partition_dir(save_path), "manifest.json"
+    )
+    if save_partitions:
+        print("Saving per-participant partitions.")
+        helperfuns.save_partitions(concat_df, save_path, presorted=True)
+    elif os.path.exists(manifest_path):
+        # don't let helperfuns.load_data read outdated partitions
+        os.remove(manifest_path)
+
+    daily_totals_path = helperfuns.get_daily_totals_path(save_path)
+    runs_path = step_runs.get_runs_path(save_path)
+    if "Steps" in concat_df.columns:
+        # run-length encode the steps (see step_runs.py)
+        runs_df = step_runs.encode_runs(concat_df)
+        step_runs.save_runs(runs_df, save_path)
+        print(f"Encoded {len(concat_df)} minutes of steps as {len(runs_df)} runs.")
+
+        # precompute the daily step totals for helperfuns.remove_zero_daily_steps
+        helperfuns.save_daily_step_totals(
+            step_runs.get_daily_step_totals(runs_df), save_path
+        )
+    else:
+        for path in [daily_totals_path, runs_path]:
+            if os.path.exists(path):
+                os.remove(path)
 
     return concat_df
 
 
+def read_participant(export_dir, files, datetime_col, nrows=None):
+    """Read, sort and deduplicate the exported files of one participant
+
+    Each file is sorted on its own (exported files are usually already
+    sorted, in which case this is skipped), and the sorted files are
+    then combined with a k-way merge (see ``merge_sorted_runs``).
+
+    :param export_dir: full path to directory containing exported
+        Fitabase files
+    :param files: filenames of the participant's files
+    :param datetime_col: name of column containing datetime values
+    :param nrows: optional number of rows to read from each file,
+        defaults to None (all rows)
+    :returns: tuple (df, duplicates) of the participant's rows sorted by
+        time, with a default index and only the first row of each
+        timestamp, and the number of dropped duplicate rows
+    """
+    runs = []
+    for f in files:
+        df = pd.read_csv(os.path.join(export_dir, f), nrows=nrows)
+        df[datetime_col] = pd.to_datetime(
+            df[datetime_col], format="%m/%d/%Y %I:%M:%S %p"
+        )
+        if not df[datetime_col].is_monotonic_increasing:
+            df = df.sort_values(datetime_col, kind="stable")
+        runs.append(df)
+
+    df = pd.concat(runs, ignore_index=True)
+    if len(runs) > 1:
+        df = df.iloc[
+            merge_sorted_runs([run[datetime_col].values for run in runs])
+        ].reset_index(drop=True)
+
+    time = df[datetime_col].values
+    keep = np.r_[True, time[1:] != time[:-1]]
+    if keep.all():
+        return (df, 0)
+    return (df[keep].reset_index(drop=True), int((~keep).sum()))
+
+
+def merge_sorted_runs(runs):
+    """Stable k-way merge of sorted arrays
+
+    The runs are merged pairwise in ceil(log2(k)) rounds, and each merge
+    of two runs places their values with binary searches, so merging n
+    values takes O(n log k) comparisons (vs. O(n log n) for sorting
+    them again).
+
+    :param runs: list of sorted numpy arrays
+    :returns: numpy array of the positions in the concatenated runs, in
+        merged order. Equal values keep the order of their runs.
+    """
+    offsets = np.cumsum([0] + [len(run) for run in runs[:-1]])
+    merged = [
+        (np.asarray(run), offset + np.arange(len(run)))
+        for run, offset in zip(runs, offsets)
+    ]
+    while len(merged) > 1:
+        pairs = [
+            _merge_two_runs(*merged[k], *merged[k + 1])
+            for k in range(0, len(merged) - 1, 2)
+        ]
+        if len(merged) % 2:
+            pairs.append(merged[-1])
+        merged = pairs
+
+    return merged[0][1] if merged else np.array([], dtype=int)
+
+
+def _merge_two_runs(a, a_positions, b, b_positions):
+    # the values of ``a`` come before equal values of ``b``
+    a_rows = np.arange(len(a)) + np.searchsorted(b, a, side="left")
+    b_rows = np.arange(len(b)) + np.searchsorted(a, b, side="right")
+    values = np.empty(len(a) + len(b), dtype=a.dtype)
+    positions = np.empty(len(a) + len(b), dtype=a_positions.dtype)
+    values[a_rows] = a
+    values[b_rows] = b
+    positions[a_rows] = a_positions
+    positions[b_rows] = b_positions
+    return (values, positions)
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,277 @@
+import pandas as pd
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import signal
+from tqdm import tqdm
+import pickle
+import click
+import os
+
+import instrumentation
+from signal_grid import read_grid_manifest, load_participant_grid, grid_time
+from metadata import save_metadata
+
+# prefixes of the rolling features of each raw data column (as in
+# rolling_features.py)
+MEASUREMENTS = {"Steps": "Steps", "Value": "HR"}
+# number of window rows per chunk when calculating order statistics
+CHUNK_ROWS = 2 ** 16
+
+
+@click.command()
+@click.option(
+    "--grid_dir", help="Path to the directory of the grid saved by signal_grid.py."
+)
+@click.option(
+    "--window_size",
+    default="10min",
+    help="Window size of the rolling window features. This must use pandas's 'offset alias' syntax and be a multiple of the grid period.",
+)
+@click.option(
+    "--window_size_in_minutes",
+    default=10,
+    type=int,
+    help="Window size of the spectrogram features in minutes.",
+)
+@click.option(
+    "--overlap/--no-overlap",
+    help="Flag for whether or not to overlap consecutive spectrogram windows (by all but one cell).",
+)
+@click.option(
+    "--max_gap",
+    default="1D",
+    help="Gaps in a measurement longer than this split the spectrogram into separate segments (like ``time_delta_threshold`` in spectrogram_features.py). Shorter gaps are linearly interpolated.",
+)
+@click.option(
+    "--save_dir",
+    help="Path to the directory for saving the features (as four separate pickle files).",
+)
+@click.option(
+    "--report_path",
+    default=None,
+    help="Optional path for saving a json report with the wall time, CPU time, peak memory and row counts of each step.",
+)
+def main(
+    grid_dir,
+    window_size,
+    window_size_in_minutes,
+    overlap,
+    max_gap,
+    save_dir,
+    report_path,
+):
+    """Create rolling window and spectrogram features on the shared grid
+
+    This is the grid-based counterpart of rolling_features.py and
+    spectrogram_features.py. All features are calculated with NumPy on
+    the fixed-rate grid of signal_grid.py, so the spectrograms don't
+    need to assume a constant sampling rate and every feature row is a
+    grid cell:
+
+    \b
+    - rolling features: at every cell where the measurement was
+      observed, over the observed cells of the trailing window
+    - spectrogram features: at the last cell of every window
+
+    The features of all files share the same (Id, Time) grid index, so
+    merging.py joins them by index alignment instead of
+    pandas.merge_asof. The file names follow those of the other feature
+    scripts with "grid" in place of "rolling"/"spectrogram", e.g.
+    "hr_grid_rolling_features_df_window=10min.pickle".
+    """
+    manifest = read_grid_manifest(grid_dir)
+    period = pd.Timedelta(manifest["period"])
+    window_cells = _num_cells(pd.Timedelta(window_size), period)
+    spectrogram_cells = _num_cells(pd.Timedelta(minutes=window_size_in_minutes), period)
+    max_gap_cells = int(pd.Timedelta(max_gap) / period)
+
+    features = {
+        (col, kind): dict() for col in MEASUREMENTS for kind in ["rolling", "spectrogram"]
+    }
+    print("Creating steps and HR grid features for each participant.")
+    for participant_id in tqdm(manifest["participants"]):
+        grid = load_participant_grid(grid_dir, participant_id, manifest)
+        time = grid_time(grid)
+        for col, measurement in MEASUREMENTS.items():
+            with instrumentation.span(
+                "grid_features", participant=participant_id, measurement=measurement
+            ) as span:
+                features[(col, "rolling")][participant_id] = get_grid_rolling_features(
+                    grid[col], grid[f"{col}_mask"], time, measurement, window_cells
+                )
+                features[(col, "spectrogram")][
+                    participant_id
+                ] = get_grid_spectrogram_features(
+                    grid[col],
+                    grid[f"{col}_mask"],
+                    time,
+                    col,
+                    period,
+                    spectrogram_cells,
+                    spectrogram_cells - 1 if overlap else 0,
+                    max_gap_cells,
+                )
+                span["rows"] = len(features[(col, "rolling")][participant_id])
+
+    suffixes = {
+        "rolling": f"window={window_size}",
+        "spectrogram": f"window={window_size_in_minutes}min_overlap={overlap}",
+    }
+    for (col, kind), features_dict in features.items():
+        features_df = pd.concat(features_dict).rename_axis(["Id", "Time"])
+        # lets merging.py recognize features on the same grid
+        features_df.attrs["grid_period"] = manifest["period"]
+        name = "steps" if col == "Steps" else "hr"
+        save_path = os.path.join(
+            save_dir, f"{name}_grid_{kind}_features_df_{suffixes[kind]}.pickle"
+        )
+        with open(save_path, "wb") as f:
+            pickle.dump(features_df, f)
+        save_metadata(features_df, save_path)
+        print(f"Saved {name} grid {kind} features to {save_path}.")
+
+    instrumentation.write_report(report_path)
+
+
+def _num_cells(duration, period):
+    num_cells = duration / period
+    if num_cells != int(num_cells) or num_cells < 1:
+        raise ValueError(
+            f"The window size {duration} is not a multiple of the grid period {period}."
+        )
+    return int(num_cells)
+
+
+def get_grid_rolling_features(values, mask, time, measurement, window_cells):
+    """Calculate rolling window features on the grid
+
+    The window of a cell consists of the cell and the ``window_cells -
+    1`` preceding cells (like a time-based pandas rolling window), and
+    only the observed (masked) cells of the window are used.
+
+    :param values: numpy array of the grid values of one measurement
+    :param mask: boolean numpy array, True where the measurement was
+        observed
+    :param time: numpy datetime64 array of the cell timestamps
+    :param measurement: prefix for the feature column names, e.g.
+        "Steps" or "HR"
+    :param window_cells: number of cells in the window
+    :returns: pandas dataframe indexed by the time of the observed cells,
+        with the raw values and the columns ``<measurement>_mean``,
+        ``_std``, ``_min``, ``_max``, ``_median``, ``_quant25`` and
+        ``_quant75`` (as in rolling_features.py)
+    """
+    rows = np.flatnonzero(mask)
+    col = "Steps" if measurement == "Steps" else "Value"
+    features = {col: values[rows]}
+
+    # mean and standard deviation from running sums over the window
+    x = np.where(mask, values, 0.0)
+    cumsum = np.r_[0, np.cumsum(x)]
+    cumsum_sq = np.r_[0, np.cumsum(x ** 2)]
+    cumcount = np.r_[0, np.cumsum(mask)]
+    window_start = np.maximum(rows + 1 - window_cells, 0)
+    count = cumcount[rows + 1] - cumcount[window_start]
+    total = cumsum[rows + 1] - cumsum[window_start]
+    total_sq = cumsum_sq[rows + 1] - cumsum_sq[window_start]
+    features[f"{measurement}_mean"] = total / count
+    with np.errstate(invalid="ignore", divide="ignore"):
+        variance = (total_sq - total ** 2 / count) / (count - 1)
+    features[f"{measurement}_std"] = np.sqrt(np.clip(variance, 0, None))
+
+    # order statistics over (chunks of) the windows of the observed cells
+    order_statistics = {
+        "min": lambda w: np.nanmin(w, axis=1),
+        "max": lambda w: np.nanmax(w, axis=1),
+        "median": lambda w: np.nanmedian(w, axis=1),
+        "quant25": lambda w: np.nanpercentile(w, 25, axis=1),
+        "quant75": lambda w: np.nanpercentile(w, 75, axis=1),
+    }
+    for name in order_statistics:
+        features[f"{measurement}_{name}"] = np.empty(len(rows))
+    padded = np.r_[np.full(window_cells - 1, np.nan), values]
+    windows = sliding_window_view(padded, window_cells)
+    for start in range(0, len(rows), CHUNK_ROWS):
+        chunk_rows = rows[start : start + CHUNK_ROWS]
+        chunk = windows[chunk_rows]
+        for name, statistic in order_statistics.items():
+            features[f"{measurement}_{name}"][
+                start : start + len(chunk_rows)
+            ] = statistic(chunk)
+
+    return pd.DataFrame(features, index=pd.DatetimeIndex(time[rows], name="Time"))
+
+
+def get_grid_spectrogram_features(
+    values,
+    mask,
+    time,
+    col,
+    period,
+    window_cells,
+    overlap_cells,
+    max_gap_cells,
+):
+    """Calculate spectrogram features on the grid
+
+    The grid is split into segments at gaps (runs of unobserved cells)
+    longer than ``max_gap_cells``, shorter gaps are linearly
+    interpolated, and segments with fewer cells than one window are
+    discarded. Each window is assigned to its last cell.
+
+    :param values: numpy array of the grid values of one measurement
+    :param mask: boolean numpy array, True where the measurement was
+        observed
+    :param time: numpy datetime64 array of the cell timestamps
+    :param col: name of the raw data column, used as the prefix of the
+        feature column names (as in spectrogram_features.py)
+    :param period: pandas.Timedelta between consecutive cells
+    :param window_cells: number of cells per window (``nperseg`` in
+        scipy.signal.spectrogram)
+    :param overlap_cells: number of overlapping cells between
+        consecutive windows (``noverlap``)
+    :param max_gap_cells: maximum number of consecutive unobserved cells
+        within a segment
+    :returns: pandas dataframe indexed by time, with one column per
+        frequency band
+    """
+    observed = np.flatnonzero(mask)
+    fs = 1 / period.total_seconds()
+    step = window_cells - overlap_cells
+    columns = None
+    features_list = []
+
+    # segments of observed cells separated by gaps longer than max_gap_cells
+    breaks = np.flatnonzero(np.diff(observed) > max_gap_cells + 1) + 1
+    for segment in np.split(observed, breaks):
+        if len(segment) == 0:
+            continue
+        first, last = segment[0], segment[-1] + 1
+        if last - first < window_cells:
+            continue
+        segment_values = np.interp(
+            np.arange(first, last), segment, values[segment]
+        )
+        f, _, Sxx = signal.spectrogram(
+            segment_values,
+            fs=fs,
+            nperseg=window_cells,
+            noverlap=overlap_cells,
+            mode="magnitude",
+        )
+        window_ends = first + window_cells - 1 + step * np.arange(Sxx.shape[1])
+        if columns is None:
+            columns = [f"{col}_spectrogram_" + str(np.round(x, 5)) + "Hz" for x in f]
+        features_list.append(
+            pd.DataFrame(
+                Sxx.T, index=pd.DatetimeIndex(time[window_ends], name="Time"), columns=columns
+            )
+        )
+
+    if not features_list:
+        return pd.DataFrame(index=pd.DatetimeIndex([], name="Time"))
+    return pd.concat(features_list)
+
+
+if __name__ == "__main__":
+    main()
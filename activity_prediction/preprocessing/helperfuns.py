@@ -2,6 +2,8 @@ import pandas as pd
 import numpy as np
 import pickle
 import random
+import json
+import os
 
 import matplotlib
 import matplotlib.pyplot as plt
@@ -10,6 +12,13 @@ import plotly.graph_objects as go
 import plotly.express as px
 import seaborn as sns
 
+try:  # imported as part of the preprocessing package
+    from . import instrumentation
+    from .metadata import get_file_signature, read_metadata, verify_metadata
+except ImportError:  # imported from within the preprocessing directory
+    import instrumentation
+    from metadata import get_file_signature, read_metadata, verify_metadata
+
 sns.set_palette("colorblind")
 plt.rcParams["font.family"] = "Times New Roman"
 plt.rcParams["font.size"] = 14
@@ -18,14 +27,36 @@ matplotlib.rcParams['axes.axisbelow'] = True
 plt.rcParams['svg.fonttype'] = 'none'
 
 
+@instrumentation.timed(
+    "load_data", rows=lambda dfs: sum(len(df) for df in dfs if df is not None)
+)
 def load_data(
-    steps_path, hr_path, validate_ids=True, sample_num=None, subset_ids=None, sort=True
+    steps_path,
+    hr_path,
+    validate_ids=True,
+    sample_num=None,
+    subset_ids=None,
+    sort=True,
+    strict=False,
 ):
     """Load steps and HR data from pickle files
 
+    If the data were also saved as per-participant partitions (see
+    ``save_partitions``), only the partitions of the requested
+    participants are read, and the data are not sorted again if the
+    partitions are known to be sorted.
+
+    Likewise, if the metadata of the pickle files were saved (see
+    ``metadata.save_metadata``), the participant IDs are validated with
+    the metadata instead of the (full) indices, and the data are not
+    sorted again if the metadata say that they are sorted.
+
     :param steps_path: path to the pickle file containing a pandas
         dataframe of steps data with "Id" as the first index and
-        "ActivityMinute" as the second (datetime) index.
+        "ActivityMinute" as the second (datetime) index, or None for
+        only loading the HR data (e.g. if the steps are read from their
+        runs instead, see step_runs.py). In that case, ``steps_df`` is
+        None and ``validate_ids`` is ignored.
     :param hr_path: path to the pickle file containing a pandas
         dataframe of HR data with "Id" as the first index and "Time" as
         the second (datetime) index.
@@ -43,82 +74,388 @@ def load_data(
         in the first "Id" index of these dataframes. Defaults to None,
         which will not perform any subsetting. ``sample_num`` takes
         precedence over this parameter.
+    :param strict: boolean that indicates whether to verify the saved
+        metadata and partition manifests against the loaded data
+        instead of trusting them (see ``metadata.verify_metadata``),
+        defaults to False.
     :returns: a tuple of two pandas dataframes: (steps_df, hr_df).
     """
 
-    with open(steps_path, "rb") as f:
-        steps_df = pickle.load(f)
+    # if the data were also saved as per-participant partitions (see
+    # ``save_partitions``), read only the partitions that are needed
+    load_steps = steps_path is not None
+    steps_manifest = read_manifest(steps_path) if load_steps else None
+    hr_manifest = read_manifest(hr_path)
+    lazy = hr_manifest is not None and (steps_manifest is not None or not load_steps)
+
+    # the participants, sortedness etc. of the data (see metadata.py)
+    steps_metadata = read_metadata(steps_path) if load_steps else None
+    hr_metadata = read_metadata(hr_path)
+    if lazy:
+        # the (sorted) partitions are read instead of the pickle files
+        if load_steps:
+            steps_metadata = dict(
+                steps_metadata or steps_manifest, sorted=steps_manifest["sorted"]
+            )
+        hr_metadata = dict(hr_metadata or hr_manifest, sorted=hr_manifest["sorted"])
+    known = hr_metadata is not None and (steps_metadata is not None or not load_steps)
+
+    steps_df = None
+    if not lazy:
+        if load_steps:
+            with open(steps_path, "rb") as f:
+                steps_df = pickle.load(f)
 
-    with open(hr_path, "rb") as f:
-        hr_df = pickle.load(f)
+        with open(hr_path, "rb") as f:
+            hr_df = pickle.load(f)
 
-    id_set = set(steps_df.index.get_level_values(0).unique())
-    if validate_ids:
+    if known:
+        id_set = set((steps_metadata if load_steps else hr_metadata)["participants"])
+    else:
+        id_set = set(
+            (steps_df if load_steps else hr_df).index.get_level_values(0).unique()
+        )
+
+    if validate_ids and load_steps:
         print(
             "Validating that the steps and HR data have the same set of participant IDs."
         )
         # check that the HR and steps data have the same set of participant IDs
-        assert id_set == set(hr_df.index.get_level_values(0).unique())
+        if known:
+            assert id_set == set(hr_metadata["participants"])
+        else:
+            assert id_set == set(hr_df.index.get_level_values(0).unique())
+
+    presorted = (
+        known
+        and hr_metadata["sorted"]
+        and (not load_steps or steps_metadata["sorted"])
+    )
 
+    ids = None
     if sample_num:
         print(f"Subsetting the steps and HR data to {sample_num} sample participants.")
-        sample_ids = random.sample(id_set, sample_num)
-        steps_df = steps_df.loc[sample_ids]
-        hr_df = hr_df.loc[sample_ids]
+        ids = random.sample(sorted(id_set), sample_num)
     elif subset_ids:
         print(
             f"Subsetting the steps and HR data to the participants specified in ``subset_ids``."
         )
-        steps_df = steps_df.loc[subset_ids]
-        hr_df = hr_df.loc[subset_ids]
-
-    if sort:
+        ids = list(subset_ids)
+    if ids is not None and presorted:
+        # keep sorted data sorted
+        ids = sorted(ids)
+
+    if lazy:
+        if load_steps:
+            steps_df = load_partitions(steps_path, ids)
+        hr_df = load_partitions(hr_path, ids)
+
+    if strict and known:
+        print("Verifying the metadata of the steps and HR data.")
+        if load_steps:
+            verify_metadata(steps_df, steps_metadata, steps_path)
+        verify_metadata(hr_df, hr_metadata, hr_path)
+
+    if not lazy and ids is not None:
+        if load_steps:
+            steps_df = steps_df.loc[ids]
+        hr_df = hr_df.loc[ids]
+
+    if sort and presorted:
+        print("The steps and HR data are already sorted, skipping sorting.")
+    elif sort:
         print("Sorting steps and HR data by participant ID and then timestamp.")
-        steps_df.sort_index(level=["Id", "ActivityMinute"], inplace=True)
+        if load_steps:
+            steps_df.sort_index(level=["Id", "ActivityMinute"], inplace=True)
         hr_df.sort_index(level=["Id", "Time"], inplace=True)
 
     return (steps_df, hr_df)
 
 
-def remove_zero_daily_steps(steps_df):
+def get_partition_dir(path):
+    """Directory of the per-participant partitions of a pickled dataframe
+
+    :param path: path to the pickle file, e.g.
+        "clean_data/hr_seconds_df.pickle"
+    :returns: path to the partition directory, e.g.
+        "clean_data/hr_seconds_df_partitions"
+    """
+    return os.path.splitext(path)[0] + "_partitions"
+
+
+def save_partitions(df, path, presorted=False):
+    """Save a dataframe as one pickle file per participant
+
+    The partitions are saved in the directory returned by
+    ``get_partition_dir(path)``, together with a "manifest.json" file
+    that lists the participants and their partition files. Each
+    partition is sorted by timestamp and the partitions are listed in
+    the order of the participant IDs, so the concatenated partitions
+    are sorted by participant ID and then timestamp (recorded as
+    ``"sorted": true`` in the manifest). The manifest also records the
+    size and modification time of the pickle file at ``path`` (which
+    must already be saved), so that ``read_manifest`` ignores the
+    partitions once the pickle file is replaced.
+
+    :param df: pandas dataframe with "Id" as the first index and a
+        datetime second index
+    :param path: path to the (unpartitioned) pickle file of ``df``
+    :param presorted: whether ``df`` is known to be sorted by
+        participant ID and then timestamp (e.g. by cleaning.clean), in
+        which case the partitions are sliced from ``df`` without sorting.
+        Defaults to False.
+    """
+    partition_dir = get_partition_dir(path)
+    os.makedirs(partition_dir, exist_ok=True)
+
+    if presorted:
+        ids = df.index.get_level_values(0)
+        bounds = np.r_[0, np.flatnonzero(ids[1:] != ids[:-1]) + 1, len(df)]
+        partitions = (
+            (ids[start], df.iloc[start:end])
+            for start, end in zip(bounds[:-1], bounds[1:])
+            if end > start
+        )
+    else:
+        partitions = (
+            (participant_id, participant_df.sort_index())
+            for participant_id, participant_df in df.groupby(level=0, sort=True)
+        )
+
+    files = dict()
+    for participant_id, participant_df in partitions:
+        files[participant_id] = f"{participant_id}.pickle"
+        with open(os.path.join(partition_dir, files[participant_id]), "wb") as f:
+            pickle.dump(participant_df, f)
+
+    manifest = {
+        "participants": list(files.keys()),
+        "files": files,
+        "index_names": list(df.index.names),
+        "sorted": True,
+        "file": get_file_signature(path),
+    }
+    with open(os.path.join(partition_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def read_manifest(path):
+    """Read the partition manifest of a pickled dataframe
+
+    :param path: path to the (unpartitioned) pickle file
+    :returns: the manifest dict (see ``save_partitions``), or None if
+        the dataframe wasn't saved as partitions or if the pickle file
+        changed after the partitions were saved (e.g. it was replaced by
+        a cached copy or by ``sharding.py reduce``)
+    """
+    manifest_path = os.path.join(get_partition_dir(path), "manifest.json")
+    if not (os.path.exists(manifest_path) and os.path.exists(path)):
+        return None
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+
+    if manifest.get("file") != get_file_signature(path):
+        print(f"Ignoring the stale partitions of {path}.")
+        return None
+    return manifest
+
+
+def load_partitions(path, ids=None):
+    """Load the partitions of some or all participants
+
+    :param path: path to the (unpartitioned) pickle file
+    :param ids: list of participant IDs to load. Defaults to None, which
+        loads all participants.
+    :returns: pandas dataframe with the rows of the requested
+        participants, in the order of the manifest (i.e. sorted by
+        participant ID)
+    """
+    manifest = read_manifest(path)
+    partition_dir = get_partition_dir(path)
+
+    if ids is None:
+        ids = manifest["participants"]
+    else:
+        missing = set(ids) - set(manifest["participants"])
+        assert not missing, f"Unknown participant IDs: {missing}"
+        id_set = set(ids)
+        ids = [i for i in manifest["participants"] if i in id_set]
+
+    dfs = []
+    for participant_id in ids:
+        file_path = os.path.join(partition_dir, manifest["files"][participant_id])
+        with open(file_path, "rb") as f:
+            dfs.append(pickle.load(f))
+
+    return pd.concat(dfs)
+
+
+def get_daily_step_totals(steps_df):
+    """Calculate the total number of steps per participant and day
+
+    :param steps_df: pandas dataframe containing a "Steps" (step count)
+        column. The first index must be "Id" (participant ID) and the
+        second index must be "ActivityMinute" (minute grain timestamps).
+    :returns: pandas series of daily step totals indexed by "Id" and
+        "date" (datetime64 days)
+    """
+    id_codes, id_uniques, day_codes, day_min, num_days = _participant_day_codes(
+        steps_df
+    )
+    keys = id_codes * num_days + day_codes
+    totals = np.bincount(keys, weights=steps_df["Steps"].values)
+    observed = np.flatnonzero(np.bincount(keys))
+
+    return pd.Series(
+        totals[observed],
+        index=pd.MultiIndex.from_arrays(
+            [
+                id_uniques[observed // num_days],
+                (day_min + observed % num_days).astype("datetime64[D]"),
+            ],
+            names=["Id", "date"],
+        ),
+        name="Steps",
+    )
+
+
+def get_daily_totals_path(steps_path):
+    """Path of the daily step totals saved next to the cleaned steps data
+
+    :param steps_path: path to the pickle file of the cleaned steps data
+    :returns: path to the pickle file of the daily step totals (see
+        ``get_daily_step_totals``)
+    """
+    return os.path.splitext(steps_path)[0] + "_daily_totals.pickle"
+
+
+def save_daily_step_totals(daily_totals, steps_path):
+    """Save the daily step totals next to the cleaned steps data
+
+    The size and modification time of the steps pickle file (which must
+    already be saved) are saved with the totals, so that
+    ``load_daily_step_totals`` ignores the totals once the steps data
+    are replaced.
+
+    :param daily_totals: pandas series (see ``get_daily_step_totals``)
+    :param steps_path: path to the pickle file of the cleaned steps data
+    """
+    with open(get_daily_totals_path(steps_path), "wb") as f:
+        pickle.dump({"file": get_file_signature(steps_path), "totals": daily_totals}, f)
+
+
+def load_daily_step_totals(steps_path):
+    """Load the daily step totals saved next to the cleaned steps data
+
+    :param steps_path: path to the pickle file of the cleaned steps data
+    :returns: pandas series (see ``get_daily_step_totals``), or None if
+        the daily step totals weren't saved or if the steps data changed
+        after they were saved
+    """
+    daily_totals_path = get_daily_totals_path(steps_path)
+    if not (os.path.exists(daily_totals_path) and os.path.exists(steps_path)):
+        return None
+    with open(daily_totals_path, "rb") as f:
+        saved = pickle.load(f)
+
+    if not isinstance(saved, dict) or saved["file"] != get_file_signature(steps_path):
+        print(f"Ignoring the stale daily step totals of {steps_path}.")
+        return None
+    return saved["totals"]
+
+
+@instrumentation.timed("remove_zero_daily_steps", rows=len)
+def remove_zero_daily_steps(steps_df, daily_totals=None):
     """Remove all step data on a day if the total number of steps is
     zero on that day
 
-    :steps_df: pandas dataframe containing a "Steps" (step count)
+    The participant-days are encoded as integers (participant code times
+    number of days plus day number, derived from the datetime64 values),
+    so the mask is built in a single vectorized pass and the input is
+    copied only once.
+
+    :param steps_df: pandas dataframe containing a "Steps" (step count)
         column. The first index must be "Id" (participant ID) and the
         second index must be "ActivityMinute" (minute grain timestamps).
+    :param daily_totals: optional pandas series of precomputed daily step
+        totals (see ``get_daily_step_totals`` and
+        ``load_daily_step_totals``) that covers (at least) the
+        participants in ``steps_df``. Defaults to None, which calculates
+        the daily totals from ``steps_df``.
     :returns: pandas dataframe with rows removed
     """
     print(
         "Removing all step data on a day if the total number of steps is zero on that day."
     )
 
-    # get date from the datetime index
-    steps_df["date"] = steps_df.index.get_level_values(1).date
+    id_codes, id_uniques, day_codes, day_min, num_days = _participant_day_codes(
+        steps_df
+    )
+    keys = id_codes * num_days + day_codes
 
-    # re-index on participant ID and date (not datetime)
-    steps_df.reset_index(inplace=True)
-    steps_df.set_index(["Id", "date"], inplace=True)
+    if daily_totals is None:
+        totals = np.bincount(keys, weights=steps_df["Steps"].values)
+        mask = totals[keys] > 0
+    else:
+        # encode the participant-days with positive totals the same way
+        positive = daily_totals[daily_totals > 0].index
+        positive_id_codes = id_uniques.get_indexer(positive.get_level_values(0))
+        positive_days = (
+            positive.get_level_values(1).values.astype("datetime64[D]").astype(np.int64)
+            - day_min
+        )
+        in_range = (
+            (positive_id_codes >= 0) & (positive_days >= 0) & (positive_days < num_days)
+        )
+        positive_keys = (
+            positive_id_codes[in_range] * num_days + positive_days[in_range]
+        )
+        mask = np.isin(keys, positive_keys)
 
-    # create an indexing mask to retain only days when the daily total number of steps is above zero
-    daily_steps = steps_df.groupby(["Id", "date"]).Steps.sum()
-    mask = daily_steps[daily_steps > 0].index
-    steps_df = steps_df.loc[mask]
+    return steps_df[mask]
 
-    # re-index back to the original index (Id, ActivityMinute)
-    steps_df.reset_index(inplace=True)
-    steps_df.set_index(["Id", "ActivityMinute"], inplace=True)
 
-    # drop the date column
-    steps_df.drop("date", axis=1, inplace=True)
+def _participant_day_codes(steps_df):
+    """Integer codes of the participants and days of each row
 
-    return steps_df
+    :returns: a tuple ``(id_codes, id_uniques, day_codes, day_min,
+        num_days)``, where ``day_codes`` count the days since ``day_min``
+        (days since the epoch) and ``num_days`` is the number of days
+        between the first and last day
+    """
+    id_codes, id_uniques = pd.factorize(steps_df.index.get_level_values(0))
+    days = steps_df.index.get_level_values(1).values.astype("datetime64[D]").astype(
+        np.int64
+    )
+    if len(days) == 0:
+        return (id_codes, id_uniques, days, 0, 1)
+    day_min = days.min()
+    return (id_codes, id_uniques, days - day_min, day_min, days.max() - day_min + 1)
 
 
 # PLOTTING
-def plot_spectrogram(spectrogram, interactive=False, save_path=None):
+def plot_spectrogram(
+    spectrogram, interactive=False, save_path=None, max_time_bins=2000
+):
+    """Plot a spectrogram as an image
+
+    The spectrogram is drawn as one raster image (``imshow``) rather
+    than one artist per cell, so the cost of the plot is roughly
+    constant for recordings of any length.
+
+    :param spectrogram: tuple (frequencies, times, Sxx) as returned by
+        scipy.signal.spectrogram
+    :param interactive: whether to plot with plotly instead of
+        matplotlib, defaults to False
+    :param save_path: optional path for saving the (non-interactive)
+        plot
+    :param max_time_bins: maximum number of time bins to draw. Longer
+        spectrograms are aggregated by averaging consecutive time bins.
+        Defaults to 2000. None draws every time bin.
+    """
 
     (f, t, Sxx) = spectrogram
+    (t, Sxx) = aggregate_time_bins(t, Sxx, max_time_bins)
 
     x_label = "Time (Seconds Elapsed)"
     y_label = "Frequency Band (Hz)"
@@ -130,11 +467,27 @@ def plot_spectrogram(spectrogram, interactive=False, save_path=None):
         )
         fig.show()
     else:
-        # reshape
-        spectrogram_df = pd.DataFrame(Sxx, index=np.round(f, 5), columns=t.astype(int))
-        spectrogram_df.sort_index(ascending=False, inplace=True)
-        ax = sns.heatmap(spectrogram_df, xticklabels = 300, cmap="Blues")
+        # each row/column of the image spans half a bin on either side
+        # of its frequency/time
+        f_step = f[1] - f[0] if len(f) > 1 else 1
+        t_step = t[1] - t[0] if len(t) > 1 else 1
+        ax = plt.gca()
+        image = ax.imshow(
+            Sxx,
+            origin="lower",
+            aspect="auto",
+            interpolation="nearest",
+            cmap="Blues",
+            extent=(
+                t[0] - t_step / 2,
+                t[-1] + t_step / 2,
+                f[0] - f_step / 2,
+                f[-1] + f_step / 2,
+            ),
+        )
+        plt.colorbar(image, ax=ax)
         ax.set(ylabel=y_label, xlabel=x_label)
+        ax.ticklabel_format(axis="x", style="plain", useOffset=False)
 
         if save_path:
             plt.savefig(save_path, dpi=600, transparent=True)
@@ -142,6 +495,27 @@ def plot_spectrogram(spectrogram, interactive=False, save_path=None):
         return ax
 
 
+def aggregate_time_bins(t, Sxx, max_time_bins):
+    """Average consecutive time bins of a spectrogram
+
+    :param t: array of the times of the time bins
+    :param Sxx: 2D array (frequencies x times) of the spectrogram
+    :param max_time_bins: maximum number of time bins to keep, or None
+    :returns: a tuple (t, Sxx) with at most ``max_time_bins`` time bins.
+        The times are the mean times of the aggregated bins.
+    """
+    if max_time_bins is None or len(t) <= max_time_bins:
+        return (t, Sxx)
+
+    bin_size = int(np.ceil(len(t) / max_time_bins))
+    starts = np.arange(0, len(t), bin_size)
+    counts = np.diff(np.r_[starts, len(t)])
+    t = np.add.reduceat(t, starts) / counts
+    Sxx = np.add.reduceat(Sxx, starts, axis=1) / counts
+
+    return (t, Sxx)
+
+
 def plot_participant(
     df,
     participant_id,
@@ -155,34 +529,78 @@ def plot_participant(
     end_time=None,
     plot_other=False,
     save_path=None,
+    downsample="minmax",
+    num_buckets=None,
 ):
+    """Plot the data of one participant with the labeled gym sessions
+
+    Long series are downsampled to the plotted time range before they
+    are drawn (see ``downsample_index``), so the cost of the plot depends
+    on its width in pixels rather than on the number of samples. Zoom in
+    with ``start_time`` and ``end_time`` to see every sample of a short
+    time range.
+
+    :param downsample: "minmax" (keep the minimum and maximum of each
+        bucket, which preserves peaks), "lttb" (largest triangle three
+        buckets) or None (plot every sample), defaults to "minmax"
+    :param num_buckets: number of buckets (about one per pixel) of the
+        downsampling. Defaults to None, which uses the width of the
+        figure in pixels (matplotlib) or 1500 (plotly).
+    """
 
     participant_df = df.loc[participant_id]
-    participant_labels = labels_df.loc[participant_id]
+    if labels_df is not None:
+        participant_labels = labels_df.loc[participant_id]
 
     if start_time and end_time:
         participant_df = participant_df.loc[start_time:end_time]
-        participant_labels = participant_labels.loc[start_time:end_time]
+        if labels_df is not None:
+            participant_labels = participant_labels.loc[start_time:end_time]
+
+    if num_buckets is None:
+        if interactive:
+            num_buckets = 1500
+        else:
+            width, _ = plt.rcParams["figure.figsize"]
+            num_buckets = int(width * plt.rcParams["figure.dpi"])
+    if downsample is not None:
+        participant_df = participant_df.iloc[
+            downsample_index(participant_df, num_buckets, method=downsample)
+        ]
+
+    # label spans as arrays of start and end times
+    spans = []
+    if labels_df is not None:
+        label_times = participant_labels.index.values
+        spans.append(
+            (
+                label_times + label_offset.to_timedelta64(),
+                label_times + (label_offset + label_duration).to_timedelta64(),
+                "red",
+            )
+        )
+        if plot_other:
+            spans.append(
+                (label_times - label_duration.to_timedelta64(), label_times, "blue")
+            )
 
     if not interactive:
         pd.options.plotting.backend = "matplotlib"
 
-        ax = participant_df.plot()
+        # x_compat: use matplotlib dates (not periods) for the x-axis
+        ax = participant_df.plot(x_compat=True)
         ax.set(ylabel=y_name, xlabel=x_name)
 
-        if not (labels_df is None):
-            for index, row in participant_labels.iterrows():
-                ax.axvspan(
-                    index + label_offset,
-                    index + label_offset + label_duration,
-                    color="tab:red",
-                    alpha=0.3,
-                )
-
-                if plot_other:
-                    ax.axvspan(
-                        index - label_duration, index, color="tab:blue", alpha=0.3,
-                    )
+        # draw all spans of a color as one collection
+        for starts, ends, color in spans:
+            x0 = mdates.date2num(starts)
+            ax.broken_barh(
+                list(zip(x0, mdates.date2num(ends) - x0)),
+                (0, 1),
+                transform=ax.get_xaxis_transform(),
+                color="tab:" + color,
+                alpha=0.3,
+            )
 
         if start_time and end_time:
             ax.xaxis.set_major_locator(mdates.HourLocator())
@@ -199,47 +617,127 @@ def plot_participant(
         prev_plotting_backend = pd.options.plotting.backend
         pd.options.plotting.backend = "plotly"
         fig = participant_df.plot()
-        shapes = []
-        if not (labels_df is None):
-            for index, row in participant_labels.iterrows():
-                shape = dict(
-                    type="rect",
-                    # x-reference is assigned to the x-values
-                    xref="x",
-                    # y-reference is assigned to the plot paper [0,1]
-                    yref="paper",
-                    x0=index + label_offset,
-                    y0=0,
-                    x1=index + label_offset + label_duration,
-                    y1=1,
-                    fillcolor="red",
+
+        # draw all spans of a color as one filled trace (rectangles
+        # separated by gaps) on a hidden y-axis from 0 to 1, which renders
+        # much faster than one layout shape per span
+        for starts, ends, color in spans:
+            x = np.full((len(starts), 5), np.datetime64("NaT"), dtype=starts.dtype)
+            x[:, 0] = x[:, 1] = starts
+            x[:, 2] = x[:, 3] = ends
+            y = np.tile([0.0, 1.0, 1.0, 0.0, np.nan], len(starts))
+            fig.add_trace(
+                go.Scatter(
+                    x=x.ravel(),
+                    y=y,
+                    yaxis="y2",
+                    fill="toself",
+                    fillcolor=color,
                     opacity=0.3,
-                    layer="below",
                     line_width=0,
+                    mode="lines",
+                    hoverinfo="skip",
+                    showlegend=False,
                 )
-                shapes.append(shape)
-                
-                if plot_other:
-                    shape = dict(
-                        type="rect",
-                        # x-reference is assigned to the x-values
-                        xref="x",
-                        # y-reference is assigned to the plot paper [0,1]
-                        yref="paper",
-                        x0=index - label_duration,
-                        y0=0,
-                        x1=index,
-                        y1=1,
-                        fillcolor="blue",
-                        opacity=0.3,
-                        layer="below",
-                        line_width=0,
-                    )
-                    shapes.append(shape)
-
-            fig.update_layout(
-                shapes=shapes, xaxis_title=x_name, yaxis_title=y_name
             )
+        fig.update_layout(
+            xaxis_title=x_name,
+            yaxis_title=y_name,
+            yaxis2=dict(overlaying="y", range=[0, 1], visible=False),
+        )
 
         fig.show()
         pd.options.plotting.backend = prev_plotting_backend
+
+
+def downsample_index(df, num_buckets, method="minmax"):
+    """Positions of the rows to keep for plotting a long series
+
+    The rows are split into ``num_buckets`` buckets of equal time span.
+    Series with at most two rows per bucket are not downsampled.
+
+    :param df: pandas dataframe or series with a datetime index (sorted)
+    :param num_buckets: number of buckets, e.g. the width of the plot in
+        pixels
+    :param method: "minmax" keeps the first, last, minimum and maximum
+        row of each bucket (of every column), so peaks and the visual
+        envelope of the series are preserved. "lttb" (largest triangle
+        three buckets) keeps one row per bucket (based on the first
+        column), which preserves the shape of the series with fewer
+        points.
+    :returns: sorted numpy array of row positions
+    """
+    n = len(df)
+    if n <= 2 * num_buckets:
+        return np.arange(n)
+
+    values = np.asarray(df, dtype=float).reshape(n, -1)
+    time = df.index.values.astype("datetime64[ns]").astype(np.int64)
+    buckets = np.minimum(
+        ((time - time[0]) / max(time[-1] - time[0], 1) * num_buckets).astype(np.int64),
+        num_buckets - 1,
+    )
+    bucket_starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+
+    if method == "minmax":
+        keep = [bucket_starts, np.r_[bucket_starts[1:] - 1, n - 1]]
+        for column in values.T:
+            # nan can't be a minimum or maximum
+            column_min = np.where(np.isnan(column), np.inf, column)
+            column_max = np.where(np.isnan(column), -np.inf, column)
+            for reduce, column_values in [
+                (np.minimum, column_min),
+                (np.maximum, column_max),
+            ]:
+                extreme = reduce.reduceat(column_values, bucket_starts)
+                is_extreme = column_values == np.repeat(
+                    extreme, np.diff(np.r_[bucket_starts, n])
+                )
+                # first extreme position in each bucket
+                positions = np.flatnonzero(is_extreme)
+                keep.append(
+                    positions[
+                        np.searchsorted(positions, bucket_starts).clip(
+                            max=len(positions) - 1
+                        )
+                    ]
+                )
+        return np.unique(np.concatenate(keep))
+    elif method == "lttb":
+        return _lttb(time.astype(float), values[:, 0], bucket_starts)
+    else:
+        raise ValueError(f"Unknown downsampling method: {method}")
+
+
+def _lttb(x, y, bucket_starts):
+    """Largest triangle three buckets: keep the first and last point and
+    the point of every bucket that forms the largest triangle with the
+    kept point of the previous bucket and the mean of the next bucket"""
+    bucket_ends = np.r_[bucket_starts[1:], len(x)]
+    y = np.nan_to_num(y, nan=np.nanmean(y))
+    cumsum_x = np.r_[0, np.cumsum(x)]
+    cumsum_y = np.r_[0, np.cumsum(y)]
+    counts = bucket_ends - bucket_starts
+    mean_x = (cumsum_x[bucket_ends] - cumsum_x[bucket_starts]) / counts
+    mean_y = (cumsum_y[bucket_ends] - cumsum_y[bucket_starts]) / counts
+
+    keep = [0]
+    for i in range(len(bucket_starts)):
+        start = max(bucket_starts[i], 1)
+        end = min(bucket_ends[i], len(x) - 1)
+        if start >= end:
+            continue
+        a = keep[-1]
+        # the last bucket uses the last point instead of the next mean
+        next_x, next_y = (
+            (mean_x[i + 1], mean_y[i + 1])
+            if i + 1 < len(bucket_starts)
+            else (x[-1], y[-1])
+        )
+        area = np.abs(
+            (x[a] - next_x) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (next_y - y[a])
+        )
+        keep.append(start + int(area.argmax()))
+    keep.append(len(x) - 1)
+    return np.unique(keep)
@@ -0,0 +1,199 @@
+"""Lightweight timing and memory instrumentation for the pipeline scripts
+
+Wrap a unit of work in a named span to record its wall time, CPU time,
+memory and (optionally) the number of rows it processed::
+
+    with instrumentation.span("rolling_features", measurement="HR") as s:
+        df = ...
+        s["rows"] = len(df)
+
+The memory of a span is its peak resident set size (RSS), i.e. the
+peak since the start of the span (Linux only: the peak RSS of the
+process is reset at the start of every span, see ``reset_peak_rss``),
+and the change in RSS from its start to its end. The peak RSS over the
+lifetime of the process is saved as well ("process_peak_rss_mb").
+
+The spans of a run are collected in memory and can be saved as a json
+report with ``write_report``.
+"""
+
+import functools
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# all spans recorded in this process, in order of completion
+SPANS = []
+# the currently open spans (for nesting)
+_STACK = []
+_START_TIME = time.time()
+# peak RSS of this process (in MB) up to the last reset of the peak RSS
+# (which also resets ru_maxrss on Linux) or the last span boundary
+_PROCESS_PEAK_MB = 0.0
+
+
+def process_peak_rss_mb():
+    """Peak resident set size over the lifetime of this process in MB
+    (including the peaks before ``reset_peak_rss``), or None if it can't
+    be measured on this platform"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    peak = peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+    return max(peak, _PROCESS_PEAK_MB)
+
+
+def rss_mb():
+    """Current and peak resident set size of this process in MB
+
+    The peak is the peak since the last ``reset_peak_rss``.
+
+    :returns: a tuple (rss, peak), or (None, None) if they can't be
+        measured on this platform (they are read from /proc/self/status
+        on Linux)
+    """
+    try:
+        with open("/proc/self/status") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+        # e.g. "VmRSS:    123456 kB"
+        return tuple(int(fields[k].split()[0]) / 2**10 for k in ["VmRSS", "VmHWM"])
+    except (OSError, KeyError, ValueError):
+        return (None, None)
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size of this process to its current
+    resident set size
+
+    :returns: whether the peak was reset (this needs Linux 4.0 or later)
+    """
+    global _PROCESS_PEAK_MB
+    _PROCESS_PEAK_MB = process_peak_rss_mb() or 0.0
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+@contextmanager
+def span(name, rows=None, **attributes):
+    """Record the wall time, CPU time and memory of a block of code
+
+    The recorded memory is the peak RSS during the block
+    ("peak_rss_mb", None if the peak RSS can't be reset on this
+    platform), the change in RSS from its start to its end
+    ("rss_delta_mb") and the peak RSS over the lifetime of the process
+    ("process_peak_rss_mb").
+
+    :param name: name of the span, e.g. "load_data"
+    :param rows: number of rows processed, if known in advance. The
+        yielded dict can be updated with ``rows`` (or any other
+        attribute) before the block ends.
+    :param attributes: additional attributes to save with the span,
+        e.g. ``participant="32113-0004"``
+    :returns: context manager yielding the (mutable) span dict
+    """
+    record = {
+        "name": name,
+        "parent": _STACK[-1]["name"] if _STACK else None,
+        "rows": rows,
+    }
+    record.update(attributes)
+    # the peak before the reset belongs to the enclosing spans
+    rss_start, peak = rss_mb()
+    _update_peaks(peak)
+    resettable = reset_peak_rss()
+    record["peak_rss_mb"] = rss_start if resettable else None
+    _STACK.append(record)
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield record
+    finally:
+        record["wall_seconds"] = time.perf_counter() - wall_start
+        record["cpu_seconds"] = time.process_time() - cpu_start
+        rss_end, peak = rss_mb()
+        _update_peaks(peak)
+        _STACK.pop()
+        record["rss_delta_mb"] = rss_end - rss_start if rss_start is not None else None
+        record["process_peak_rss_mb"] = process_peak_rss_mb()
+        SPANS.append(record)
+
+
+def _update_peaks(peak):
+    # the peak RSS since the last reset counts towards all open spans
+    # (whose peak RSS is None if it can't be reset) and the process
+    global _PROCESS_PEAK_MB
+    if peak is None:
+        return
+    _PROCESS_PEAK_MB = max(_PROCESS_PEAK_MB, peak)
+    for open_record in _STACK:
+        if open_record["peak_rss_mb"] is not None:
+            open_record["peak_rss_mb"] = max(open_record["peak_rss_mb"], peak)
+
+
+def timed(name, rows=None):
+    """Decorator that records every call of a function as a span
+
+    :param name: name of the span
+    :param rows: optional function that returns the number of processed
+        rows given the return value of the decorated function, e.g.
+        ``len``
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name) as record:
+                result = func(*args, **kwargs)
+                if rows is not None:
+                    record["rows"] = rows(result)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def record(name, **values):
+    """Add a span that was measured elsewhere (e.g. in a worker process)
+
+    :param name: name of the span
+    :param values: the measurements and attributes of the span, e.g.
+        ``wall_seconds=1.5``
+    """
+    entry = {"name": name, "parent": _STACK[-1]["name"] if _STACK else None}
+    entry.update(values)
+    SPANS.append(entry)
+
+
+def write_report(path):
+    """Save all spans of this run as a json report
+
+    :param path: path for saving the json file. Nothing is saved if this
+        is None.
+    """
+    if path is None:
+        return
+
+    report = {
+        "command": " ".join(sys.argv),
+        "pid": os.getpid(),
+        "start_time": _START_TIME,
+        "wall_seconds": time.time() - _START_TIME,
+        "process_peak_rss_mb": process_peak_rss_mb(),
+        "spans": SPANS,
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2, default=str)
+    print(f"Saved the instrumentation report to {path}.")
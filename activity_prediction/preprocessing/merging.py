@@ -1,7 +1,21 @@
 import pandas as pd
 import numpy as np
+import threading
 import pickle
+import queue
 import click
+import time
+
+try:  # imported as part of the preprocessing package
+    from . import helperfuns
+    from . import instrumentation
+    from . import sharding
+    from .metadata import save_metadata
+except ImportError:  # imported from within the preprocessing directory
+    import helperfuns
+    import instrumentation
+    import sharding
+    from metadata import save_metadata
 
 
 @click.command()
@@ -9,15 +23,66 @@ import click
     "--tolerance",
     help="This corresponds to the ``tolerance`` parameter in pandas.merge_asof and is used for merging features (not labels). This must use pandas's 'offset alias' syntax (see https://pandas.pydata.org/pandas-docs/stable/user_guide/timeseries.html#offset-aliases), e.g. '10min'.",
 )
+@click.option(
+    "--report_path",
+    default=None,
+    help="Optional path for saving a json report with the wall time, CPU time, peak memory and row counts of each step.",
+)
+@click.option(
+    "--shard",
+    default=None,
+    callback=sharding.shard_callback,
+    help="Optional shard spec i/N for only merging the participants of shard i of N (see sharding.py). The shard i/N outputs of the feature scripts are used (see --allow_unsharded_inputs), and the merged features are saved with a '_shard-i-of-N' suffix.",
+)
+@click.option(
+    "--allow_unsharded_inputs/--no-allow_unsharded_inputs",
+    default=False,
+    help="Flag for whether or not to read the unsharded features (and select the participants of the shard) if there are no shard i/N outputs of the previous script. Without this flag, a missing shard output is an error.",
+)
+@click.option(
+    "--labels_path",
+    default="clean_data/labels_df.pickle",
+    help="Path to the pickle file containing the cleaned labels (see clean_labels.py).",
+)
+@click.option(
+    "--prefetch",
+    default=1,
+    type=int,
+    help="Number of inputs (labels and feature files) that are loaded ahead on a background thread while the current input is merged. Loaded inputs wait in a queue of this size, which bounds the extra memory. Use 0 to load every input only when it is needed.",
+)
+@click.option(
+    "--save_partitions/--no-save_partitions",
+    default=True,
+    help="Flag for whether or not to also save the merged features as one pickle file per participant (see helperfuns.save_partitions), so that predict.py can score them without loading all participants at once.",
+)
 @click.argument(
     "feature_paths", nargs=-1,
 )
 @click.argument("save_path", nargs=1)
-def main(tolerance, feature_paths, save_path):
+def main(
+    tolerance,
+    feature_paths,
+    save_path,
+    report_path,
+    shard,
+    allow_unsharded_inputs,
+    labels_path,
+    prefetch,
+    save_partitions,
+):
     """Merge features and labels onto the same timeline
 
     Uses pandas.merge_asof, which is a left join that matches on the
-    closest observation in time.
+    closest observation in time. Features on the same fixed-rate grid
+    (see grid_features.py) are instead joined by index alignment.
+
+    The labels and feature files are loaded (and the shard selected) on
+    a background thread in the order they are merged, so that reading
+    the next file overlaps with merging the current one (see --prefetch
+    and ``prefetch_inputs``). The time spent waiting for each input is printed
+    and saved in the --report_path report, which shows whether a run is
+    I/O-bound (waiting for inputs) or compute-bound (the loader waiting
+    for the merging).
 
     FEATURE_PATHS: Space-separated paths to the pickle files containing
     the features (pandas dataframes) to merge. The merging will perform
@@ -26,11 +91,26 @@ def main(tolerance, feature_paths, save_path):
     SAVE_PATH: Path for saving the merged features as a pickle file.
     """
 
+    def load_input(path):
+        with open(path, "rb") as f:
+            df = pickle.load(f)
+        if path == labels_path:
+            return df
+        df = sharding.select_shard(df, shard)
+        df.index.rename(["Id", "Time"], inplace=True)
+        return df
+
+    inputs = [labels_path] + [
+        sharding.get_input_path(path, shard, allow_unsharded=allow_unsharded_inputs)
+        for path in feature_paths
+    ]
+    loaded = prefetch_inputs(load_input, inputs, max_prefetched=prefetch)
+    _, labels_df = next(loaded)
+
     merged = None
     # merge all features
-    for path in feature_paths:
-        to_merge = pickle.load(open(path, "rb"))
-        to_merge.index.rename(["Id", "Time"], inplace=True)
+    for path, to_merge in loaded:
+        grid_period = to_merge.attrs.get("grid_period")
 
         # check if dataframe contains spectrogram features
         if any(["spectrogram" in x for x in to_merge.columns]):
@@ -40,33 +120,143 @@ def main(tolerance, feature_paths, save_path):
 
         if merged is None:  # first dataframe
             merged = to_merge
+            merged_grid_period = grid_period
             start_nrows = merged.shape[0]
             print(f"The first feature file contains {start_nrows} rows.")
 
             # merge labels
             merged = merge_labels(
-                merged, duration=pd.Timedelta("1H"), offset=pd.Timedelta("10min")
+                merged,
+                duration=pd.Timedelta("1H"),
+                offset=pd.Timedelta("10min"),
+                labels_df=labels_df,
             )
+            del labels_df
             end_nrows = merged.shape[0]
             print(
-                f"After merging (time-based left joins) with labels, the resulting dataframe contains {end_nrows} ({np.round(end_nrows/start_nrows*100, 2)}% of the starting number of rows)."
+                f"After merging (time-based left joins) with labels, the resulting dataframe contains {end_nrows} ({np.round(end_nrows/max(start_nrows, 1)*100, 2)}% of the starting number of rows)."
             )
             continue
 
-        merged = merge_features(merged, to_merge, tolerance=tolerance)
-        merged.set_index(["Id", "Time"], inplace=True)
+        if grid_period is not None and grid_period == merged_grid_period:
+            merged = merge_aligned_features(merged, to_merge)
+        else:
+            merged = merge_features(merged, to_merge, tolerance=tolerance)
+            merged.set_index(["Id", "Time"], inplace=True)
 
     end_nrows = merged.shape[0]
     print(
-        f"After merging (time-based left joins) the features, the resulting dataframe contains {end_nrows} ({np.round(end_nrows/start_nrows*100, 2)}% of the starting number of rows)."
+        f"After merging (time-based left joins) the features, the resulting dataframe contains {end_nrows} ({np.round(end_nrows/max(start_nrows, 1)*100, 2)}% of the starting number of rows)."
     )
 
+    save_path = sharding.get_shard_path(save_path, shard)
     with open(save_path, "wb") as f:
         pickle.dump(merged, f)
+    save_metadata(merged, save_path)
     print(f"Saved the merged features and labels to {save_path}.")
+    if save_partitions:
+        helperfuns.save_partitions(merged, save_path)
+        print(f"Saved the partitions to {helperfuns.get_partition_dir(save_path)}.")
+
+    instrumentation.write_report(report_path)
+
+
+def prefetch_inputs(load, paths, max_prefetched=1):
+    """Load files on a background thread ahead of their use
+
+    The loaded files wait in a queue of size ``max_prefetched``, so at
+    most ``max_prefetched`` loaded files (plus the one that is being
+    loaded) are held in memory besides the one that is being used. The
+    wait times are recorded with ``instrumentation.record``: how long
+    the caller waited for each file ("prefetch_wait") and, in total, how
+    long the loader waited for space in the queue
+    ("prefetch_blocked").
+
+    :param load: function that loads a path, e.g. reads a pickle file
+    :param paths: list of paths to load, in the order of their use
+    :param max_prefetched: size of the queue of loaded files, defaults
+        to 1. With 0, every file is loaded by the caller's thread when
+        it is needed.
+    :returns: generator of tuples (path, loaded file)
+    """
+    if max_prefetched < 1:
+        for path in paths:
+            start = time.perf_counter()
+            df = load(path)
+            wait_seconds = time.perf_counter() - start
+            instrumentation.record(
+                "prefetch_wait",
+                path=path,
+                load_seconds=wait_seconds,
+                wait_seconds=wait_seconds,
+            )
+            yield (path, df)
+            del df
+        return
+
+    loaded = queue.Queue(maxsize=max_prefetched)
+    stop = threading.Event()
+    blocked = [0.0]
+
+    def loader():
+        for path in paths:
+            if stop.is_set():
+                return
+            start = time.perf_counter()
+            try:
+                df = load(path)
+            except Exception as e:
+                loaded.put((path, e, None))
+                return
+            load_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            loaded.put((path, df, load_seconds))
+            blocked[0] += time.perf_counter() - start
+            del df
+
+    thread = threading.Thread(target=loader, daemon=True)
+    thread.start()
+    total_wait = total_load = 0.0
+    try:
+        for _ in paths:
+            start = time.perf_counter()
+            path, df, load_seconds = loaded.get()
+            wait_seconds = time.perf_counter() - start
+            if isinstance(df, Exception):
+                raise df
+            print(
+                f"Loaded {path} in {load_seconds:.2f}s (waited {wait_seconds:.2f}s for it)."
+            )
+            instrumentation.record(
+                "prefetch_wait",
+                path=path,
+                load_seconds=load_seconds,
+                wait_seconds=wait_seconds,
+            )
+            total_wait += wait_seconds
+            total_load += load_seconds
+            # don't keep a reference to the file while the caller uses it
+            item = [(path, df)]
+            del df
+            yield item.pop()
+    finally:
+        # let the loader finish if the caller stops early
+        stop.set()
+        while thread.is_alive():
+            try:
+                loaded.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    thread.join()
+    instrumentation.record("prefetch_blocked", wait_seconds=blocked[0])
+    print(
+        f"Loading the inputs took {total_load:.2f}s, of which the merging waited {total_wait:.2f}s (I/O-bound). The loader waited {blocked[0]:.2f}s for the merging (compute-bound)."
+    )
 
 
 # TODO: docs
+@instrumentation.timed("merge_features", rows=len)
 def merge_features(df1, df2, tolerance, datetime_index="Time", id_index="Id"):
     """Merge timeseries features by finding the nearest match in time using pandas.merge_asof.
 
@@ -92,6 +282,29 @@ def merge_features(df1, df2, tolerance, datetime_index="Time", id_index="Id"):
     return merged
 
 
+@instrumentation.timed("merge_aligned_features", rows=len)
+def merge_aligned_features(df1, df2):
+    """Merge features that share the same (Id, Time) grid index by
+    index alignment
+
+    Unlike ``merge_features``, this doesn't need to sort or search for
+    the nearest match in time: rows are matched on equal index values.
+
+    :param df1: pandas dataframe indexed by "Id" and "Time"
+    :param df2: pandas dataframe of features on the same grid as
+        ``df1`` (see grid_features.py), indexed by "Id" and "Time"
+    :returns: pandas dataframe with the rows of ``df1`` that have a
+        match in ``df2``, without missing values
+    """
+    merged = df1.join(df2, how="inner")
+
+    # drop records that don't have any matches from df2
+    merged.dropna(inplace=True)
+
+    return merged
+
+
+@instrumentation.timed("merge_labels", rows=len)
 def merge_labels(
     df,
     duration=pd.Timedelta("1H"),
@@ -99,6 +312,7 @@ def merge_labels(
     datetime_index="Time",
     id_index="Id",
     labels_path="clean_data/labels_df.pickle",
+    labels_df=None,
 ):
     """Merge the input dataframe with labels (Strong-D study arms)
 
@@ -106,11 +320,15 @@ def merge_labels(
     :param offset: [description], defaults to pd.Timedelta("10min")
     :param duration: [description], defaults to pd.Timedelta("1H")
     :param labels_path: [description], defaults to "clean_data/labels_df.pickle"
+    :param labels_df: the labels (e.g. already loaded from
+        ``labels_path``). Defaults to None, which loads them from
+        ``labels_path``.
     :returns: [description]
     """
 
-    with open(labels_path, "rb") as f:
-        labels_df = pickle.load(f)
+    if labels_df is None:
+        with open(labels_path, "rb") as f:
+            labels_df = pickle.load(f)
 
     # drop any existing "Arm" label column
     df.drop("Arm", axis=1, inplace=True, errors="ignore")
@@ -167,6 +385,100 @@ def merge_labels(
     return merged
 
 
+@instrumentation.timed("get_label_coverage", rows=len)
+def get_label_coverage(
+    df,
+    labels_df,
+    duration=pd.Timedelta("1H"),
+    offset=pd.Timedelta("10min"),
+):
+    """Count the rows of each participant per label, as assigned by
+    ``merge_labels``
+
+    This applies the same matching rules as ``merge_labels`` (a row gets
+    the arm of the latest label at most ``duration`` after the label
+    time shifted by ``offset``, unless it lies within ``duration``
+    before a label, which makes it "other"), but only counts the matches
+    with binary searches over the sorted timestamps instead of joining
+    the rows.
+
+    :param df: pandas dataframe (e.g. the cleaned steps data) indexed by
+        participant ID and time
+    :param labels_df: pandas dataframe of the labels with indices ("Id",
+        "Time") and an "Arm" column
+    :param duration: see ``merge_labels``, defaults to 1 hour
+    :param offset: see ``merge_labels``, defaults to 10 minutes
+    :returns: pandas dataframe indexed by "Id" with the total number of
+        rows ("Rows"), the number of rows per label (one column per arm
+        and "other") and the number of labels ("Labels")
+    """
+    duration = duration.to_timedelta64()
+    offset = offset.to_timedelta64()
+    arms = sorted(labels_df["Arm"].unique())
+    labels_by_id = {
+        participant_id: participant_labels.droplevel(0).sort_index()
+        for participant_id, participant_labels in labels_df.groupby(level=0)
+    }
+
+    # group the timestamps by participant
+    ids, codes = np.unique(df.index.get_level_values(0), return_inverse=True)
+    order = np.argsort(codes, kind="stable")
+    bounds = np.r_[0, np.cumsum(np.bincount(codes, minlength=len(ids)))]
+    times = df.index.get_level_values(1).values[order]
+
+    rows = []
+    for k, participant_id in enumerate(ids):
+        time = np.sort(times[bounds[k] : bounds[k + 1]])
+        counts = dict.fromkeys(arms + ["other"], 0)
+        participant_labels = labels_by_id.get(participant_id)
+        if participant_labels is not None:
+            i, has_arm, is_other = match_labels(
+                time, participant_labels.index.values, duration, offset
+            )
+            counts["other"] = int(is_other.sum())
+            row_arms = participant_labels["Arm"].values[i[has_arm & ~is_other]]
+            for arm, count in zip(*np.unique(row_arms, return_counts=True)):
+                counts[arm] = int(count)
+        rows.append(
+            {
+                "Id": participant_id,
+                "Rows": len(time),
+                **counts,
+                "Labels": 0 if participant_labels is None else len(participant_labels),
+            }
+        )
+
+    return pd.DataFrame(rows).set_index("Id")
+
+
+def match_labels(time, label_time, duration, offset):
+    """Match the timestamps of one participant with labels like
+    ``merge_labels``
+
+    :param time: sorted numpy datetime64 array of the row timestamps
+    :param label_time: sorted numpy datetime64 array of the label
+        timestamps of the same participant
+    :param duration: numpy.timedelta64 (see ``merge_labels``)
+    :param offset: numpy.timedelta64 (see ``merge_labels``)
+    :returns: a tuple (i, has_arm, is_other) of numpy arrays: the index
+        of the latest (shifted) label of each row, whether the row is
+        within ``duration`` of that label, and whether the row is within
+        ``duration`` before a label (which makes it "other")
+    """
+    # arm of the latest (shifted) label within the duration
+    i = np.searchsorted(label_time + offset, time, side="right") - 1
+    has_arm = (i >= 0) & (time - (label_time[np.maximum(i, 0)] + offset) <= duration)
+
+    # "other" within the duration before a label
+    j = np.searchsorted(label_time - duration, time, side="right") - 1
+    is_other = (j >= 0) & (
+        time - (label_time[np.maximum(j, 0)] - duration) <= duration
+    )
+
+    return (i, has_arm, is_other)
+
+
+@instrumentation.timed("get_top_frequency_bands", rows=len)
 def get_top_frequency_bands(spectrogram_features, n=5):
     """Keep only the top n spectrogram frequency bands/columns 10 with the largest average magnitudes/contributions
 
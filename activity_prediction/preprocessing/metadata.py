@@ -0,0 +1,147 @@
+import pandas as pd
+import numpy as np
+import json
+import os
+
+
+def get_metadata_path(path):
+    """Path of the metadata saved next to a pickled dataframe
+
+    :param path: path to the pickle file, e.g.
+        "clean_data/hr_seconds_df.pickle"
+    :returns: path to the metadata json file, e.g.
+        "clean_data/hr_seconds_df_metadata.json"
+    """
+    return os.path.splitext(path)[0] + "_metadata.json"
+
+
+def get_file_signature(path):
+    """Size and modification time of a file, which change whenever the
+    file is overwritten
+
+    :param path: path to the file
+    :returns: dict with the keys "size" and "mtime"
+    """
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def compute_metadata(df):
+    """Describe a dataframe indexed by participant ID and time
+
+    :param df: pandas dataframe with "Id" as the first index and a
+        datetime second index
+    :returns: dict with the keys "sorted" (whether the rows are sorted
+        by participant ID and then time), "deduplicated" (whether the
+        index is unique), "index_names", "columns", "dtypes",
+        "index_dtypes", "rows" and
+        "participants" (a dict of participant IDs and their number of
+        rows and first and last timestamps, sorted by participant ID)
+    """
+    codes, ids = pd.factorize(df.index.get_level_values(0), sort=True)
+    time = pd.Series(df.index.get_level_values(1))
+    ranges = time.groupby(codes).agg(["min", "max"])
+    counts = np.bincount(codes, minlength=len(ids))
+
+    return {
+        "sorted": bool(df.index.is_monotonic_increasing),
+        "deduplicated": bool(df.index.is_unique),
+        "index_names": list(df.index.names),
+        "columns": [str(c) for c in df.columns],
+        "dtypes": [str(d) for d in df.dtypes],
+        "index_dtypes": [str(level.dtype) for level in df.index.levels],
+        "rows": len(df),
+        "participants": {
+            str(participant_id): {
+                "rows": int(counts[k]),
+                "start": str(ranges["min"].iloc[k]),
+                "end": str(ranges["max"].iloc[k]),
+            }
+            for k, participant_id in enumerate(ids)
+        },
+    }
+
+
+def save_metadata(df, path, metadata=None):
+    """Save the metadata of a pickled dataframe next to it
+
+    Call this right after saving the pickle file: the metadata records
+    the size and modification time of the pickle file, so that metadata
+    of a pickle file that was overwritten later is recognized as stale.
+
+    :param df: the pickled pandas dataframe (see ``compute_metadata``)
+    :param path: path to the pickle file of ``df``
+    :param metadata: the metadata of ``df``, if already known (e.g.
+        because ``df`` was just sorted and deduplicated). Defaults to
+        None, which computes it.
+    :returns: the metadata dict
+    """
+    if metadata is None:
+        metadata = compute_metadata(df)
+    metadata = dict(metadata, file=get_file_signature(path))
+    with open(get_metadata_path(path), "w") as f:
+        json.dump(metadata, f, indent=2)
+    return metadata
+
+
+def read_metadata(path):
+    """Read the metadata of a pickled dataframe
+
+    This only reads the (small) metadata file and compares the size and
+    modification time of the pickle file with those recorded at save
+    time, so it takes constant time regardless of the number of rows.
+
+    :param path: path to the pickle file
+    :returns: the metadata dict (see ``compute_metadata``), or None if
+        there is no metadata or if it is stale
+    """
+    metadata_path = get_metadata_path(path)
+    if not (os.path.exists(metadata_path) and os.path.exists(path)):
+        return None
+    with open(metadata_path) as f:
+        metadata = json.load(f)
+
+    if metadata.get("file") != get_file_signature(path):
+        print(f"Ignoring the stale metadata of {path}.")
+        return None
+    return metadata
+
+
+def verify_metadata(df, metadata, path=""):
+    """Check a loaded dataframe against its saved metadata (for --strict
+    runs)
+
+    The dataframe may contain a subset of the participants, in which
+    case only their metadata are compared. A dataframe must be sorted
+    (deduplicated) if the metadata say so, but not the other way round,
+    because a subset of an unsorted dataframe can be sorted.
+
+    :param df: the loaded pandas dataframe
+    :param metadata: the saved metadata dict, or a partition manifest
+        (see ``helperfuns.save_partitions``)
+    :param path: path to the pickle file, for the error message
+    :raises ValueError: if the dataframe doesn't match the metadata
+    """
+    actual = compute_metadata(df)
+    mismatches = [
+        key
+        for key in ["sorted", "deduplicated"]
+        if metadata.get(key) and not actual[key]
+    ]
+    if "participants" in metadata:
+        saved = metadata["participants"]
+        if set(actual["participants"]) - set(saved) or (
+            isinstance(saved, dict)
+            and any(
+                saved[i] != actual["participants"][i] for i in actual["participants"]
+            )
+        ):
+            mismatches.append("participants")
+    for key in ["index_names", "columns"]:
+        if key in metadata and metadata[key] != actual[key]:
+            mismatches.append(key)
+
+    if mismatches:
+        raise ValueError(
+            f"The saved metadata of {path} don't match the data: {mismatches}"
+        )
@@ -0,0 +1,183 @@
+import pandas as pd
+import numpy as np
+from scipy import signal
+from collections import deque
+import bisect
+
+
+class OnlineRollingFeatures:
+    """Incremental version of the rolling window features in
+    rolling_features.py for a single participant and measurement
+
+    Observations must be added in time order. The window for an
+    observation at time ``t`` contains all observations in ``(t -
+    window_size, t]``, which is the same window as in
+    ``pandas.DataFrame.rolling(window=window_size)``. Only the
+    observations within the current window are kept in memory.
+
+    The mean and standard deviation use running sums, the minimum and
+    maximum use monotonic queues, and the median and quantiles use a
+    sorted list of the values in the window.
+    """
+
+    def __init__(self, measurement, window_size):
+        """
+        :param measurement: prefix of the feature names, e.g. "HR" or
+            "Steps"
+        :param window_size: pandas offset alias (e.g. "10min") or
+            pandas.Timedelta
+        """
+        self.measurement = measurement
+        self.window_size = pd.Timedelta(window_size).to_timedelta64()
+        self.window = deque()  # (time, value) pairs
+        self.min_queue = deque()
+        self.max_queue = deque()
+        self.sorted_values = []
+        self.sum = 0.0
+        self.sum_sq = 0.0
+
+    def update(self, time, value):
+        """Add an observation and return the rolling features of the
+        window ending at this observation
+
+        :param time: numpy.datetime64 or pandas.Timestamp, not earlier
+            than the previously added observation
+        :param value: observed value
+        :returns: dict mapping feature names (e.g. "HR_mean") to values
+        """
+        time = np.datetime64(time, "ns")
+        value = float(value)
+
+        self.window.append((time, value))
+        self.sum += value
+        self.sum_sq += value * value
+        bisect.insort(self.sorted_values, value)
+        while self.min_queue and self.min_queue[-1] > value:
+            self.min_queue.pop()
+        self.min_queue.append(value)
+        while self.max_queue and self.max_queue[-1] < value:
+            self.max_queue.pop()
+        self.max_queue.append(value)
+
+        # evict the observations that are no longer in (t - window, t]
+        while self.window[0][0] <= time - self.window_size:
+            _, old = self.window.popleft()
+            self.sum -= old
+            self.sum_sq -= old * old
+            del self.sorted_values[bisect.bisect_left(self.sorted_values, old)]
+            if self.min_queue[0] == old:
+                self.min_queue.popleft()
+            if self.max_queue[0] == old:
+                self.max_queue.popleft()
+
+        n = len(self.window)
+        mean = self.sum / n
+        if n > 1:
+            variance = max(self.sum_sq - n * mean * mean, 0.0) / (n - 1)
+            std = np.sqrt(variance)
+        else:
+            std = np.nan
+
+        m = self.measurement
+        return {
+            f"{m}_mean": mean,
+            f"{m}_std": std,
+            f"{m}_min": self.min_queue[0],
+            f"{m}_max": self.max_queue[0],
+            f"{m}_median": self._quantile(0.5),
+            f"{m}_quant25": self._quantile(0.25),
+            f"{m}_quant75": self._quantile(0.75),
+        }
+
+    def _quantile(self, q):
+        """Quantile of the current window, using linear interpolation
+        like ``pandas.core.window.Rolling.quantile``"""
+        position = q * (len(self.sorted_values) - 1)
+        lower = int(np.floor(position))
+        upper = min(lower + 1, len(self.sorted_values) - 1)
+        fraction = position - lower
+        return self.sorted_values[lower] + fraction * (
+            self.sorted_values[upper] - self.sorted_values[lower]
+        )
+
+
+class OnlineSpectrogramFeatures:
+    """Incremental version of the spectrogram features in
+    spectrogram_features.py for a single participant and measurement
+
+    Keeps the last ``window_size`` observations and calculates the
+    magnitude spectrum of this window (with the same parameters as
+    ``get_participant_spectrogram_features``) for every new
+    observation, i.e. the equivalent of the --overlap option of
+    spectrogram_features.py.
+
+    Note that the batch spectrogram features are indexed by the
+    *middle* of each window, whereas these features are returned at the
+    *end* of each window, i.e. as soon as the window is complete.
+    """
+
+    def __init__(self, spectrogram_col, samples_per_sec, window_size, bands=None):
+        """
+        :param spectrogram_col: name of the measurement, used as the
+            prefix of the feature names (e.g. "Value" or "Steps")
+        :param samples_per_sec: assumed constant sampling rate (``fs``
+            in scipy.signal.spectrogram)
+        :param window_size: number of observations per window
+            (``nperseg`` in scipy.signal.spectrogram)
+        :param bands: optional list of feature names (e.g.
+            "Value_spectrogram_0.0Hz") to return. Defaults to None, which
+            returns all frequency bands.
+        """
+        self.spectrogram_col = spectrogram_col
+        self.samples_per_sec = samples_per_sec
+        self.window_size = window_size
+        self.window = deque(maxlen=window_size)
+        self.last_time = None
+
+        f, _, _ = signal.spectrogram(
+            np.zeros(window_size),
+            fs=samples_per_sec,
+            nperseg=window_size,
+            noverlap=window_size - 1,
+            mode="magnitude",
+        )
+        self.names = [
+            f"{spectrogram_col}_spectrogram_" + str(np.round(f[j], 5)) + "Hz"
+            for j in range(len(f))
+        ]
+        self.keep = [
+            j for j, name in enumerate(self.names) if bands is None or name in bands
+        ]
+
+    def update(self, time, value, time_delta_threshold=pd.Timedelta("1D")):
+        """Add an observation and return the spectrogram features of the
+        last ``window_size`` observations
+
+        :param time: numpy.datetime64 or pandas.Timestamp, not earlier
+            than the previously added observation
+        :param value: observed value
+        :param time_delta_threshold: pandas.Timedelta. If the gap to the
+            previous observation is larger than this, the window is
+            restarted (like the splitting of the batch spectrograms),
+            defaults to pd.Timedelta("1D")
+        :returns: dict mapping feature names to band magnitudes, or None
+            if there are fewer than ``window_size`` observations since
+            the start (or the last large gap)
+        """
+        time = np.datetime64(time, "ns")
+        if self.last_time is not None and time - self.last_time > time_delta_threshold:
+            self.window.clear()
+        self.last_time = time
+        self.window.append(float(value))
+
+        if len(self.window) < self.window_size:
+            return None
+
+        _, _, Sxx = signal.spectrogram(
+            np.fromiter(self.window, dtype=float, count=self.window_size),
+            fs=self.samples_per_sec,
+            nperseg=self.window_size,
+            noverlap=self.window_size - 1,
+            mode="magnitude",
+        )
+        return {self.names[j]: Sxx[j, 0] for j in self.keep}
@@ -0,0 +1,596 @@
+import pandas as pd
+import numpy as np
+from scipy import signal
+from tqdm import tqdm
+import warnings
+import pickle
+import click
+import os
+
+import helperfuns
+import instrumentation
+from merging import match_labels
+from metadata import save_metadata
+from spectrogram_features import STEPS_SAMPLES_PER_SEC, HR_SAMPLES_PER_SEC
+
+# raw data column, feature prefix and sampling rate of each measurement
+MEASUREMENTS = {
+    "steps": ("Steps", "Steps", STEPS_SAMPLES_PER_SEC),
+    "hr": ("Value", "HR", HR_SAMPLES_PER_SEC),
+}
+# maximum number of values in a chunk of padded windows when calculating
+# quantiles and spectrograms
+CHUNK_VALUES = 2 ** 22
+# observations per block of the prefix sums of WindowIndex
+BLOCK_ROWS = 1024
+
+
+@click.command()
+@click.option(
+    "--cleaned_steps_path",
+    help="Path to the pickle file containing the cleaned Fitabase/Fitbit steps data. These data are a pandas dataframe with 'Id' as the first index, 'ActivityMinute' as the second (datetime) index, and 'Steps' as the only column.",
+)
+@click.option(
+    "--cleaned_hr_path",
+    help="Path to the pickle file containing the cleaned Fitabase/Fitbit heart rate data. These data are a pandas dataframe with 'Id' as the first index, 'Time' as the second (datetime) index, and 'Value' as the only column.",
+)
+@click.option(
+    "--labels_path",
+    default="clean_data/labels_df.pickle",
+    help="Path to the pickle file containing the cleaned labels (see clean_labels.py). The query points are the samples of --query_measurement that merging.merge_labels would label.",
+)
+@click.option(
+    "--queries_path",
+    default=None,
+    help="Optional path to a pickle file containing a pandas dataframe whose ('Id', 'Time') index are the query points. This takes precedence over --labels_path.",
+)
+@click.option(
+    "--query_measurement",
+    default="steps",
+    type=click.Choice(list(MEASUREMENTS)),
+    help="Measurement whose labeled samples are the query points (the first feature file passed to merging.py).",
+)
+@click.option(
+    "--window_size",
+    default="10min",
+    help="Window size of the rolling window features. This must use pandas's 'offset alias' syntax, e.g. '10min'.",
+)
+@click.option(
+    "--window_size_in_minutes",
+    default=10,
+    type=int,
+    help="Window size of the spectrogram features in minutes (see spectrogram_features.py).",
+)
+@click.option(
+    "--save_dir",
+    help="Path to the directory for saving the features (as four separate pickle files).",
+)
+@click.option(
+    "--report_path",
+    default=None,
+    help="Optional path for saving a json report with the wall time, CPU time, peak memory and row counts of each step.",
+)
+def main(
+    cleaned_steps_path,
+    cleaned_hr_path,
+    labels_path,
+    queries_path,
+    query_measurement,
+    window_size,
+    window_size_in_minutes,
+    save_dir,
+    report_path,
+):
+    """Create rolling window and spectrogram features at query points only
+
+    This is the on-demand counterpart of rolling_features.py and
+    spectrogram_features.py: instead of calculating the features at
+    every raw sample, only the windows ending at the query points are
+    calculated. By default, the query points are the samples that
+    merging.merge_labels labels (all other rows are dropped before
+    training anyway).
+
+    \b
+    - rolling features: over the samples in (t - window_size, t], as in
+      rolling_features.py (pandas time-based rolling windows)
+    - spectrogram features: over the last ``window_rows`` samples up to
+      t (see spectrogram_features.py for ``window_rows``), if these
+      don't contain a gap longer than 1 day. Unlike
+      spectrogram_features.py, the features are assigned to the end of
+      the window (like online_features.py).
+
+    All four files are indexed by the same query points, so merging.py
+    matches them exactly. The file names follow those of the other
+    feature scripts with "query" in place of "rolling"/"spectrogram",
+    e.g. "hr_query_rolling_features_df_window=10min.pickle".
+    """
+    steps_df, hr_df = helperfuns.load_data(
+        steps_path=cleaned_steps_path,
+        hr_path=cleaned_hr_path,
+        validate_ids=True,
+        sort=True,
+        sample_num=None,
+    )
+    steps_df = helperfuns.remove_zero_daily_steps(
+        steps_df,
+        daily_totals=helperfuns.load_daily_step_totals(cleaned_steps_path),
+    )
+    data = {"steps": steps_df, "hr": hr_df}
+
+    if queries_path is not None:
+        with open(queries_path, "rb") as f:
+            queries = pickle.load(f).index
+    else:
+        with open(labels_path, "rb") as f:
+            labels_df = pickle.load(f)
+        queries = get_labeled_queries(data[query_measurement], labels_df)
+    queries = queries.set_names(["Id", "Time"])
+    print(f"Creating features at {len(queries)} query points.")
+
+    for name, (col, measurement, samples_per_sec) in MEASUREMENTS.items():
+        with instrumentation.span(
+            "query_rolling_features", measurement=measurement
+        ) as span:
+            rolling_df = get_query_rolling_features(
+                data[name], queries, col, measurement, window_size
+            )
+            span["rows"] = len(rolling_df)
+        save_features(
+            rolling_df,
+            os.path.join(
+                save_dir, f"{name}_query_rolling_features_df_window={window_size}.pickle"
+            ),
+        )
+
+        with instrumentation.span(
+            "query_spectrogram_features", measurement=measurement
+        ) as span:
+            spectrogram_df = get_query_spectrogram_features(
+                data[name],
+                queries,
+                col,
+                samples_per_sec,
+                window_rows=int(window_size_in_minutes * 60 * samples_per_sec),
+            )
+            span["rows"] = len(spectrogram_df)
+        save_features(
+            spectrogram_df,
+            os.path.join(
+                save_dir,
+                f"{name}_query_spectrogram_features_df_window={window_size_in_minutes}min.pickle",
+            ),
+        )
+
+    instrumentation.write_report(report_path)
+
+
+def save_features(features_df, save_path):
+    with open(save_path, "wb") as f:
+        pickle.dump(features_df, f)
+    save_metadata(features_df, save_path)
+    print(f"Saved the query point features to {save_path}.")
+
+
+def get_labeled_queries(
+    df, labels_df, duration=pd.Timedelta("1H"), offset=pd.Timedelta("10min")
+):
+    """Query points at the rows that ``merging.merge_labels`` labels
+
+    :param df: pandas dataframe indexed by participant ID and time,
+        sorted by both
+    :param labels_df: pandas dataframe of the labels with indices ("Id",
+        "Time") and an "Arm" column
+    :param duration: see ``merging.merge_labels``, defaults to 1 hour
+    :param offset: see ``merging.merge_labels``, defaults to 10 minutes
+    :returns: pandas MultiIndex ("Id", "Time") of the labeled rows
+    """
+    keep = np.zeros(len(df), dtype=bool)
+    ids = df.index.get_level_values(0)
+    time = df.index.get_level_values(1).values
+    for participant_id, participant_labels in labels_df.groupby(level=0):
+        start, end = ids.slice_locs(participant_id, participant_id)
+        if start == end:
+            continue
+        _, has_arm, is_other = match_labels(
+            time[start:end],
+            np.sort(participant_labels.index.get_level_values(1).values),
+            duration.to_timedelta64(),
+            offset.to_timedelta64(),
+        )
+        keep[start:end] = has_arm | is_other
+
+    return df.index[keep]
+
+
+class WindowIndex:
+    """Range statistics over the observations of one participant and
+    measurement
+
+    Prefix sums give the count, mean and standard deviation of any range
+    of consecutive observations in O(1). Sparse tables, i.e. the minimum
+    and maximum of every range of 2**k observations, give the minimum
+    and maximum in O(1) as the minimum (maximum) of two overlapping
+    power-of-two ranges. Building the index takes O(n log n) time and
+    memory.
+
+    The prefix sums restart at every block of ``BLOCK_ROWS`` observations
+    and are centered on the mean of their block, so the rounding errors
+    of a range don't grow with the length of the participant's history.
+    A range is split into the part in its first block, the part in its
+    last block and the whole blocks in between (from prefix sums over
+    the blocks), and their means and sums of squared deviations are
+    combined with the pairwise formula of Chan et al. A range of equal
+    values (minimum == maximum) has exactly that value as its mean and
+    a standard deviation of exactly 0, as in pandas.
+    """
+
+    def __init__(self, time, values):
+        """
+        :param time: sorted numpy datetime64 array
+        :param values: numpy array of the observed values
+        """
+        self.time = np.asarray(time)
+        self.values = np.asarray(values, dtype=float)
+        self.min_table = _sparse_table(self.values, np.minimum)
+        self.max_table = _sparse_table(self.values, np.maximum)
+
+        num_blocks = -(-len(self.values) // BLOCK_ROWS)
+        padded = np.zeros(num_blocks * BLOCK_ROWS)
+        padded[: len(self.values)] = self.values
+        blocks = padded.reshape(num_blocks, BLOCK_ROWS)
+        block_count = np.clip(
+            len(self.values) - BLOCK_ROWS * np.arange(num_blocks), 0, BLOCK_ROWS
+        )
+        with np.errstate(invalid="ignore"):
+            self.block_mean = blocks.sum(axis=1) / block_count
+        # zero padding after the last observation
+        centered = np.where(
+            np.arange(BLOCK_ROWS) < block_count[:, None],
+            blocks - self.block_mean[:, None],
+            0.0,
+        )
+        # sums of the (centered) values before each position within its
+        # block; the sums of whole blocks are in the last column
+        block_sum = np.cumsum(centered, axis=1)
+        block_sum_sq = np.cumsum(centered ** 2, axis=1)
+        positions = np.arange(1, len(self.values) + 1)
+        self.prefix_sum = np.r_[
+            0.0,
+            np.where(positions % BLOCK_ROWS > 0, block_sum.ravel()[positions - 1], 0),
+        ]
+        self.prefix_sum_sq = np.r_[
+            0.0,
+            np.where(
+                positions % BLOCK_ROWS > 0, block_sum_sq.ravel()[positions - 1], 0
+            ),
+        ]
+        self.block_sum = block_sum[:, -1] if num_blocks else np.zeros(0)
+        self.block_sum_sq = block_sum_sq[:, -1] if num_blocks else np.zeros(0)
+
+        # prefix sums over the blocks, centered on the overall mean
+        self.center = self.values.mean() if len(self.values) else 0.0
+        block_m2 = self.block_sum_sq - self.block_sum ** 2 / np.maximum(block_count, 1)
+        shift = self.block_mean - self.center
+        self.blocks_count = np.r_[0, np.cumsum(block_count)]
+        self.blocks_sum = np.r_[0.0, np.cumsum(block_count * shift)]
+        self.blocks_sum_sq = np.r_[0.0, np.cumsum(block_m2 + block_count * shift ** 2)]
+
+    def window_rows(self, end_time, window_size):
+        """Rows [start, end) of the observations in ``(end_time -
+        window_size, end_time]``"""
+        start = np.searchsorted(self.time, end_time - window_size, side="right")
+        end = np.searchsorted(self.time, end_time, side="right")
+        return (start, end)
+
+    def count(self, start, end):
+        return end - start
+
+    def mean(self, start, end):
+        _, mean, _ = self._moments(start, end)
+        return np.where(self._constant(start, end), self.min(start, end), mean)
+
+    def std(self, start, end):
+        """Sample standard deviation (NaN for fewer than two
+        observations)"""
+        count, _, m2 = self._moments(start, end)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            variance = np.clip(m2, 0, None) / (count - 1)
+        variance = np.where(self._constant(start, end), 0.0, variance)
+        return np.where(count > 1, np.sqrt(variance), np.nan)
+
+    def _constant(self, start, end):
+        """Whether all observations of each (non-empty) range are equal"""
+        return (self.count(start, end) > 0) & (
+            self.min(start, end) == self.max(start, end)
+        )
+
+    def _moments(self, start, end):
+        """Count, mean and sum of squared deviations from the mean of the
+        observations in each range (the mean is NaN for empty ranges)"""
+        start = np.asarray(start)
+        end = np.asarray(end)
+        if len(self.values) == 0:
+            return (end - start, np.full(len(start), np.nan), np.zeros(len(start)))
+        last_block = len(self.block_mean) - 1
+        first = start // BLOCK_ROWS
+        last = end // BLOCK_ROWS
+        same = first == last
+
+        # the part in the first block: rows [start, end) or [start, end
+        # of the block)
+        first_count = np.where(same, end, (first + 1) * BLOCK_ROWS) - start
+        first_sum = (
+            np.where(
+                same,
+                self.prefix_sum[end],
+                self.block_sum[np.minimum(first, last_block)],
+            )
+            - self.prefix_sum[start]
+        )
+        first_sum_sq = (
+            np.where(
+                same,
+                self.prefix_sum_sq[end],
+                self.block_sum_sq[np.minimum(first, last_block)],
+            )
+            - self.prefix_sum_sq[start]
+        )
+        moments = _centered_moments(
+            first_count,
+            self.block_mean[np.minimum(first, last_block)],
+            first_sum,
+            first_sum_sq,
+        )
+
+        # the whole blocks in between and the part in the last block
+        middle = np.minimum(first + 1, last)
+        middle_moments = _centered_moments(
+            self.blocks_count[last] - self.blocks_count[middle],
+            self.center,
+            self.blocks_sum[last] - self.blocks_sum[middle],
+            self.blocks_sum_sq[last] - self.blocks_sum_sq[middle],
+        )
+        last_moments = _centered_moments(
+            np.where(same, 0, end - last * BLOCK_ROWS),
+            self.block_mean[np.minimum(last, last_block)],
+            np.where(same, 0.0, self.prefix_sum[end]),
+            np.where(same, 0.0, self.prefix_sum_sq[end]),
+        )
+        moments = _combine_moments(moments, middle_moments)
+        return _combine_moments(moments, last_moments)
+
+    def min(self, start, end):
+        return self._range_query(self.min_table, np.minimum, start, end)
+
+    def max(self, start, end):
+        return self._range_query(self.max_table, np.maximum, start, end)
+
+    def quantiles(self, start, end, q):
+        """Quantiles of the observations in each range, with linear
+        interpolation like ``pandas.core.window.Rolling.quantile``
+
+        Unlike the other statistics, this takes time proportional to
+        the length of the ranges.
+
+        :param q: list of quantiles in [0, 1]
+        :returns: numpy array of shape (len(q), len(start))
+        """
+        result = np.full((len(q), len(start)), np.nan)
+        if len(start) == 0:
+            return result
+        width = max(int((end - start).max()), 1)
+        chunk_rows = max(1, CHUNK_VALUES // width)
+        padded = np.r_[self.values, np.nan]
+        offsets = np.arange(width)
+        for first in range(0, len(start), chunk_rows):
+            chunk = slice(first, first + chunk_rows)
+            rows = start[chunk, None] + offsets
+            rows = np.where(rows < end[chunk, None], rows, len(self.values))
+            with warnings.catch_warnings():
+                # ranges without observations are NaN
+                warnings.simplefilter("ignore", RuntimeWarning)
+                result[:, chunk] = np.nanquantile(padded[rows], q, axis=1)
+        return result
+
+    def _range_query(self, table, combine, start, end):
+        result = np.full(len(start), np.nan)
+        count = self.count(start, end)
+        valid = count > 0
+        # level of the largest power of two that fits in each range
+        level = np.zeros(len(start), dtype=int)
+        level[valid] = np.frexp(count[valid])[1] - 1
+        for k in np.unique(level[valid]):
+            rows = valid & (level == k)
+            result[rows] = combine(
+                table[k][start[rows]], table[k][end[rows] - (1 << k)]
+            )
+        return result
+
+
+def _centered_moments(count, center, total, total_sq):
+    """Count, mean and sum of squared deviations from the mean of
+    observations, given their sum and sum of squares relative to
+    ``center``"""
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(count > 0, center + total / count, np.nan)
+        m2 = np.where(count > 0, total_sq - total ** 2 / count, 0.0)
+    return (count, mean, m2)
+
+
+def _combine_moments(a, b):
+    """Moments (see ``_centered_moments``) of the union of two sets of
+    observations (Chan et al.'s pairwise update)"""
+    count_a, mean_a, m2_a = a
+    count_b, mean_b, m2_b = b
+    count = count_a + count_b
+    with np.errstate(invalid="ignore", divide="ignore"):
+        delta = mean_b - mean_a
+        mean = np.where(
+            count_b == 0,
+            mean_a,
+            np.where(count_a == 0, mean_b, mean_a + delta * count_b / count),
+        )
+        m2 = m2_a + m2_b
+        both = (count_a > 0) & (count_b > 0)
+        m2 = np.where(both, m2 + delta ** 2 * count_a * count_b / count, m2)
+    return (count, mean, m2)
+
+
+def _sparse_table(values, combine):
+    """Sparse table of ``values``: level k contains ``combine`` of the
+    values in every range of 2**k consecutive observations"""
+    table = [values]
+    length = 1
+    while 2 * length <= len(values):
+        previous = table[-1]
+        table.append(combine(previous[:-length], previous[length:]))
+        length *= 2
+    return table
+
+
+def _iter_participants(df, queries):
+    """Group the query points by participant
+
+    :returns: generator of tuples (participant_df, query_rows,
+        query_time), where ``participant_df`` contains the rows of the
+        participant in ``df`` (indexed by time only, None if there are
+        none) and ``query_rows`` are the positions of the participant's
+        query points in ``queries``
+    """
+    codes, ids = pd.factorize(queries.get_level_values(0))
+    order = np.argsort(codes, kind="stable")
+    bounds = np.r_[0, np.cumsum(np.bincount(codes, minlength=len(ids)))]
+    query_time = queries.get_level_values(1).values
+    df_ids = df.index.get_level_values(0)
+    for k, participant_id in enumerate(tqdm(ids)):
+        query_rows = order[bounds[k] : bounds[k + 1]]
+        start, end = df_ids.slice_locs(participant_id, participant_id)
+        participant_df = df.iloc[start:end].droplevel(0) if end > start else None
+        yield (participant_df, query_rows, query_time[query_rows])
+
+
+def get_query_rolling_features(
+    df, queries, col, measurement, window_size, quantiles=True
+):
+    """Calculate rolling window features at query points
+
+    The features of a query point at time t are calculated over the
+    observations in (t - window_size, t], i.e. the same window as in
+    rolling_features.py, so the features at the time of an observation
+    are equal to those of rolling_features.py (the mean and standard
+    deviation up to around 1e-11, see WindowIndex).
+
+    :param df: pandas dataframe with "Id" as the first index and a
+        datetime second index, sorted by both, containing the raw data
+        column ``col``
+    :param queries: pandas MultiIndex ("Id", "Time") of the query points
+    :param col: name of the raw data column, e.g. "Steps" or "Value"
+    :param measurement: prefix of the feature column names, e.g. "Steps"
+        or "HR"
+    :param window_size: pandas offset alias (e.g. "10min") or
+        pandas.Timedelta
+    :param quantiles: whether to also calculate the median and the 25th
+        and 75th quantiles (which take time proportional to the window
+        length), defaults to True
+    :returns: pandas dataframe indexed by ``queries`` (in the same
+        order) with the feature columns of rolling_features.py. Query
+        points without observations in their window have missing
+        values.
+    """
+    window_size = pd.Timedelta(window_size).to_timedelta64()
+    names = ["mean", "std", "min", "max"]
+    if quantiles:
+        names += ["median", "quant25", "quant75"]
+    features = {f"{measurement}_{name}": np.full(len(queries), np.nan) for name in names}
+
+    for participant_df, query_rows, query_time in _iter_participants(df, queries):
+        if participant_df is None:
+            continue
+        index = WindowIndex(participant_df.index.values, participant_df[col].values)
+        start, end = index.window_rows(query_time, window_size)
+        features[f"{measurement}_mean"][query_rows] = index.mean(start, end)
+        features[f"{measurement}_std"][query_rows] = index.std(start, end)
+        features[f"{measurement}_min"][query_rows] = index.min(start, end)
+        features[f"{measurement}_max"][query_rows] = index.max(start, end)
+        if quantiles:
+            median, quant25, quant75 = index.quantiles(start, end, [0.5, 0.25, 0.75])
+            features[f"{measurement}_median"][query_rows] = median
+            features[f"{measurement}_quant25"][query_rows] = quant25
+            features[f"{measurement}_quant75"][query_rows] = quant75
+        del index
+
+    return pd.DataFrame(features, index=queries)
+
+
+def get_query_spectrogram_features(
+    df,
+    queries,
+    col,
+    samples_per_sec,
+    window_rows,
+    time_delta_threshold=pd.Timedelta("1D"),
+):
+    """Calculate spectrogram features at query points
+
+    The features of a query point at time t are the magnitude spectrum
+    (as in spectrogram_features.py) of the last ``window_rows``
+    observations up to t. Like the separate spectrograms of
+    spectrogram_features.py, a window must not contain a gap longer
+    than ``time_delta_threshold``.
+
+    :param df: pandas dataframe with "Id" as the first index and a
+        datetime second index, sorted by both, containing the raw data
+        column ``col``
+    :param queries: pandas MultiIndex ("Id", "Time") of the query points
+    :param col: name of the raw data column, used as the prefix of the
+        feature column names (as in spectrogram_features.py)
+    :param samples_per_sec: assumed constant sampling rate (``fs`` in
+        scipy.signal.spectrogram)
+    :param window_rows: number of observations per window (``nperseg``)
+    :param time_delta_threshold: pandas.Timedelta, defaults to 1 day
+    :returns: pandas dataframe indexed by ``queries`` (in the same
+        order) with one column per frequency band. Query points without
+        a complete window have missing values.
+    """
+    get_spectrogram = lambda x: signal.spectrogram(
+        x,
+        fs=samples_per_sec,
+        nperseg=window_rows,
+        noverlap=window_rows - 1,
+        mode="magnitude",
+        axis=-1,
+    )
+    f, _, _ = get_spectrogram(np.zeros(window_rows))
+    columns = [f"{col}_spectrogram_" + str(np.round(x, 5)) + "Hz" for x in f]
+    features = np.full((len(queries), len(f)), np.nan)
+    threshold = time_delta_threshold.to_timedelta64()
+    chunk_rows = max(1, CHUNK_VALUES // window_rows)
+
+    for participant_df, query_rows, query_time in _iter_participants(df, queries):
+        if participant_df is None:
+            continue
+        time = participant_df.index.values
+        values = participant_df[col].values.astype(float)
+
+        # first row of the segment (between gaps) of every row
+        segment_start = np.zeros(len(time), dtype=int)
+        breaks = np.flatnonzero(np.diff(time) > threshold) + 1
+        segment_start[breaks] = breaks
+        segment_start = np.maximum.accumulate(segment_start)
+
+        end = np.searchsorted(time, query_time, side="right")
+        start = end - window_rows
+        valid = np.flatnonzero(
+            (start >= 0) & (start >= segment_start[np.maximum(end - 1, 0)])
+        )
+        for first in range(0, len(valid), chunk_rows):
+            rows = valid[first : first + chunk_rows]
+            windows = values[start[rows, None] + np.arange(window_rows)]
+            _, _, Sxx = get_spectrogram(windows)
+            features[query_rows[rows]] = Sxx[:, :, 0]
+
+    return pd.DataFrame(features, index=queries, columns=columns)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,11 @@ import click
 import os
 
 import helperfuns
+import instrumentation
+import sharding
+import step_runs
+from checkpoints import FeatureCheckpoints, input_signature, load_remaining_data
+from metadata import save_metadata
 
 
 @click.command()
@@ -29,12 +34,62 @@ import helperfuns
     "--save_dir",
     help="Path to the directory for saving the steps and heart rate rolling features (as two separate pickle files).",
 )
+@click.option(
+    "--report_path",
+    default=None,
+    help="Optional path for saving a json report with the wall time, CPU time, peak memory and row counts of each step.",
+)
+@click.option(
+    "--checkpoint_dir",
+    default=None,
+    help="Path to the directory for the per-participant checkpoints of the features. Defaults to a 'rolling_features_window=<window_size>_checkpoints' subdirectory of --save_dir.",
+)
+@click.option(
+    "--resume/--no-resume",
+    default=True,
+    help="Flag for whether or not to skip the participants that were checkpointed by a previous (e.g. interrupted) run with the same parameters and inputs.",
+)
+@click.option(
+    "--strict/--no-strict",
+    default=False,
+    help="Flag for whether or not to verify the saved metadata of the cleaned data (participants, row counts, time ranges, sortedness) against the loaded data instead of trusting them.",
+)
+@click.option(
+    "--shard",
+    default=None,
+    callback=sharding.shard_callback,
+    help="Optional shard spec i/N for only processing the participants of shard i of N (see sharding.py). The shard i/N outputs of cleaning.py are used (see --allow_unsharded_inputs), and the features are saved with a '_shard-i-of-N' suffix.",
+)
+@click.option(
+    "--allow_unsharded_inputs/--no-allow_unsharded_inputs",
+    default=False,
+    help="Flag for whether or not to read the unsharded cleaned data (and select the participants of the shard) if there are no shard i/N outputs of the previous script. Without this flag, a missing shard output is an error.",
+)
+@click.option(
+    "--chunk_size",
+    default=None,
+    help="Optional length of the time chunks in which the features of each participant are calculated (see get_chunked_rolling_features), e.g. '30D'. This bounds the memory used by the rolling window functions for participants with a lot of data. This must use pandas's 'offset alias' syntax and be longer than --window_size.",
+)
+@click.option(
+    "--step_runs/--no-step_runs",
+    "use_step_runs",
+    default=False,
+    help="Flag for whether or not to calculate the steps features from the run-length encoded steps data saved by cleaning.py (see step_runs.py and get_rolling_features_from_runs), which skips the work for long runs of zero steps. The per-minute steps data are then not loaded.",
+)
 def main(
     cleaned_steps_path,
     cleaned_hr_path,
     window_size,
     also_save_non_overlapping,
     save_dir,
+    report_path,
+    checkpoint_dir,
+    resume,
+    strict,
+    shard,
+    allow_unsharded_inputs,
+    chunk_size,
+    use_step_runs,
 ):
     """Create and save rolling window features using the cleaned HR
     (seconds) and steps (minutes) data.
@@ -55,95 +110,378 @@ def main(
     The rolling window functions used for both steps and HR data are:
     mean, standard deviation, minimum, maximum, median, 25th quantile,
     and 75th quantile.
+
+    The features of each participant are checkpointed as soon as they
+    are calculated (see checkpoints.py), so an interrupted run can be
+    resumed by running the same command again.
     """
-    steps_df, hr_df = helperfuns.load_data(
-        steps_path=cleaned_steps_path,
-        hr_path=cleaned_hr_path,
-        validate_ids=True,
-        sort=True,
-        sample_num=None,
+    cleaned_steps_path = sharding.get_input_path(
+        cleaned_steps_path, shard, allow_unsharded=allow_unsharded_inputs
+    )
+    cleaned_hr_path = sharding.get_input_path(
+        cleaned_hr_path, shard, allow_unsharded=allow_unsharded_inputs
+    )
+    if checkpoint_dir is None:
+        checkpoint_dir = os.path.join(
+            save_dir,
+            f"rolling_features_window={window_size}{sharding.shard_suffix(shard)}_checkpoints",
+        )
+    checkpoints = FeatureCheckpoints(
+        checkpoint_dir,
+        params={
+            "window_size": window_size,
+            "inputs": input_signature([cleaned_steps_path, cleaned_hr_path]),
+        },
+        resume=resume,
     )
 
-    # Remove all step data on a day if the total number of steps is zero
-    # on that day
-    steps_df = helperfuns.remove_zero_daily_steps(steps_df)
+    # load the participants that aren't checkpointed yet (the step runs
+    # instead of the steps data with --step_runs)
+    id_list, remaining_ids, steps_df, hr_df = load_remaining_data(
+        checkpoints,
+        cleaned_steps_path,
+        cleaned_hr_path,
+        strict=strict,
+        shard=shard,
+        use_step_runs=use_step_runs,
+    )
 
     df_dict = {"Steps": steps_df, "HR": hr_df}
-    measurements = list(df_dict.keys())
-    print("Creating steps and HR rolling features.")
-    pbar = tqdm(total=14)  # open custom progress bar
-    for measurement in measurements:
-        df = df_dict[measurement].copy()
-
-        # use only the second datetime index for time-based rolling
-        # functions
-        group = df.reset_index(0).groupby("Id")
-
-        # rolling functions
-        df[f"{measurement}_mean"] = group.rolling(window=window_size).mean().values
-        df[f"{measurement}_std"] = group.rolling(window=window_size).std().values
-        pbar.update(2)
-        df[f"{measurement}_min"] = group.rolling(window=window_size).min().values
-        df[f"{measurement}_max"] = group.rolling(window=window_size).max().values
-        pbar.update(2)
-        df[f"{measurement}_median"] = group.rolling(window=window_size).median().values
-        df[f"{measurement}_quant25"] = (
-            group.rolling(window=window_size).quantile(0.25).values
+    if remaining_ids:
+        # the steps of a participant can be empty after removing the days
+        # without steps
+        id_sets = {m: set(df.index.get_level_values(0)) for m, df in df_dict.items()}
+        id_index = {m: df.index.get_level_values(0) for m, df in df_dict.items()}
+
+    print("Creating steps and HR rolling features for each participant.")
+    for participant_id in tqdm(remaining_ids):
+        outputs = dict()
+        for measurement, df in df_dict.items():
+            with instrumentation.span(
+                "rolling_features", participant=participant_id, measurement=measurement
+            ) as span:
+                if measurement == "Steps" and use_step_runs:
+                    start, end = id_index[measurement].slice_locs(
+                        participant_id, participant_id
+                    )
+                    features_df = get_rolling_features_from_runs(
+                        df.iloc[start:end], window_size=window_size
+                    )
+                elif chunk_size is None:
+                    participant_df = (
+                        df.loc[[participant_id]]
+                        if participant_id in id_sets[measurement]
+                        else df.iloc[:0]
+                    )
+                    features_df = get_rolling_features(
+                        participant_df, measurement=measurement, window_size=window_size
+                    )
+                else:
+                    # a positional slice of the (sorted) data instead of a
+                    # copy of the participant's rows
+                    start, end = id_index[measurement].slice_locs(
+                        participant_id, participant_id
+                    )
+                    features_df = get_chunked_rolling_features(
+                        df.iloc[start:end],
+                        measurement=measurement,
+                        window_size=window_size,
+                        chunk_size=chunk_size,
+                    )
+                span["rows"] = len(features_df)
+            outputs[measurement.lower()] = features_df.droplevel(0)
+        checkpoints.save(participant_id, outputs)
+
+    # assemble and save one measurement at a time
+    for name, label, time_col, cleaned_path in [
+        ("steps", "steps", "ActivityMinute", cleaned_steps_path),
+        ("hr", "HR", "Time", cleaned_hr_path),
+    ]:
+        features_df = checkpoints.assemble(
+            name, id_list, index_names=["Id", time_col], input_path=cleaned_path
         )
-        df[f"{measurement}_quant75"] = (
-            group.rolling(window=window_size).quantile(0.75).values
+
+        save_path = sharding.get_shard_path(
+            os.path.join(
+                save_dir, f"{name}_rolling_features_df_window={window_size}.pickle"
+            ),
+            shard,
         )
-        pbar.update(3)
+        with open(save_path, "wb") as f:
+            pickle.dump(features_df, f)
+        save_metadata(features_df, save_path)
+        print(f"Saved {label} rolling features to {save_path}.")
 
-        df_dict[f"{measurement}_features"] = df
+        if also_save_non_overlapping:
+            no_overlap_df = features_df.groupby(
+                ["Id", pd.Grouper(level=time_col, freq=window_size)]
+            ).first()
+            no_overlap_save_path = sharding.get_shard_path(
+                os.path.join(
+                    save_dir,
+                    f"{name}_rolling_features_df_window={window_size}_no-overlap.pickle",
+                ),
+                shard,
+            )
+            with open(no_overlap_save_path, "wb") as f:
+                pickle.dump(no_overlap_df, f)
+            save_metadata(no_overlap_df, no_overlap_save_path)
+            print(
+                f"Saved non-overlapping {label} rolling features to {no_overlap_save_path}."
+            )
 
-    pbar.close()  # close custom progress bar
+        del features_df
 
-    steps_save_path = os.path.join(
-        save_dir, f"steps_rolling_features_df_window={window_size}.pickle"
-    )
-    with open(steps_save_path, "wb") as f:
-        pickle.dump(df_dict["Steps_features"], f)
-    print(f"Saved steps rolling features to {steps_save_path}.")
+    instrumentation.write_report(report_path)
 
-    hr_save_path = os.path.join(
-        save_dir, f"hr_rolling_features_df_window={window_size}.pickle"
+
+def get_rolling_features(df, measurement, window_size):
+    """Calculate rolling window features for steps or HR data
+
+    :param df: pandas dataframe with "Id" as the first index, a datetime
+        second index, and the raw data (e.g. "Steps" or "Value") as the
+        only column. The rows must be sorted by "Id" and then time.
+    :param measurement: prefix for the feature column names, e.g.
+        "Steps" or "HR"
+    :param window_size: window size used for pandas rolling window
+        functions, e.g. "10min"
+    :returns: a copy of ``df`` with the additional feature columns
+        ``<measurement>_mean``, ``<measurement>_std``,
+        ``<measurement>_min``, ``<measurement>_max``,
+        ``<measurement>_median``, ``<measurement>_quant25`` and
+        ``<measurement>_quant75``
+    """
+    df = df.copy()
+
+    # use only the second datetime index for time-based rolling
+    # functions
+    group = df.reset_index(0).groupby("Id")
+
+    # rolling functions
+    df[f"{measurement}_mean"] = group.rolling(window=window_size).mean().values
+    df[f"{measurement}_std"] = group.rolling(window=window_size).std().values
+    df[f"{measurement}_min"] = group.rolling(window=window_size).min().values
+    df[f"{measurement}_max"] = group.rolling(window=window_size).max().values
+    df[f"{measurement}_median"] = group.rolling(window=window_size).median().values
+    df[f"{measurement}_quant25"] = (
+        group.rolling(window=window_size).quantile(0.25).values
+    )
+    df[f"{measurement}_quant75"] = (
+        group.rolling(window=window_size).quantile(0.75).values
     )
-    with open(hr_save_path, "wb") as f:
-        pickle.dump(df_dict["HR_features"], f)
-    print(f"Saved HR rolling features to {hr_save_path}.")
-
-    if also_save_non_overlapping:
-        # steps
-        no_overlap_steps_df = (
-            df_dict["Steps_features"]
-            .groupby(["Id", pd.Grouper(level="ActivityMinute", freq=window_size)])
-            .first()
-        )
-        no_overlap_steps_save_path = os.path.join(
-            save_dir,
-            f"steps_rolling_features_df_window={window_size}_no-overlap.pickle",
-        )
-        with open(no_overlap_steps_save_path, "wb") as f:
-            pickle.dump(no_overlap_steps_df, f)
-        print(
-            f"Saved non-overlapping steps rolling features to {no_overlap_steps_save_path}."
-        )
 
-        # HR
-        no_overlap_hr_df = (
-            df_dict["HR_features"]
-            .groupby(["Id", pd.Grouper(level="Time", freq=window_size)])
-            .first()
-        )
-        no_overlap_hr_save_path = os.path.join(
-            save_dir, f"hr_rolling_features_df_window={window_size}_no-overlap.pickle",
-        )
-        with open(no_overlap_hr_save_path, "wb") as f:
-            pickle.dump(no_overlap_hr_df, f)
-        print(
-            f"Saved non-overlapping HR rolling features to {no_overlap_hr_save_path}."
+    return df
+
+
+def get_chunked_rolling_features(df, measurement, window_size, chunk_size):
+    """Calculate rolling window features for steps or HR data in time
+    chunks
+
+    The rows are split into consecutive chunks of about ``chunk_size``
+    time. The features of a chunk are calculated by
+    ``get_rolling_features`` on the rows of the chunk and a "halo" of the
+    preceding rows within ``window_size`` of the chunk's first row, i.e.
+    all the rows that the windows of the chunk's rows contain, and the
+    halo rows are dropped afterwards. This way, the rolling window
+    functions only ever see one chunk (plus halo) at a time.
+
+    If possible, a chunk starts at the first row after a gap of at least
+    ``window_size`` (e.g. when the Fitbit wasn't worn) instead of exactly
+    ``chunk_size`` after the previous chunk. Its halo is then empty and
+    pandas restarts its running sums at that row anyway, so the features
+    are exactly the same as those of ``get_rolling_features``.
+
+    Chunks that have to start in the middle of continuous data are not
+    exact: pandas updates the mean and the standard deviation with
+    running sums, whose rounding depends on all rows since the last such
+    gap, and the halo only contains the last ``window_size`` of them.
+    Making these chunks exact would need an unbounded halo, so instead
+    their mean and standard deviation agree with those of
+    ``get_rolling_features`` within ``numpy.allclose(..., rtol=1e-9,
+    atol=1e-9)`` for data of the magnitude of heart rates and step
+    counts (the differences are around 1e-11). For integer data (such as
+    the cleaned data), the mean is exact, as are the minimum, maximum,
+    median and quantiles of any data.
+
+    :param df: pandas dataframe with "Id" as the first index, a datetime
+        second index, and the raw data (e.g. "Steps" or "Value") as the
+        only column. The rows must be sorted by "Id" and then time, and
+        there should only be one participant (as in ``main``).
+    :param measurement: prefix for the feature column names, e.g.
+        "Steps" or "HR"
+    :param window_size: window size used for pandas rolling window
+        functions, e.g. "10min"
+    :param chunk_size: length of the time chunks, e.g. "30D". Longer
+        chunks need more memory, shorter chunks recalculate more halo
+        rows (one ``window_size`` per chunk).
+    :returns: same as ``get_rolling_features``
+    """
+    time = df.index.get_level_values(1).values
+    window = pd.Timedelta(window_size).to_timedelta64()
+    chunk = pd.Timedelta(chunk_size).to_timedelta64()
+    if len(df) == 0 or time[-1] - time[0] < chunk:
+        return get_rolling_features(df, measurement, window_size)
+
+    # first row of each chunk (rows with the same timestamp are always in
+    # the same chunk)
+    num_chunks = int((time[-1] - time[0]) // chunk) + 1
+    bounds = np.r_[
+        np.searchsorted(time, time[0] + chunk * np.arange(num_chunks), side="left"),
+        len(df),
+    ]
+    # move the start of each chunk to the next row after a gap, if there
+    # is one before the next chunk
+    gaps = np.flatnonzero(np.diff(time) >= window) + 1
+    next_gaps = np.searchsorted(gaps, bounds[1:-1])
+    for k, g in enumerate(next_gaps, start=1):
+        if g < len(gaps) and gaps[g] < bounds[k + 1]:
+            bounds[k] = gaps[g]
+
+    features = None
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        if end == start:
+            continue
+        halo_start = np.searchsorted(time, time[start] - window, side="right")
+        chunk_df = get_rolling_features(
+            df.iloc[halo_start:end], measurement, window_size
+        ).iloc[start - halo_start :]
+        if features is None:
+            # allocate the features of all chunks up front
+            feature_cols = chunk_df.columns[df.shape[1] :]
+            features = {col: np.empty(len(df)) for col in feature_cols}
+        for col in feature_cols:
+            features[col][start:end] = chunk_df[col].values
+        del chunk_df
+
+    return df.assign(**features)
+
+
+def get_rolling_features_from_runs(runs_df, window_size, period=step_runs.RUN_PERIOD):
+    """Calculate the rolling window features of run-length encoded steps
+    data
+
+    Within a run of zero steps, the window of every row that lies
+    entirely within the run (i.e. whose window doesn't contain any
+    earlier row) only contains zeros, so its features are known in
+    closed form: all of them are zero, except that the standard
+    deviation is missing for a window with a single row. Only the other
+    rows, i.e. the rows of runs with steps and the first
+    ``window_size`` of each zero run, are decoded (together with the
+    preceding rows within ``window_size``) and passed to
+    ``get_rolling_features``. The work therefore grows with the
+    activity of the participants instead of the elapsed time, apart
+    from filling in the output.
+
+    The features are the same as those of ``get_rolling_features`` on
+    the decoded data (up to the floating point rounding of pandas's
+    running standard deviation, which depends on the rows before each
+    window).
+
+    :param runs_df: pandas dataframe of step runs (see
+        ``step_runs.encode_runs``), sorted by "Id" and time
+    :param window_size: window size used for pandas rolling window
+        functions, e.g. "10min"
+    :param period: time between consecutive rows of a run, defaults to 1
+        minute
+    :returns: same as ``get_rolling_features`` for the decoded steps
+        data (with the measurement "Steps")
+    """
+    if len(runs_df) == 0:
+        return get_rolling_features(
+            step_runs.decode_runs(runs_df, period), "Steps", window_size
         )
 
+    # integer nanoseconds (the output keeps the unit of the runs' time
+    # index, e.g. datetime64[us])
+    time_dtype = runs_df.index.get_level_values(1).dtype
+    window = pd.Timedelta(window_size).to_timedelta64().astype("timedelta64[ns]")
+    window = window.astype(np.int64)
+    period_ns = period.to_timedelta64().astype("timedelta64[ns]").astype(np.int64)
+    # number of rows of a run in a window
+    run_window_rows = int(-(-window // period_ns))
+
+    ids = runs_df.index.get_level_values(0)
+    start = runs_df.index.get_level_values(1).values.astype("datetime64[ns]")
+    start = start.astype(np.int64)
+    length = runs_df["Length"].values.astype(np.int64)
+    zero = runs_df["Steps"].values == 0
+    new_id = np.r_[True, ids[1:] != ids[:-1]]
+
+    # first row of each run whose window only contains rows of the run
+    prev_end = np.r_[0, (start + (length - 1) * period_ns)[:-1]]
+    interior = np.where(
+        new_id, 0, np.clip(-(-(prev_end + window - start) // period_ns), 0, None)
+    )
+    interior = np.where(zero, np.minimum(interior, length), length)
+
+    # rows before the next run (of the same participant) with rows that
+    # aren't interior are needed for the windows of that run
+    id_codes = np.cumsum(new_id)
+    active_runs = np.flatnonzero(interior > 0)
+    next_run = np.searchsorted(active_runs, np.arange(len(runs_df)), side="right")
+    has_next = next_run < len(active_runs)
+    next_run = active_runs[np.minimum(next_run, len(active_runs) - 1)]
+    has_next &= id_codes[next_run] == id_codes
+    halo = np.where(
+        has_next,
+        np.clip((start[next_run] - window - start) // period_ns + 1, 0, length),
+        length,
+    )
+    halo = np.maximum(halo, interior)
+
+    # decode the active rows [0, interior) and the halo rows [halo,
+    # length) of every run
+    seg_run = np.r_[np.arange(len(runs_df)), np.arange(len(runs_df))]
+    seg_first = np.r_[np.zeros(len(runs_df), dtype=np.int64), halo]
+    seg_end = np.r_[interior, length]
+    order = np.argsort(seg_run, kind="stable")
+    seg_run, seg_first, seg_end = seg_run[order], seg_first[order], seg_end[order]
+    seg_length = seg_end - seg_first
+    seg_active = np.r_[
+        np.ones(len(runs_df), dtype=bool), np.zeros(len(runs_df), dtype=bool)
+    ][order]
+
+    rows = np.repeat(np.arange(len(seg_run)), seg_length)
+    offsets = (
+        np.arange(len(rows))
+        - np.repeat(np.cumsum(seg_length) - seg_length, seg_length)
+        + seg_first[rows]
+    )
+    run_rows = seg_run[rows]
+    compute_df = pd.DataFrame(
+        {"Steps": runs_df["Steps"].values[run_rows]},
+        index=pd.MultiIndex.from_arrays(
+            [
+                ids[run_rows],
+                (start[run_rows] + offsets * period_ns)
+                .astype("datetime64[ns]")
+                .astype(time_dtype),
+            ],
+            names=runs_df.index.names,
+        ),
+    )
+    compute_df = get_rolling_features(compute_df, "Steps", window_size)
+    active = seg_active[rows]
+
+    # the decoded features: closed form for the interior rows of zero runs
+    # (the output has one row per minute, so this is the only part that
+    # grows with the elapsed time)
+    steps_df = step_runs.decode_runs(runs_df, period)
+    run_offset = np.cumsum(length) - length
+    positions = run_offset[run_rows[active]] + offsets[active]
+    features = dict()
+    for col in compute_df.columns[1:]:
+        values = np.zeros(len(steps_df))
+        if col == "Steps_std":
+            if run_window_rows == 1:
+                values[:] = np.nan
+            else:
+                values[run_offset[zero & (interior == 0)]] = np.nan
+        values[positions] = compute_df[col].values[active]
+        features[col] = values
+
+    return steps_df.assign(**features)
+
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
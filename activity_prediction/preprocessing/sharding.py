@@ -0,0 +1,402 @@
+import pandas as pd
+import numpy as np
+import subprocess
+import hashlib
+import pickle
+import json
+import click
+import os
+
+try:  # imported as part of the preprocessing package
+    from . import helperfuns
+    from . import step_runs
+    from .metadata import (
+        compute_metadata,
+        get_file_signature,
+        get_metadata_path,
+        read_metadata,
+        save_metadata,
+    )
+except ImportError:  # imported from within the preprocessing directory
+    import helperfuns
+    import step_runs
+    from metadata import (
+        compute_metadata,
+        get_file_signature,
+        get_metadata_path,
+        read_metadata,
+        save_metadata,
+    )
+
+
+@click.group()
+def cli():
+    """Run the preprocessing scripts on shards of the participants
+
+    ``cleaning.py``, ``rolling_features.py``, ``spectrogram_features.py``
+    and ``merging.py`` accept ``--shard i/N``, which only processes the
+    participants whose (md5) hash modulo N is i and saves the outputs
+    with a "_shard-i-of-N" suffix. The shards can run on separate
+    machines (with a shared file system): a script with ``--shard i/N``
+    reads the shard i/N outputs of the previous script (or, with
+    ``--allow_unsharded_inputs``, the unsharded outputs if there are no
+    shard outputs).
+
+    ``reduce`` combines the outputs of all shards into the final
+    dataset, and ``run`` runs all shards of a script as local processes.
+    """
+
+
+@cli.command()
+@click.option("--num_shards", type=int, help="Number of shards (N).")
+@click.option(
+    "--remove_shards/--keep_shards",
+    default=False,
+    help="Flag for whether or not to delete the shard outputs after combining them.",
+)
+@click.argument("paths", nargs=-1)
+def reduce(num_shards, remove_shards, paths):
+    """Combine the outputs of all shards
+
+    PATHS: Space-separated paths of the final (unsharded) pickle files,
+    e.g. "clean_data/steps_minutes_df.pickle". The shard outputs are
+    found next to them (see ``get_shard_path``).
+    """
+    for path in paths:
+        reduce_shards(path, num_shards, remove_shards=remove_shards)
+
+
+@cli.command(context_settings=dict(ignore_unknown_options=True))
+@click.option("--num_shards", type=int, help="Number of shards (N).")
+@click.option(
+    "--reduce",
+    "reduce_paths",
+    multiple=True,
+    help="Path of a final (unsharded) pickle file to combine from the shard outputs once all shards succeeded (see the reduce command). Can be used multiple times.",
+)
+@click.argument("command", nargs=-1, type=click.UNPROCESSED)
+def run(num_shards, reduce_paths, command):
+    """Run all shards of a script as separate local processes
+
+    COMMAND: the command to run, without --shard, e.g. "python
+    rolling_features.py --window_size 10min ...". Each process gets
+    ``--shard i/N`` appended. Use "--" before the command so that its
+    options aren't parsed as options of this command.
+    """
+    processes = [
+        subprocess.Popen([*command, "--shard", f"{i}/{num_shards}"])
+        for i in range(num_shards)
+    ]
+    failed = [i for i, process in enumerate(processes) if process.wait() != 0]
+    if failed:
+        raise click.ClickException(f"The shards {failed} of {num_shards} failed.")
+    print(f"All {num_shards} shards succeeded.")
+
+    for path in reduce_paths:
+        reduce_shards(path, num_shards)
+
+
+def parse_shard(spec):
+    """Parse a shard spec
+
+    :param spec: "i/N" (shard i of N, with 0 <= i < N) or None
+    :returns: a tuple (i, N), or None if ``spec`` is None
+    :raises click.BadParameter: if ``spec`` is malformed
+    """
+    if spec is None:
+        return None
+    try:
+        index, num_shards = [int(x) for x in spec.split("/")]
+    except ValueError:
+        raise click.BadParameter(f"Expected a shard spec i/N, got '{spec}'.")
+    if not 0 <= index < num_shards:
+        raise click.BadParameter(f"Expected 0 <= i < N in the shard spec '{spec}'.")
+    return (index, num_shards)
+
+
+def shard_callback(ctx, param, value):
+    """click callback for ``--shard`` options"""
+    return parse_shard(value)
+
+
+def get_shard_index(participant_id, num_shards):
+    """Shard of a participant
+
+    This uses the md5 hash of the participant ID (unlike Python's
+    ``hash``, it is the same in every process and on every machine).
+    """
+    digest = hashlib.md5(str(participant_id).encode()).hexdigest()
+    return int(digest, 16) % num_shards
+
+
+def select_ids(ids, shard):
+    """The participant IDs in ``ids`` that belong to a shard
+
+    :param ids: iterable of participant IDs
+    :param shard: a tuple (i, N) (see ``parse_shard``), or None for all
+        participants
+    :returns: list of participant IDs, in the order of ``ids``
+    """
+    if shard is None:
+        return list(ids)
+    index, num_shards = shard
+    return [i for i in ids if get_shard_index(i, num_shards) == index]
+
+
+def select_shard(df, shard):
+    """The rows of a dataframe (with "Id" as the first index) that
+    belong to a shard"""
+    if shard is None:
+        return df
+    ids = df.index.get_level_values(0)
+    return df[ids.isin(select_ids(ids.unique(), shard))]
+
+
+def shard_suffix(shard):
+    """Suffix of the outputs of a shard, e.g. "_shard-0-of-4" ("" for
+    None)"""
+    if shard is None:
+        return ""
+    return f"_shard-{shard[0]}-of-{shard[1]}"
+
+
+def get_shard_path(path, shard):
+    """Path of the output of a shard
+
+    :param path: path of the final (unsharded) output, e.g.
+        "clean_data/hr_seconds_df.pickle"
+    :param shard: a tuple (i, N), or None
+    :returns: e.g. "clean_data/hr_seconds_df_shard-0-of-4.pickle", or
+        ``path`` if ``shard`` is None
+    """
+    stem, ext = os.path.splitext(path)
+    return stem + shard_suffix(shard) + ext
+
+
+def get_input_path(path, shard, allow_unsharded=False):
+    """Path of the input of a shard: the output of the same shard of the
+    previous script
+
+    :param path: path of the final (unsharded) input
+    :param shard: a tuple (i, N), or None
+    :param allow_unsharded: whether to fall back to ``path`` if the
+        output of the shard doesn't exist, in which case the script
+        selects the rows of the shard from the whole input. Defaults to
+        False.
+    :returns: path of the input
+    :raises FileNotFoundError: if the output of the shard doesn't exist
+        (and ``allow_unsharded`` is False)
+    """
+    shard_path = get_shard_path(path, shard)
+    if shard is None or os.path.exists(shard_path):
+        return shard_path
+    if not allow_unsharded:
+        raise FileNotFoundError(
+            f"Missing the shard input {shard_path}. Run the previous script with --shard {shard[0]}/{shard[1]}, or pass --allow_unsharded_inputs to read the shard from {path}."
+        )
+    print(f"Reading the shard {shard[0]}/{shard[1]} from the unsharded input {path}.")
+    return path
+
+
+def reduce_shards(path, num_shards, remove_shards=False):
+    """Combine the pickled dataframes of all shards into one
+
+    The result is sorted by participant ID and then time. Its columns
+    are allocated up front (from the row counts and dtypes in the
+    metadata of the shards, see metadata.py) and filled one shard at a
+    time, so only one shard is in memory besides the result. The
+    metadata of the result are combined from those of the shards.
+
+    If every shard was saved with per-participant partitions (see
+    ``helperfuns.save_partitions``) or daily step totals, these are
+    combined as well.
+
+    :param path: path of the final (unsharded) pickle file
+    :param num_shards: number of shards
+    :param remove_shards: whether to delete the shard outputs afterwards,
+        defaults to False
+    :returns: the combined dataframe
+    """
+    shard_paths = [get_shard_path(path, (i, num_shards)) for i in range(num_shards)]
+    missing = [p for p in shard_paths if not os.path.exists(p)]
+    if missing:
+        raise FileNotFoundError(f"Missing shard outputs: {missing}")
+
+    shard_metadata = []
+    for shard_path in shard_paths:
+        metadata = read_metadata(shard_path)
+        if metadata is None or "dtypes" not in metadata:
+            with open(shard_path, "rb") as f:
+                metadata = compute_metadata(pickle.load(f))
+        shard_metadata.append(metadata)
+
+    # rows of each participant in the result, sorted by participant ID
+    participants = dict()
+    for metadata in shard_metadata:
+        overlap = set(participants) & set(metadata["participants"])
+        if overlap:
+            raise ValueError(f"Participants in more than one shard: {overlap}")
+        participants.update(metadata["participants"])
+    ids = sorted(participants)
+    rows = np.array([participants[i]["rows"] for i in ids], dtype=np.int64)
+    offsets = dict(zip(ids, np.r_[0, np.cumsum(rows)[:-1]]))
+    num_rows = int(rows.sum())
+
+    # shards without rows (e.g. without participants) don't contribute
+    # to the columns and dtypes
+    nonempty = [
+        k for k, metadata in enumerate(shard_metadata) if metadata["rows"] > 0
+    ] or [0]
+    first = nonempty[0]
+    columns = shard_metadata[first]["columns"]
+    for k in nonempty:
+        if shard_metadata[k]["columns"] != columns:
+            raise ValueError(
+                f"{shard_paths[k]} has different columns than {shard_paths[first]}."
+            )
+    nonempty = [shard_metadata[k] for k in nonempty]
+    dtypes = [
+        np.result_type(*[_numpy_dtype(m["dtypes"][j]) for m in nonempty])
+        for j in range(len(columns))
+    ]
+    data = [np.empty(num_rows, dtype=dtype) for dtype in dtypes]
+    time = np.empty(
+        num_rows,
+        dtype=np.result_type(*[_numpy_dtype(m["index_dtypes"][1]) for m in nonempty]),
+    )
+
+    print(f"Combining {num_shards} shards of {path}.")
+    for k, shard_path in enumerate(shard_paths):
+        with open(shard_path, "rb") as f:
+            df = pickle.load(f)
+        if not shard_metadata[k]["sorted"]:
+            df = df.sort_index()
+        if k == first:
+            column_labels = df.columns
+            index_names = df.index.names
+            attrs = df.attrs
+
+        # position of every row of the shard in the result
+        shard_ids, starts, counts = np.unique(
+            df.index.get_level_values(0), return_index=True, return_counts=True
+        )
+        positions = np.repeat(
+            np.array([offsets[i] for i in shard_ids], dtype=np.int64) - starts, counts
+        ) + np.arange(len(df))
+        if len(df):
+            time[positions] = df.index.get_level_values(1).values
+            for j in range(len(columns)):
+                data[j][positions] = df.iloc[:, j].values
+        del df
+
+    index = pd.MultiIndex.from_arrays(
+        [np.repeat(np.array(ids, dtype=object), rows), time], names=index_names
+    )
+    combined_df = pd.DataFrame(dict(enumerate(data)), index=index, copy=False)
+    combined_df.columns = column_labels
+    combined_df.attrs.update(attrs)
+
+    with open(path, "wb") as f:
+        pickle.dump(combined_df, f)
+    metadata = dict(
+        shard_metadata[first],
+        sorted=True,
+        deduplicated=all(m["deduplicated"] for m in shard_metadata),
+        rows=num_rows,
+        participants={i: participants[i] for i in ids},
+    )
+    metadata.pop("file", None)
+    save_metadata(combined_df, path, metadata=metadata)
+    print(f"Saved the combined shards to {path}.")
+
+    _reduce_partitions(path, shard_paths, move=remove_shards)
+    _reduce_daily_totals(path, shard_paths)
+    _reduce_step_runs(path, shard_paths)
+
+    if remove_shards:
+        for shard_path in shard_paths:
+            for p in [
+                shard_path,
+                get_metadata_path(shard_path),
+                helperfuns.get_daily_totals_path(shard_path),
+                step_runs.get_runs_path(shard_path),
+            ]:
+                if os.path.exists(p):
+                    os.remove(p)
+
+    return combined_df
+
+
+def _numpy_dtype(name):
+    try:
+        dtype = np.dtype(name)
+    except TypeError:  # pandas extension dtypes, e.g. "category"
+        return np.dtype(object)
+    # strings are stored as Python objects (not fixed-width numpy strings)
+    return np.dtype(object) if dtype.kind in "USO" else dtype
+
+
+def _reduce_partitions(path, shard_paths, move=False):
+    """Combine the partition manifests of all shards (if every shard has
+    partitions)
+
+    The combined manifest refers to the partition files of the shards,
+    unless ``move`` is True, which moves them into the partition
+    directory of the combined dataframe.
+    """
+    manifest_path = os.path.join(helperfuns.get_partition_dir(path), "manifest.json")
+    manifests = [helperfuns.read_manifest(p) for p in shard_paths]
+    if any(manifest is None for manifest in manifests):
+        if os.path.exists(manifest_path):
+            # don't let helperfuns.load_data read outdated partitions
+            os.remove(manifest_path)
+        return
+
+    partition_dir = helperfuns.get_partition_dir(path)
+    os.makedirs(partition_dir, exist_ok=True)
+    files = dict()
+    for shard_path, manifest in zip(shard_paths, manifests):
+        shard_dir = helperfuns.get_partition_dir(shard_path)
+        for participant_id, file_name in manifest["files"].items():
+            file_path = os.path.join(shard_dir, file_name)
+            if move:
+                os.replace(file_path, os.path.join(partition_dir, file_name))
+                files[participant_id] = file_name
+            else:
+                files[participant_id] = os.path.relpath(file_path, partition_dir)
+        if move:
+            os.remove(os.path.join(shard_dir, "manifest.json"))
+            os.rmdir(shard_dir)
+
+    files = {i: files[i] for i in sorted(files)}
+    combined_manifest = dict(
+        manifests[0],
+        participants=list(files),
+        files=files,
+        sorted=all(m["sorted"] for m in manifests),
+        file=get_file_signature(path),
+    )
+    with open(manifest_path, "w") as f:
+        json.dump(combined_manifest, f, indent=2)
+    print(f"Saved the combined partitions to {partition_dir}.")
+
+
+def _reduce_daily_totals(path, shard_paths):
+    """Combine the daily step totals of all shards (if every shard has
+    them)"""
+    daily_totals = [helperfuns.load_daily_step_totals(p) for p in shard_paths]
+    if any(totals is None for totals in daily_totals):
+        return
+    helperfuns.save_daily_step_totals(pd.concat(daily_totals).sort_index(), path)
+
+
+def _reduce_step_runs(path, shard_paths):
+    """Combine the step runs of all shards (if every shard has them)"""
+    runs = [step_runs.load_runs(p) for p in shard_paths]
+    if any(runs_df is None for runs_df in runs):
+        return
+    step_runs.save_runs(pd.concat(runs).sort_index(), path)
+
+
+if __name__ == "__main__":
+    cli()
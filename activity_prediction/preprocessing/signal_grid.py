@@ -0,0 +1,235 @@
+import pandas as pd
+import numpy as np
+from tqdm import tqdm
+import json
+import click
+import os
+
+import helperfuns
+import instrumentation
+
+# raw data columns and the duration that each sample covers: a steps
+# sample counts the steps of a whole minute, a HR sample is a point in
+# time
+COLUMNS = {"Steps": pd.Timedelta("1min"), "Value": pd.Timedelta("0s")}
+
+
+@click.command()
+@click.option(
+    "--cleaned_steps_path",
+    help="Path to the pickle file containing the cleaned Fitabase/Fitbit steps data. These data are a pandas dataframe with 'Id' as the first index, 'ActivityMinute' as the second (datetime) index, and 'Steps' as the only column.",
+)
+@click.option(
+    "--cleaned_hr_path",
+    help="Path to the pickle file containing the cleaned Fitabase/Fitbit heart rate data. These data are a pandas dataframe with 'Id' as the first index, 'Time' as the second (datetime) index, and 'Value' as the only column.",
+)
+@click.option(
+    "--period",
+    default="10s",
+    show_default=True,
+    help="Time between consecutive grid cells. This must use pandas's 'offset alias' syntax (see https://pandas.pydata.org/pandas-docs/stable/user_guide/timeseries.html#offset-aliases).",
+)
+@click.option(
+    "--save_dir",
+    help="Path to the directory for saving the grid (one .npz file per participant and a manifest.json file).",
+)
+@click.option(
+    "--report_path",
+    default=None,
+    help="Optional path for saving a json report with the wall time, CPU time, peak memory and row counts of each step.",
+)
+@click.option(
+    "--strict/--no-strict",
+    default=False,
+    help="Flag for whether or not to verify the saved metadata of the cleaned data (participants, row counts, time ranges, sortedness) against the loaded data instead of trusting them.",
+)
+def main(
+    cleaned_steps_path, cleaned_hr_path, period, save_dir, report_path, strict
+):
+    """Resample the cleaned HR and steps data onto a shared fixed-rate grid
+
+    For every participant, HR and steps are placed on one timeline with
+    a constant time between cells (``--period``), from the first to the
+    last sample of either measurement. The value of a cell is the mean
+    of the samples that fall into it (a steps sample covers its whole
+    minute, so with a period below one minute it fills several cells
+    with the steps of that minute). Cells without samples are NaN and
+    are marked as missing in a boolean gap mask per measurement.
+
+    As in the feature scripts, step data on days without any steps are
+    removed first (see ``helperfuns.remove_zero_daily_steps``).
+
+    The grid is the input of grid_features.py.
+    """
+    steps_df, hr_df = helperfuns.load_data(
+        steps_path=cleaned_steps_path,
+        hr_path=cleaned_hr_path,
+        validate_ids=True,
+        sort=True,
+        sample_num=None,
+        strict=strict,
+    )
+    steps_df = helperfuns.remove_zero_daily_steps(
+        steps_df,
+        daily_totals=helperfuns.load_daily_step_totals(cleaned_steps_path),
+    )
+
+    id_list = list(hr_df.index.get_level_values(0).unique())
+    steps_ids = set(steps_df.index.get_level_values(0))
+
+    os.makedirs(save_dir, exist_ok=True)
+    files = dict()
+    print("Resampling the steps and HR data of each participant onto the grid.")
+    for participant_id in tqdm(id_list):
+        with instrumentation.span("signal_grid", participant=participant_id) as span:
+            grid = build_participant_grid(
+                {
+                    "Steps": steps_df.loc[participant_id]
+                    if participant_id in steps_ids
+                    else steps_df.iloc[:0].droplevel(0),
+                    "Value": hr_df.loc[participant_id],
+                },
+                period=period,
+            )
+            span["rows"] = grid["num_cells"]
+        files[participant_id] = f"{participant_id}.npz"
+        np.savez(os.path.join(save_dir, files[participant_id]), **grid)
+
+    manifest = {
+        "participants": id_list,
+        "files": files,
+        "period": period,
+        "columns": list(COLUMNS),
+    }
+    with open(os.path.join(save_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    print(f"Saved the grid of {len(id_list)} participants to {save_dir}.")
+
+    instrumentation.write_report(report_path)
+
+
+def build_participant_grid(participant_dfs, period):
+    """Resample the data of one participant onto a fixed-rate grid
+
+    :param participant_dfs: dict of raw data column names (keys of
+        ``COLUMNS``) and pandas dataframes of a single participant,
+        indexed by time and containing that column
+    :param period: time between consecutive grid cells, e.g. "10s"
+    :returns: dict of numpy arrays: "start" (timestamp of the first cell
+        in nanoseconds since the epoch), "period" (in nanoseconds),
+        "num_cells", "time_unit" (the unit of the datetime64 index of the
+        data, e.g. "us", see ``grid_time``), and for every column its
+        cell values (NaN where the mask is False) and "<column>_mask"
+    """
+    period_ns = pd.Timedelta(period).value
+    time_unit, _ = np.datetime_data(
+        np.result_type(*[df.index.dtype for df in participant_dfs.values()])
+    )
+    times = {
+        col: df.index.values.astype("datetime64[ns]").astype(np.int64)
+        for col, df in participant_dfs.items()
+    }
+    observed = [t for t in times.values() if len(t) > 0]
+    if observed:
+        start = min(t[0] for t in observed) // period_ns * period_ns
+        end = max(
+            t[-1] + COLUMNS[col].value for col, t in times.items() if len(t) > 0
+        )
+        num_cells = int((end - start) // period_ns) + 1
+    else:
+        start, num_cells = 0, 0
+
+    grid = {
+        "start": np.int64(start),
+        "period": np.int64(period_ns),
+        "num_cells": np.int64(num_cells),
+        "time_unit": np.str_(time_unit),
+    }
+    for col, df in participant_dfs.items():
+        values, mask = _to_grid(
+            times[col],
+            df[col].values.astype(float),
+            start,
+            period_ns,
+            num_cells,
+            COLUMNS[col].value,
+        )
+        grid[col] = values
+        grid[f"{col}_mask"] = mask
+
+    return grid
+
+
+def _to_grid(time, values, start, period, num_cells, duration):
+    """Mean of the samples that cover each cell
+
+    A sample at ``time`` covers the cells from the one containing
+    ``time`` up to (excluding) the one containing ``time + duration``,
+    and at least one cell. Sums and counts are accumulated with
+    difference arrays, so this is linear in the number of samples and
+    cells.
+    """
+    first = (time - start) // period
+    last = np.maximum(first + 1, -(-(time + duration - start) // period))
+    last = np.minimum(last, num_cells)
+
+    sums = np.zeros(num_cells + 1)
+    counts = np.zeros(num_cells + 1)
+    np.add.at(sums, first, values)
+    np.add.at(sums, last, -values)
+    np.add.at(counts, first, 1)
+    np.add.at(counts, last, -1)
+    sums = np.cumsum(sums[:-1])
+    counts = np.round(np.cumsum(counts[:-1]))
+
+    mask = counts > 0
+    with np.errstate(invalid="ignore", divide="ignore"):
+        grid_values = np.where(mask, sums / counts, np.nan)
+
+    return (grid_values, mask)
+
+
+def read_grid_manifest(grid_dir):
+    """Read the manifest of a grid saved by this script
+
+    :returns: dict with the keys "participants", "files", "period" and
+        "columns"
+    """
+    with open(os.path.join(grid_dir, "manifest.json")) as f:
+        return json.load(f)
+
+
+def load_participant_grid(grid_dir, participant_id, manifest=None):
+    """Load the grid of one participant
+
+    :param grid_dir: path to the directory of the grid
+    :param participant_id: participant ID
+    :param manifest: the grid manifest (see ``read_grid_manifest``), if
+        already loaded
+    :returns: dict of numpy arrays (see ``build_participant_grid``)
+    """
+    if manifest is None:
+        manifest = read_grid_manifest(grid_dir)
+    path = os.path.join(grid_dir, manifest["files"][participant_id])
+    with np.load(path) as npz:
+        return {key: npz[key] for key in npz.files}
+
+
+def grid_time(grid):
+    """Timestamps of the cells of a grid
+
+    :param grid: dict of numpy arrays (see ``build_participant_grid``)
+    :returns: numpy datetime64 array in the unit of the data that the
+        grid was built from (e.g. datetime64[us]), so that the grid
+        features can be merged with the labels and other features
+    """
+    time_unit = str(grid["time_unit"]) if "time_unit" in grid else "ns"
+    return (
+        (grid["start"] + grid["period"] * np.arange(grid["num_cells"], dtype=np.int64))
+        .astype("datetime64[ns]")
+        .astype(f"datetime64[{time_unit}]")
+    )
+
+
+if __name__ == "__main__":
+    main()
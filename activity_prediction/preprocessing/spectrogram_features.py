@@ -8,6 +8,10 @@ import os
 from pathlib import Path
 
 import helperfuns
+import instrumentation
+import sharding
+from checkpoints import FeatureCheckpoints, input_signature, load_remaining_data
+from metadata import save_metadata
 
 # majority (99.9996%) sampling rate in Strong-D step data
 STEPS_SAMPLES_PER_SEC = 1 / 60
@@ -36,12 +40,49 @@ HR_SAMPLES_PER_SEC = 1 / 9
     "--save_dir",
     help="Path to the directory for saving the steps and heart rate spectrogram features (as two separate pickle files).",
 )
+@click.option(
+    "--report_path",
+    default=None,
+    help="Optional path for saving a json report with the wall time, CPU time, peak memory and row counts of each step.",
+)
+@click.option(
+    "--checkpoint_dir",
+    default=None,
+    help="Path to the directory for the per-participant checkpoints of the features. Defaults to a 'spectrogram_features_window=<window_size_in_minutes>min_overlap=<overlap>_checkpoints' subdirectory of --save_dir.",
+)
+@click.option(
+    "--resume/--no-resume",
+    default=True,
+    help="Flag for whether or not to skip the participants that were checkpointed by a previous (e.g. interrupted) run with the same parameters and inputs.",
+)
+@click.option(
+    "--strict/--no-strict",
+    default=False,
+    help="Flag for whether or not to verify the saved metadata of the cleaned data (participants, row counts, time ranges, sortedness) against the loaded data instead of trusting them.",
+)
+@click.option(
+    "--shard",
+    default=None,
+    callback=sharding.shard_callback,
+    help="Optional shard spec i/N for only processing the participants of shard i of N (see sharding.py). The shard i/N outputs of cleaning.py are used (see --allow_unsharded_inputs), and the features are saved with a '_shard-i-of-N' suffix.",
+)
+@click.option(
+    "--allow_unsharded_inputs/--no-allow_unsharded_inputs",
+    default=False,
+    help="Flag for whether or not to read the unsharded cleaned data (and select the participants of the shard) if there are no shard i/N outputs of the previous script. Without this flag, a missing shard output is an error.",
+)
 def main(
     cleaned_steps_path,
     cleaned_hr_path,
     window_size_in_minutes,
     overlap,
     save_dir,
+    report_path,
+    checkpoint_dir,
+    resume,
+    strict,
+    shard,
+    allow_unsharded_inputs,
 ):
     """
     Create and save spectrogram features using the cleaned HR (seconds)
@@ -59,22 +100,37 @@ def main(
     paragraph above for ``window_rows``). Otherwise, for --no-overlap,
     ``overlapping_rows = 0``. This corresponds to the ``noverlap``
     parameter in scipy.signal.spectrogram.
+
+    The features of each participant are checkpointed as soon as they
+    are calculated (see checkpoints.py), so an interrupted run can be
+    resumed by running the same command again.
     """
 
-    steps_df, hr_df = helperfuns.load_data(
-        steps_path=cleaned_steps_path,
-        hr_path=cleaned_hr_path,
-        validate_ids=True,
-        sample_num=None,
-        subset_ids=None,
-        sort=True,
+    cleaned_steps_path = sharding.get_input_path(
+        cleaned_steps_path, shard, allow_unsharded=allow_unsharded_inputs
+    )
+    cleaned_hr_path = sharding.get_input_path(
+        cleaned_hr_path, shard, allow_unsharded=allow_unsharded_inputs
+    )
+    if checkpoint_dir is None:
+        checkpoint_dir = os.path.join(
+            save_dir,
+            f"spectrogram_features_window={window_size_in_minutes}min_overlap={overlap}{sharding.shard_suffix(shard)}_checkpoints",
+        )
+    checkpoints = FeatureCheckpoints(
+        checkpoint_dir,
+        params={
+            "window_size_in_minutes": window_size_in_minutes,
+            "overlap": overlap,
+            "inputs": input_signature([cleaned_steps_path, cleaned_hr_path]),
+        },
+        resume=resume,
     )
 
-    id_list = list(steps_df.index.get_level_values(0).unique())
-
-    # Remove all step data on a day if the total number of steps is zero
-    # on that day
-    steps_df = helperfuns.remove_zero_daily_steps(steps_df)
+    # load the participants that aren't checkpointed yet
+    id_list, remaining_ids, steps_df, hr_df = load_remaining_data(
+        checkpoints, cleaned_steps_path, cleaned_hr_path, strict=strict, shard=shard
+    )
 
     # derive the number of observations in the window
     steps_window_rows = int(window_size_in_minutes * 60 * STEPS_SAMPLES_PER_SEC)
@@ -89,49 +145,73 @@ def main(
         hr_overlap = hr_window_rows - 1
 
     print("Creating steps and HR spectrogram features for each participant.")
-    steps_features_dict = dict()
-    hr_features_dict = dict()
-    for participant_id in tqdm(id_list):
-        steps_features_df, _ = get_participant_spectrogram_features(
-            participant_df=steps_df.loc[participant_id],
-            time_delta_threshold=pd.Timedelta("1D"),
-            spectrogram_col="Steps",
-            spectrogram_samples_per_sec=STEPS_SAMPLES_PER_SEC,
-            spectrogram_window_size=steps_window_rows,
-            spectrogram_overlap_size=steps_overlap,
-        )
-        steps_features_dict[participant_id] = steps_features_df
-
-        hr_features_df, _ = get_participant_spectrogram_features(
-            participant_df=hr_df.loc[participant_id],
-            time_delta_threshold=pd.Timedelta("1D"),
-            spectrogram_col="Value",
-            spectrogram_samples_per_sec=HR_SAMPLES_PER_SEC,
-            spectrogram_window_size=hr_window_rows,
-            spectrogram_overlap_size=hr_overlap,
+    for participant_id in tqdm(remaining_ids):
+        with instrumentation.span(
+            "spectrogram_features", participant=participant_id, measurement="Steps"
+        ) as span:
+            steps_features_df, _ = get_participant_spectrogram_features(
+                participant_df=steps_df.loc[participant_id],
+                time_delta_threshold=pd.Timedelta("1D"),
+                spectrogram_col="Steps",
+                spectrogram_samples_per_sec=STEPS_SAMPLES_PER_SEC,
+                spectrogram_window_size=steps_window_rows,
+                spectrogram_overlap_size=steps_overlap,
+                check_sorted=strict,
+            )
+            span["rows"] = len(steps_features_df)
+
+        with instrumentation.span(
+            "spectrogram_features", participant=participant_id, measurement="HR"
+        ) as span:
+            hr_features_df, _ = get_participant_spectrogram_features(
+                participant_df=hr_df.loc[participant_id],
+                time_delta_threshold=pd.Timedelta("1D"),
+                spectrogram_col="Value",
+                spectrogram_samples_per_sec=HR_SAMPLES_PER_SEC,
+                spectrogram_window_size=hr_window_rows,
+                spectrogram_overlap_size=hr_overlap,
+                check_sorted=strict,
+            )
+            span["rows"] = len(hr_features_df)
+        checkpoints.save(
+            participant_id, {"steps": steps_features_df, "hr": hr_features_df}
         )
-        hr_features_dict[participant_id] = hr_features_df
 
-    # concatenate all participants' features
-    all_steps_features_df = pd.concat(steps_features_dict).rename_axis(["Id", "Time"])
-    all_hr_features_df = pd.concat(hr_features_dict).rename_axis(["Id", "Time"])
+    # combine all participants' features
+    all_steps_features_df = checkpoints.assemble(
+        "steps", id_list, index_names=["Id", "Time"], input_path=cleaned_steps_path
+    )
 
-    steps_save_path = os.path.join(
-        save_dir,
-        f"steps_spectrogram_features_df_window={window_size_in_minutes}min_overlap={overlap}.pickle",
+    steps_save_path = sharding.get_shard_path(
+        os.path.join(
+            save_dir,
+            f"steps_spectrogram_features_df_window={window_size_in_minutes}min_overlap={overlap}.pickle",
+        ),
+        shard,
     )
     with open(steps_save_path, "wb") as f:
         pickle.dump(all_steps_features_df, f)
+    save_metadata(all_steps_features_df, steps_save_path)
     print(f"Saved steps spectrogram features to {steps_save_path}.")
 
-    hr_save_path = os.path.join(
-        save_dir,
-        f"hr_spectrogram_features_df_window={window_size_in_minutes}min_overlap={overlap}.pickle",
+    all_hr_features_df = checkpoints.assemble(
+        "hr", id_list, index_names=["Id", "Time"], input_path=cleaned_hr_path
+    )
+
+    hr_save_path = sharding.get_shard_path(
+        os.path.join(
+            save_dir,
+            f"hr_spectrogram_features_df_window={window_size_in_minutes}min_overlap={overlap}.pickle",
+        ),
+        shard,
     )
     with open(hr_save_path, "wb") as f:
         pickle.dump(all_hr_features_df, f)
+    save_metadata(all_hr_features_df, hr_save_path)
     print(f"Saved HR spectrogram features to {hr_save_path}.")
 
+    instrumentation.write_report(report_path)
+
     return (all_steps_features_df, all_hr_features_df)
 
 
@@ -142,6 +222,7 @@ def get_participant_spectrogram_features(
     spectrogram_samples_per_sec,
     spectrogram_window_size,
     spectrogram_overlap_size,
+    check_sorted=True,
 ):
     """Get spectrogram features for a single participant.
 
@@ -200,6 +281,10 @@ def get_participant_spectrogram_features(
         between consecutive windowed Fourier transforms within the
         spectrogram. This corresponds to the ``noverlap`` parameter in
         scipy.signal.spectrogram.
+    :param check_sorted: whether to check that ``participant_df`` is
+        sorted on its index. Defaults to True. ``main`` skips this check
+        (unless --strict) because helperfuns.load_data already
+        guarantees sorted data.
     :returns: a tuple ``(features_df, spectrograms)``. ``spectrograms`` 
         is a pandas series containing >=1 spectrograms (see the
         ``time_delta_threshold`` parameter to understand how there can
@@ -211,7 +296,8 @@ def get_participant_spectrogram_features(
     """
 
     # assert that the dataframe is sorted on its index (time)
-    assert all(participant_df.index == participant_df.index.sort_values())
+    if check_sorted:
+        assert participant_df.index.is_monotonic_increasing
 
     # find the time deltas between consecutive time stamps
     participant_df["time"] = participant_df.index
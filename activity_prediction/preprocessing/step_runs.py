@@ -0,0 +1,177 @@
+import pandas as pd
+import numpy as np
+import pickle
+import os
+
+try:  # imported as part of the preprocessing package
+    from .metadata import get_file_signature
+except ImportError:  # imported from within the preprocessing directory
+    from metadata import get_file_signature
+
+# time between consecutive rows of the cleaned steps data
+RUN_PERIOD = pd.Timedelta("1min")
+
+
+def get_runs_path(steps_path):
+    """Path of the step runs saved next to the cleaned steps data
+
+    :param steps_path: path to the pickle file of the cleaned steps data
+    :returns: path to the pickle file of the run-length encoded steps
+        (see ``encode_runs``)
+    """
+    return os.path.splitext(steps_path)[0] + "_runs.pickle"
+
+
+def save_runs(runs_df, steps_path):
+    """Save the step runs next to the cleaned steps data
+
+    The size and modification time of the steps pickle file (which must
+    already be saved) are saved with the runs, so that ``load_runs``
+    ignores the runs once the steps data are replaced.
+
+    :param runs_df: pandas dataframe (see ``encode_runs``)
+    :param steps_path: path to the pickle file of the cleaned steps data
+    """
+    with open(get_runs_path(steps_path), "wb") as f:
+        pickle.dump({"file": get_file_signature(steps_path), "runs": runs_df}, f)
+
+
+def load_runs(steps_path, ids=None):
+    """Load the step runs saved next to the cleaned steps data
+
+    :param steps_path: path to the pickle file of the cleaned steps data
+    :param ids: optional list of participant IDs to keep. Defaults to
+        None, which keeps all participants.
+    :returns: pandas dataframe (see ``encode_runs``), or None if the runs
+        weren't saved or if the steps data changed after they were saved
+    """
+    runs_path = get_runs_path(steps_path)
+    if not (os.path.exists(runs_path) and os.path.exists(steps_path)):
+        return None
+    with open(runs_path, "rb") as f:
+        saved = pickle.load(f)
+
+    if not isinstance(saved, dict) or saved["file"] != get_file_signature(steps_path):
+        print(f"Ignoring the stale step runs of {steps_path}.")
+        return None
+    runs_df = saved["runs"]
+    if ids is not None:
+        runs_df = runs_df[runs_df.index.get_level_values(0).isin(ids)]
+    return runs_df
+
+
+def encode_runs(steps_df, period=RUN_PERIOD):
+    """Run-length encode minute-level steps data
+
+    A run is a maximal sequence of rows of the same participant and day
+    with the same step count, each ``period`` after the previous one.
+    Because most minutes have zero steps, the number of runs grows with
+    the (active) minutes with steps rather than with the elapsed time.
+    Runs never span midnight, so every day can be summed up or dropped
+    as a whole (see ``get_daily_step_totals`` and
+    ``remove_zero_daily_steps``).
+
+    :param steps_df: pandas dataframe with a "Steps" column, indexed by
+        "Id" and "ActivityMinute" and sorted by both (as saved by
+        cleaning.py)
+    :param period: time between consecutive rows of a run, defaults to 1
+        minute
+    :returns: pandas dataframe indexed by "Id" and "ActivityMinute" (the
+        first minute of each run) with the columns "Steps" (the step
+        count of every minute of the run) and "Length" (number of
+        minutes)
+    """
+    ids = steps_df.index.get_level_values(0)
+    time = steps_df.index.get_level_values(1).values
+    steps = steps_df["Steps"].values
+
+    starts = np.ones(len(steps_df), dtype=bool)
+    starts[1:] = (
+        (ids[1:] != ids[:-1])
+        | (steps[1:] != steps[:-1])
+        | (np.diff(time) != period.to_timedelta64())
+        | (time[1:].astype("datetime64[D]") != time[:-1].astype("datetime64[D]"))
+    )
+    first_rows = np.flatnonzero(starts)
+
+    return pd.DataFrame(
+        {
+            "Steps": steps[first_rows],
+            "Length": np.diff(np.r_[first_rows, len(steps_df)]),
+        },
+        index=steps_df.index[first_rows],
+    )
+
+
+def decode_runs(runs_df, period=RUN_PERIOD):
+    """Expand run-length encoded steps data into one row per minute
+
+    :param runs_df: pandas dataframe (see ``encode_runs``)
+    :param period: time between consecutive rows of a run, defaults to 1
+        minute
+    :returns: pandas dataframe with a "Steps" column, indexed by "Id"
+        and "ActivityMinute", as it was before ``encode_runs``
+    """
+    lengths = runs_df["Length"].values
+    run_rows = np.repeat(np.arange(len(runs_df)), lengths)
+    offsets = np.arange(len(run_rows)) - np.repeat(
+        np.cumsum(lengths) - lengths, lengths
+    )
+    # keep the unit of the time index (e.g. datetime64[us])
+    start = runs_df.index.get_level_values(1).values
+    time = (start[run_rows] + offsets * period.to_timedelta64()).astype(start.dtype)
+
+    return pd.DataFrame(
+        {"Steps": runs_df["Steps"].values[run_rows]},
+        index=pd.MultiIndex.from_arrays(
+            [runs_df.index.get_level_values(0)[run_rows], time],
+            names=runs_df.index.names,
+        ),
+    )
+
+
+def get_daily_step_totals(runs_df):
+    """Calculate the total number of steps per participant and day from
+    the runs
+
+    This takes one multiplication per run, so long runs of zero steps
+    cost as much as a single minute.
+
+    :param runs_df: pandas dataframe (see ``encode_runs``)
+    :returns: pandas series of daily step totals indexed by "Id" and
+        "date" (datetime64 days), like
+        ``helperfuns.get_daily_step_totals`` of the decoded data
+    """
+    days = runs_df.index.get_level_values(1).values.astype("datetime64[D]")
+    totals = pd.Series(
+        (runs_df["Steps"].values * runs_df["Length"].values).astype(float),
+        index=pd.MultiIndex.from_arrays(
+            [runs_df.index.get_level_values(0), days], names=["Id", "date"]
+        ),
+        name="Steps",
+    )
+    return totals.groupby(level=[0, 1], sort=False).sum()
+
+
+def remove_zero_daily_steps(runs_df):
+    """Remove the runs on days with zero steps in total (see
+    ``helperfuns.remove_zero_daily_steps``)
+
+    :param runs_df: pandas dataframe (see ``encode_runs``)
+    :returns: pandas dataframe of the remaining runs
+    """
+    print(
+        "Removing all step data on a day if the total number of steps is zero on that day."
+    )
+    codes = pd.factorize(
+        pd.MultiIndex.from_arrays(
+            [
+                runs_df.index.get_level_values(0),
+                runs_df.index.get_level_values(1).values.astype("datetime64[D]"),
+            ]
+        )
+    )[0]
+    totals = np.bincount(
+        codes, weights=runs_df["Steps"].values * runs_df["Length"].values
+    )
+    return runs_df[totals[codes] > 0]
@@ -0,0 +1,192 @@
+import pandas as pd
+import numpy as np
+import pickle
+import time
+import click
+
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.model_selection import GroupKFold
+from sklearn.model_selection import cross_validate
+
+
+@click.command()
+@click.option(
+    "--method",
+    type=click.Choice(["stride", "similarity"]),
+    default="stride",
+    help="How to thin the rows within each (participant, label) stratum. 'stride' keeps the first row in every ``--stride`` amount of time. 'similarity' keeps only one row out of every group of rows whose feature vectors are (nearly) identical (see ``--resolution``).",
+)
+@click.option(
+    "--stride",
+    default="1min",
+    help="Time stride used by the 'stride' method. This must use pandas's 'offset alias' syntax (see https://pandas.pydata.org/pandas-docs/stable/user_guide/timeseries.html#offset-aliases), e.g. '1min'.",
+)
+@click.option(
+    "--resolution",
+    default=0.05,
+    type=float,
+    help="Resolution used by the 'similarity' method, as a fraction of each feature column's standard deviation. Two rows (of the same participant and label) are considered redundant if all of their features fall into the same bins of this width.",
+)
+@click.option(
+    "--report/--no-report",
+    default=False,
+    help="Flag for whether or not to report the speed vs. accuracy trade-off of the subsampling by fitting a small random forest (with grouped cross-validation) on both the full and the subsampled rows.",
+)
+@click.argument("merged_features_path", nargs=1)
+@click.argument("save_path", nargs=1)
+def main(method, stride, resolution, report, merged_features_path, save_path):
+    """Reduce the number of (redundant) rows in a merged training set
+
+    Rolling window features are calculated on every raw observation, so
+    consecutive rows come from heavily overlapping windows and are
+    nearly identical. This script thins these rows separately for each
+    participant and each label (i.e. stratified by "Id" and "Arm"), so
+    that every participant keeps rows for every label that it has.
+
+    MERGED_FEATURES_PATH: Path to the pickle file containing the merged
+    features and labels (see merging.py).
+
+    SAVE_PATH: Path for saving the subsampled features and labels as a
+    pickle file.
+    """
+    with open(merged_features_path, "rb") as f:
+        merged = pickle.load(f)
+
+    start_nrows = merged.shape[0]
+    print(f"The merged feature file contains {start_nrows} rows.")
+
+    if method == "stride":
+        subsampled = stride_subsample(merged, stride=stride)
+    else:
+        subsampled = similarity_subsample(merged, resolution=resolution)
+
+    end_nrows = subsampled.shape[0]
+    print(
+        f"After subsampling (method={method}), the resulting dataframe contains {end_nrows} ({np.round(end_nrows/start_nrows*100, 2)}% of the starting number of rows)."
+    )
+    print("Number of rows per label before vs. after subsampling:")
+    print(
+        pd.DataFrame(
+            {
+                "before": merged["Arm"].value_counts(),
+                "after": subsampled["Arm"].value_counts(),
+            }
+        )
+    )
+
+    if report:
+        print("Reporting the speed vs. accuracy trade-off of the subsampling.")
+        print(report_tradeoff(merged, subsampled))
+
+    with open(save_path, "wb") as f:
+        pickle.dump(subsampled, f)
+    print(f"Saved the subsampled features and labels to {save_path}.")
+
+
+def stride_subsample(df, stride, datetime_index="Time", id_index="Id", label_col="Arm"):
+    """Keep only the first row in every ``stride`` amount of time for
+    each participant and label
+
+    :param df: pandas dataframe with the indices (``id_index``,
+        ``datetime_index``) and a ``label_col`` column, e.g. the output
+        of merging.py.
+    :param stride: pandas offset alias (e.g. "1min") or pandas.Timedelta
+        that determines the time buckets. Each (participant, label)
+        stratum keeps at most one row per time bucket.
+    :param datetime_index: name of the datetime index, defaults to
+        "Time"
+    :param id_index: name of the participant ID index, defaults to "Id"
+    :param label_col: name of the label column, defaults to "Arm"
+    :returns: pandas dataframe containing a subset of the rows in
+        ``df`` (in the same order)
+    """
+    keys = pd.DataFrame(
+        {
+            id_index: df.index.get_level_values(id_index),
+            label_col: df[label_col].values,
+            "bucket": df.index.get_level_values(datetime_index).floor(stride),
+        }
+    )
+    return df[~keys.duplicated().values]
+
+
+def similarity_subsample(df, resolution, id_index="Id", label_col="Arm"):
+    """Keep only one row out of every group of rows (of the same
+    participant and label) with nearly identical feature vectors
+
+    Each feature column is binned into bins of width ``resolution *
+    <standard deviation of the column>``, and only the first row is
+    kept for each distinct combination of participant, label and binned
+    feature values.
+
+    :param df: pandas dataframe with an ``id_index`` index, a
+        ``label_col`` column and numeric feature columns, e.g. the
+        output of merging.py.
+    :param resolution: bin width as a fraction of each feature column's
+        standard deviation. Larger values remove more rows.
+    :param id_index: name of the participant ID index, defaults to "Id"
+    :param label_col: name of the label column, defaults to "Arm"
+    :returns: pandas dataframe containing a subset of the rows in
+        ``df`` (in the same order)
+    """
+    features = df.drop(label_col, axis=1).select_dtypes(include="number")
+    scale = features.std().replace(0, 1).fillna(1).values * resolution
+    keys = pd.DataFrame(np.floor(features.values / scale), columns=features.columns)
+    keys[id_index] = df.index.get_level_values(id_index)
+    keys[label_col] = df[label_col].values
+    return df[~keys.duplicated().values]
+
+
+def report_tradeoff(full_df, subsampled_df, n_splits=5, n_estimators=100):
+    """Compare the fit time and F1 score of a random forest trained on
+    the full vs. the subsampled rows
+
+    Both random forests are scored with grouped (by participant)
+    cross-validation, and the validation folds always use the *full*
+    rows, so that the scores are directly comparable.
+
+    :param full_df: merged features and labels before subsampling
+    :param subsampled_df: merged features and labels after subsampling
+    :param n_splits: number of grouped cross-validation splits, defaults
+        to 5
+    :param n_estimators: number of trees in the random forests, defaults
+        to 100
+    :returns: pandas dataframe with one row per training set ("full"
+        and "subsampled") and the number of rows, the mean fit time (in
+        seconds) and the mean f1-macro validation score as columns
+    """
+    full_df = full_df.drop(["Steps", "Value"], axis=1, errors="ignore").dropna()
+    X = full_df.drop("Arm", axis=1)
+    y = full_df["Arm"]
+    groups = X.index.get_level_values(0)
+    n_splits = min(n_splits, groups.nunique())
+    kept = X.index.isin(subsampled_df.index)
+
+    rows = dict()
+    for name, train_mask in [
+        ("full", np.ones(len(X), dtype=bool)),
+        ("subsampled", kept),
+    ]:
+        # restrict the training folds to the training set, but validate
+        # on all rows
+        cv = [
+            (train[train_mask[train]], test)
+            for train, test in GroupKFold(n_splits=n_splits).split(X, y, groups)
+        ]
+        rf = RandomForestClassifier(
+            n_estimators=n_estimators, n_jobs=-1, random_state=0
+        )
+        start = time.perf_counter()
+        scores = cross_validate(rf, X, y, cv=cv, scoring="f1_macro")
+        rows[name] = {
+            "rows": int(train_mask.sum()),
+            "fit_time": scores["fit_time"].mean(),
+            "f1_macro": scores["test_score"].mean(),
+            "total_time": time.perf_counter() - start,
+        }
+
+    return pd.DataFrame.from_dict(rows, orient="index")
+
+
+if __name__ == "__main__":
+    main()
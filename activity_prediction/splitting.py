@@ -2,80 +2,140 @@ import pandas as pd
 import pickle
 import random
 import json
+import os
+import click
 
-random.seed(0)
-
-from preprocessing import helperfuns
 from preprocessing import merging
 
 CLEANED_STEPS_PATH = "preprocessing/clean_data/steps_minutes_df.pickle"
-CLEANED_HR_PATH = "preprocessing/clean_data/hr_seconds_df.pickle"
+LABELS_PATH = "preprocessing/clean_data/labels_df.pickle"
+# per-participant label coverage, derived from the cleaned steps data and
+# labels (see ``get_label_coverage``)
+COVERAGE_PATH = "preprocessing/clean_data/label_coverage.csv"
 TEST_PARTICIPANT_RATIO = 0.2
 SAVE_FILE = "train_test_participants.json"
-
-
-def main():
+SPLITS_FILE = "train_test_splits.json"
+
+
+@click.command()
+@click.option(
+    "--seed",
+    default=0,
+    type=int,
+    help="Random seed of the split saved in SAVE_FILE.",
+)
+@click.option(
+    "--num_splits",
+    default=1,
+    type=int,
+    help="Number of splits to generate (with the seeds seed, seed + 1, ...). If this is more than 1, all splits are also saved as a list in SPLITS_FILE, e.g. for studying the variance of the test scores across splits.",
+)
+@click.option(
+    "--refresh_coverage/--no-refresh_coverage",
+    default=False,
+    help="Flag for whether or not to recompute the label coverage summary even if it is up to date.",
+)
+def main(seed, num_splits, refresh_coverage):
     """Perform participant-conscious train-test split
-    
+
     1. Remove participants whose step data doesn't merge with any labels
        (aerobic, strength, or combined)
     2. Remove participants in the "combined" arm
     3. Split the participants into training (80%) and testing (20%)
        groups
     4. Save as a json file specified by ``SAVE_FILE``
-    
-    """
 
-    steps_df, hr_df = helperfuns.load_data(
-        steps_path=CLEANED_STEPS_PATH,
-        hr_path=CLEANED_HR_PATH,
-        validate_ids=True,
-        sample_num=None,
-        subset_ids=None,
-        sort=False,
-    )
-
-    steps_df.index.rename(["Id", "Time"], inplace=True)
-
-    # for each row in steps_df, match labels that occur within 1hr
-    # before the row's timestamp
-    merged = merging.merge_labels(
-        steps_df, labels_path="preprocessing/clean_data/labels_df.pickle",
-    )
-
-    all_participants = set(merged.index.get_level_values(0).unique())
-
-    # find participants without any arm (strength/aerobic/combined)
-    # labels, i.e. they only have the "other" label
-    unique_labels = merged.groupby(level="Id")["Arm"].apply(lambda x: set(x.unique()))
-    no_arms_participants = set(unique_labels[unique_labels == {"other"}].index)
-
-    # find participants in the "combined" arm
-    combined_participants = set(
-        merged[merged["Arm"] == "combined"].index.get_level_values(0).unique()
-    )
-
-    # only keep participants that have labels and that are *not* in the
-    # "combined" arm
-    keep_participants = list(
-        all_participants - no_arms_participants - combined_participants
-    )
-    keep_participants.sort()  # so that the random seed will reproduce the same splits
-    num_participants = len(keep_participants)
-
-    # separate train vs test participants
-    test_num = int(num_participants * TEST_PARTICIPANT_RATIO)
-    split_dict = dict()
-    split_dict["test"] = random.sample(keep_participants, test_num)
-    split_dict["train"] = list(set(keep_participants) - set(split_dict["test"]))
-    split_dict["test"].sort()
-    split_dict["train"].sort()
+    Steps 1 and 2 only need the number of steps rows per participant
+    and label, which are computed once and saved in ``COVERAGE_PATH``
+    (see ``get_label_coverage``), so the split itself runs in seconds.
+    """
+    coverage_df = get_label_coverage(refresh=refresh_coverage)
+    keep_participants = get_eligible_participants(coverage_df)
+
+    splits = [
+        split_participants(keep_participants, TEST_PARTICIPANT_RATIO, s)
+        for s in range(seed, seed + num_splits)
+    ]
+    if not splits[0]["test"]:
+        print(
+            f"Warning: the test split is empty, since there are only {len(keep_participants)} eligible participants (evaluation.py needs test participants)."
+        )
 
     # save as json file
     with open(SAVE_FILE, "w") as f:
-        json.dump(split_dict, f)
+        json.dump(splits[0], f)
     print(f"Saved the participant train-test split to {SAVE_FILE}.")
 
+    if num_splits > 1:
+        with open(SPLITS_FILE, "w") as f:
+            seeds = range(seed, seed + num_splits)
+            json.dump([dict(seed=s, **split) for s, split in zip(seeds, splits)], f)
+        print(f"Saved {num_splits} participant train-test splits to {SPLITS_FILE}.")
+
+
+def get_label_coverage(refresh=False):
+    """Load the per-participant label coverage summary, (re)computing it
+    if it is missing or older than the cleaned steps data or labels
+
+    For each participant, the summary contains the number of steps rows
+    that ``merging.merge_labels`` matches with each label (each arm and
+    "other"). It is computed from the steps data only (see
+    ``merging.get_label_coverage``).
+
+    :param refresh: whether to recompute the summary regardless,
+        defaults to False
+    :returns: pandas dataframe indexed by "Id"
+    """
+    up_to_date = os.path.exists(COVERAGE_PATH) and os.path.getmtime(
+        COVERAGE_PATH
+    ) >= max(os.path.getmtime(CLEANED_STEPS_PATH), os.path.getmtime(LABELS_PATH))
+    if up_to_date and not refresh:
+        return pd.read_csv(COVERAGE_PATH, index_col="Id", dtype={"Id": str})
+
+    print("Computing the label coverage of each participant.")
+    with open(CLEANED_STEPS_PATH, "rb") as f:
+        steps_df = pickle.load(f)
+    with open(LABELS_PATH, "rb") as f:
+        labels_df = pickle.load(f)
+
+    # match labels that occur within 1hr before each row's timestamp
+    coverage_df = merging.get_label_coverage(steps_df, labels_df)
+    coverage_df.to_csv(COVERAGE_PATH)
+    print(f"Saved the label coverage summary to {COVERAGE_PATH}.")
+
+    return coverage_df
+
+
+def get_eligible_participants(coverage_df):
+    """Participants whose step data merge with any arm (strength,
+    aerobic or combined) labels and who are *not* in the "combined" arm
+
+    :param coverage_df: label coverage summary (see
+        ``get_label_coverage``)
+    :returns: sorted list of participant IDs
+    """
+    arms = [c for c in coverage_df.columns if c not in ["Rows", "Labels", "other"]]
+    has_arms = coverage_df[arms].sum(axis=1) > 0
+    combined = coverage_df.get("combined", 0) > 0
+    # sorted so that the random seed will reproduce the same splits
+    return sorted(coverage_df.index[has_arms & ~combined])
+
+
+def split_participants(participants, test_ratio, seed):
+    """Randomly split participants into training and testing groups
+
+    :param participants: sorted list of participant IDs
+    :param test_ratio: ratio of the participants in the testing group
+    :param seed: random seed
+    :returns: dict with the sorted "test" and "train" participant IDs
+    """
+    test_num = int(len(participants) * test_ratio)
+    test = random.Random(seed).sample(participants, test_num)
+    return {
+        "test": sorted(test),
+        "train": sorted(set(participants) - set(test)),
+    }
+
 
 if __name__ == "__main__":
     main()
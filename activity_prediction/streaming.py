@@ -0,0 +1,298 @@
+import pandas as pd
+import numpy as np
+import socket
+import time
+import csv
+import sys
+import os
+import click
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "preprocessing")
+)
+
+from online_features import OnlineRollingFeatures, OnlineSpectrogramFeatures
+from spectrogram_features import STEPS_SAMPLES_PER_SEC, HR_SAMPLES_PER_SEC
+from predict import load_estimator
+
+# event types and the corresponding raw data column names
+EVENT_TYPES = {"hr": "Value", "steps": "Steps"}
+
+
+@click.group()
+def cli():
+    """Near-real-time activity classification over HR and steps events
+
+    Events are csv lines with the fields ``Id,Time,Type,Value``, where
+    ``Type`` is "hr" or "steps" and ``Time`` is parseable by pandas.
+    Events of the same participant must arrive in time order.
+    """
+
+
+@cli.command()
+@click.option(
+    "--model_path",
+    help="Path to the grid search pickle saved by training.py, or to a random forest exported by exporting.py (recommended, since it predicts single rows much faster).",
+)
+@click.option(
+    "--events_path",
+    default=None,
+    help="Path to a csv file of events (with a header). Use either this or --port.",
+)
+@click.option(
+    "--port",
+    default=None,
+    type=int,
+    help="Port on localhost to listen on for events (one csv line per event, without a header), e.g. sent by the 'replay' command.",
+)
+@click.option(
+    "--save_path", help="Path for saving the emitted classifications as a csv file."
+)
+@click.option(
+    "--window_size",
+    default="10min",
+    help="Window size of the rolling window features (see preprocessing/rolling_features.py).",
+)
+@click.option(
+    "--window_size_in_minutes",
+    default=10,
+    type=int,
+    help="Window size of the spectrogram features (see preprocessing/spectrogram_features.py).",
+)
+@click.option(
+    "--latency_target_ms",
+    default=10.0,
+    type=float,
+    help="Per-event latency target in milliseconds. The number of events that exceed it is reported at the end.",
+)
+@click.option(
+    "--tolerance",
+    default="1min",
+    help="Maximum age of the latest features of the other measurement (HR or steps) for classifying an event, like the tolerance of preprocessing/merging.py. This must use pandas's 'offset alias' syntax (see https://pandas.pydata.org/pandas-docs/stable/user_guide/timeseries.html#offset-aliases), e.g. '1min'.",
+)
+def classify(
+    model_path,
+    events_path,
+    port,
+    save_path,
+    window_size,
+    window_size_in_minutes,
+    latency_target_ms,
+    tolerance,
+):
+    """Classify a stream of events and save the classifications"""
+    classifier = StreamingClassifier(
+        estimator=load_estimator(model_path),
+        window_size=window_size,
+        window_size_in_minutes=window_size_in_minutes,
+        tolerance=tolerance,
+    )
+
+    lines = read_events(events_path) if events_path else listen(port)
+
+    latencies = []
+    with open(save_path, "w", newline="") as f:
+        writer = None
+        for line in lines:
+            if not line.strip():
+                continue
+            participant_id, timestamp, event_type, value = line.strip().split(",")
+            start = time.perf_counter()
+            result = classifier.process(
+                participant_id, pd.Timestamp(timestamp), event_type, float(value)
+            )
+            latencies.append(time.perf_counter() - start)
+
+            if result is None:
+                continue
+            if writer is None:
+                writer = csv.DictWriter(f, fieldnames=list(result.keys()))
+                writer.writeheader()
+            writer.writerow(result)
+
+    print(f"Saved the classifications to {save_path}.")
+    print(latency_summary(np.array(latencies) * 1000, latency_target_ms))
+
+
+@cli.command()
+@click.option("--events_path", help="Path to a csv file of events (with a header).")
+@click.option("--port", type=int, help="Port on localhost to send the events to.")
+@click.option(
+    "--speedup",
+    default=0.0,
+    type=float,
+    help="Replay speed relative to the event timestamps, e.g. 60 replays one hour of events per minute. Defaults to 0, which sends the events as fast as possible.",
+)
+def replay(events_path, port, speedup):
+    """Replay a csv file of events over a socket (for testing)"""
+    with open(events_path) as f, socket.create_connection(("localhost", port)) as s:
+        next(f)  # skip the header
+        first_time = None
+        start = time.perf_counter()
+        for line in f:
+            if speedup > 0:
+                event_time = pd.Timestamp(line.split(",")[1])
+                first_time = first_time or event_time
+                delay = (event_time - first_time).total_seconds() / speedup
+                time.sleep(max(0.0, delay - (time.perf_counter() - start)))
+            s.sendall(line.encode())
+
+
+def read_events(events_path):
+    """Yield the lines of a csv file of events (without the header)"""
+    with open(events_path) as f:
+        next(f)  # skip the header
+        yield from f
+
+
+def listen(port):
+    """Accept one connection on localhost and yield the received lines"""
+    with socket.create_server(("localhost", port)) as server:
+        print(f"Listening for events on port {port}.")
+        connection, _ = server.accept()
+        with connection, connection.makefile() as lines:
+            yield from lines
+
+
+class StreamingClassifier:
+    """Maintain online features per participant and classify each event
+
+    For every participant, this keeps the same rolling window features
+    (see rolling_features.py) and spectrogram features (see
+    spectrogram_features.py) as the batch scripts, for both HR and
+    steps, and combines the latest HR and steps features into one row
+    like merging.py. Each event updates the features of its measurement,
+    and once every feature used by the estimator is available, the
+    combined row is classified. As in merging.py, the features of the
+    other measurement are only used if its latest event is at most
+    ``tolerance`` older than the current event, so no row is classified
+    with the features of e.g. a HR stream that stopped.
+
+    Note that the batch step features are calculated after removing days
+    with zero total steps (see ``helperfuns.remove_zero_daily_steps``),
+    which can't be known before the end of the day and is therefore not
+    applied here.
+    """
+
+    def __init__(
+        self,
+        estimator,
+        window_size="10min",
+        window_size_in_minutes=10,
+        tolerance="1min",
+    ):
+        """
+        :param estimator: fitted classifier (e.g. the best estimator of
+            a grid search or an exporting.CompactForest) with the
+            attributes ``feature_names_in_`` and ``classes_``
+        :param window_size: window size of the rolling window features,
+            defaults to "10min"
+        :param window_size_in_minutes: window size of the spectrogram
+            features, defaults to 10
+        :param tolerance: maximum age of the latest features of the
+            other measurement, defaults to "1min" (like merging.py)
+        """
+        self.estimator = estimator
+        self.tolerance = pd.Timedelta(tolerance)
+        self.feature_names = list(estimator.feature_names_in_)
+        self.classes = list(estimator.classes_)
+        self.window_size = window_size
+        self.spectrogram_rows = {
+            "hr": int(window_size_in_minutes * 60 * HR_SAMPLES_PER_SEC),
+            "steps": int(window_size_in_minutes * 60 * STEPS_SAMPLES_PER_SEC),
+        }
+        self.samples_per_sec = {
+            "hr": HR_SAMPLES_PER_SEC,
+            "steps": STEPS_SAMPLES_PER_SEC,
+        }
+        self.participants = dict()
+
+    def _new_participant(self):
+        # the latest features of each measurement and the time of its
+        # latest event
+        state = {"latest": dict(), "latest_time": dict(), "last_time": None}
+        for event_type, col in EVENT_TYPES.items():
+            state["latest"][event_type] = dict()
+            measurement = "HR" if event_type == "hr" else "Steps"
+            state[event_type] = [OnlineRollingFeatures(measurement, self.window_size)]
+            spectrogram = OnlineSpectrogramFeatures(
+                col,
+                self.samples_per_sec[event_type],
+                self.spectrogram_rows[event_type],
+                bands=self.feature_names,
+            )
+            if spectrogram.keep:  # only if the estimator uses these bands
+                state[event_type].append(spectrogram)
+        return state
+
+    def process(self, participant_id, timestamp, event_type, value):
+        """Update the features with one event and classify the
+        participant's latest features
+
+        :param participant_id: participant ID
+        :param timestamp: pandas.Timestamp of the event
+        :param event_type: "hr" or "steps"
+        :param value: HR or step count
+        :returns: dict with the keys "Id", "Time", the probability of
+            each class and "Predicted", or None if some features are not
+            available yet (or are older than ``tolerance``)
+        """
+        if participant_id not in self.participants:
+            self.participants[participant_id] = self._new_participant()
+        state = self.participants[participant_id]
+
+        if state["last_time"] is not None and timestamp < state["last_time"]:
+            raise ValueError(
+                f"Event at {timestamp} for participant {participant_id} is out of order."
+            )
+        state["last_time"] = timestamp
+
+        measurement_latest = state["latest"][event_type]
+        measurement_latest[EVENT_TYPES[event_type]] = value
+        for features in state[event_type]:
+            update = features.update(timestamp, value)
+            if update is not None:
+                measurement_latest.update(update)
+        state["latest_time"][event_type] = timestamp
+
+        # combine the features of the measurements with recent events
+        latest = dict()
+        for other_type, latest_time in state["latest_time"].items():
+            if timestamp - latest_time <= self.tolerance:
+                latest.update(state["latest"][other_type])
+        if any(name not in latest for name in self.feature_names):
+            return None
+
+        X = np.array([[latest[name] for name in self.feature_names]])
+        if np.isnan(X).any():
+            return None
+        proba = self.estimator.predict_proba(X)[0]
+
+        result = {"Id": participant_id, "Time": timestamp}
+        result.update(zip(self.classes, proba))
+        result["Predicted"] = self.classes[int(proba.argmax())]
+        return result
+
+
+def latency_summary(latencies_ms, latency_target_ms):
+    """Summarize per-event latencies
+
+    :param latencies_ms: array of per-event latencies in milliseconds
+    :param latency_target_ms: latency target in milliseconds
+    :returns: string with the number of events, latency percentiles and
+        the number of events exceeding the target
+    """
+    if len(latencies_ms) == 0:
+        return "No events were processed."
+    p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99])
+    over = int((latencies_ms > latency_target_ms).sum())
+    return (
+        f"Processed {len(latencies_ms)} events. Latency (ms): p50={p50:.3f}, "
+        f"p95={p95:.3f}, p99={p99:.3f}, max={latencies_ms.max():.3f}. "
+        f"{over} events ({np.round(over/len(latencies_ms)*100, 2)}%) exceeded the "
+        f"target of {latency_target_ms}ms."
+    )
+
+
+if __name__ == "__main__":
+    cli()
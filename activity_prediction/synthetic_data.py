@@ -0,0 +1,212 @@
+import pandas as pd
+import numpy as np
+import os
+import click
+from tqdm import tqdm
+
+# file name of the labels csv, as expected by preprocessing/clean_labels.py
+LABELS_FILE = "24HourFitnessUsage with Randomization Arms added.xlsx - STRONGD.csv"
+ARMS = [
+    "Arm 1: Strength Training Only",
+    "Arm 2: Aerobic Training Only",
+    "Arm 3: Combination (Aerobic and Strength) Training",
+]
+FITABASE_DATETIME_FORMAT = "%m/%d/%Y %I:%M:%S %p"
+
+
+@click.command()
+@click.option(
+    "--save_dir",
+    help="Path to the directory for saving the synthetic data. The Fitabase files are saved in the 'export' subdirectory and the labels csv in the 'labels' subdirectory.",
+)
+@click.option("--num_participants", default=10, type=int)
+@click.option("--days", default=7, type=int, help="Number of days per participant.")
+@click.option(
+    "--hr_interval_seconds",
+    default=5.0,
+    type=float,
+    help="Mean time between consecutive HR samples in seconds.",
+)
+@click.option(
+    "--jitter_seconds",
+    default=3.0,
+    type=float,
+    help="Standard deviation of the time between consecutive HR samples in seconds. Intervals are rounded to whole seconds (at least 1 second).",
+)
+@click.option(
+    "--gap_rate",
+    default=0.05,
+    type=float,
+    help="Probability that any given hour of HR and steps data is missing (e.g. the Fitbit wasn't worn).",
+)
+@click.option(
+    "--sessions_per_week",
+    default=3,
+    type=int,
+    help="Number of labeled gym sessions per participant and week.",
+)
+@click.option("--seed", default=0, type=int)
+def main(
+    save_dir,
+    num_participants,
+    days,
+    hr_interval_seconds,
+    jitter_seconds,
+    gap_rate,
+    sessions_per_week,
+    seed,
+):
+    """Generate a synthetic Fitabase export and labels
+
+    Writes one ``<Id>_heartrate_seconds_<start>_<end>.csv`` and one
+    ``<Id>_minuteStepsNarrow_<start>_<end>.csv`` file per participant
+    (the input of preprocessing/cleaning.py) and the gym check-in labels
+    csv (the input of preprocessing/clean_labels.py).
+
+    Each participant has a circadian HR baseline, no steps at night, and
+    labeled gym sessions that start 10 minutes after the check-in and
+    last one hour. During a session, HR is elevated for every arm, while
+    the number of steps is high for aerobic training, low for strength
+    training, and alternates between both for combined training.
+    """
+    generate(
+        save_dir=save_dir,
+        num_participants=num_participants,
+        days=days,
+        hr_interval_seconds=hr_interval_seconds,
+        jitter_seconds=jitter_seconds,
+        gap_rate=gap_rate,
+        sessions_per_week=sessions_per_week,
+        seed=seed,
+    )
+    print(f"Saved the synthetic Fitabase export and labels to {save_dir}.")
+
+
+def generate(
+    save_dir,
+    num_participants=10,
+    days=7,
+    hr_interval_seconds=5.0,
+    jitter_seconds=3.0,
+    gap_rate=0.05,
+    sessions_per_week=3,
+    seed=0,
+    start="2020-01-06",
+):
+    """Generate and save a synthetic Fitabase export and labels (see
+    ``main``)
+
+    :returns: a tuple of the paths (export_dir, labels_path)
+    """
+    rng = np.random.default_rng(seed)
+    export_dir = os.path.join(save_dir, "export")
+    labels_dir = os.path.join(save_dir, "labels")
+    os.makedirs(export_dir, exist_ok=True)
+    os.makedirs(labels_dir, exist_ok=True)
+
+    start = pd.Timestamp(start)
+    end = start + pd.Timedelta(days=days)
+    date_suffix = f"{start:%Y%m%d}_{end - pd.Timedelta('1s'):%Y%m%d}"
+
+    labels = []
+    for i in tqdm(range(num_participants)):
+        participant_id = f"32113-{i + 1:04d}"
+        arm = ARMS[i % len(ARMS)]
+
+        # gym sessions: check-in on random days between 6am and 8pm
+        num_sessions = max(1, int(days / 7 * sessions_per_week))
+        session_days = rng.choice(days, size=min(num_sessions, days), replace=False)
+        check_ins = (
+            start
+            + pd.to_timedelta(np.sort(session_days), unit="D")
+            + pd.to_timedelta(
+                rng.integers(6 * 60, 20 * 60, len(session_days)), unit="min"
+            )
+        )
+        session_starts = (check_ins + pd.Timedelta("10min")).values
+        for check_in in check_ins:
+            labels.append(
+                {
+                    "Participant ID": participant_id,
+                    "Date": f"{check_in:%m/%d/%Y}",
+                    "Time": f"{check_in:%I:%M:%S%p}",
+                    "Randomization Arm": arm,
+                }
+            )
+
+        # missing hours (shared by HR and steps)
+        missing_hours = rng.random(days * 24) < gap_rate
+
+        # HR: irregular sampling around hr_interval_seconds
+        num_hr = int(days * 86400 / hr_interval_seconds * 1.1)
+        intervals = np.maximum(
+            1, np.round(rng.normal(hr_interval_seconds, jitter_seconds, num_hr))
+        )
+        hr_seconds = np.cumsum(intervals).astype(np.int64)
+        hr_seconds = hr_seconds[hr_seconds < days * 86400]
+        hr_time = start.to_datetime64() + hr_seconds.astype("timedelta64[s]")
+        in_session = _in_sessions(hr_time, session_starts)
+        hour_of_day = (hr_seconds % 86400) / 3600
+        hr = (
+            65
+            + 8 * np.sin((hour_of_day - 9) / 24 * 2 * np.pi)
+            + 50 * in_session
+            + rng.normal(0, 4, len(hr_time))
+        )
+        keep = ~missing_hours[hr_seconds // 3600]
+        hr_df = pd.DataFrame({"Time": hr_time[keep], "Value": np.round(hr[keep])})
+
+        # steps: one sample per minute
+        minutes = np.arange(days * 1440)
+        steps_time = start.to_datetime64() + minutes.astype("timedelta64[m]")
+        in_session = _in_sessions(steps_time, session_starts)
+        awake = ((minutes % 1440) >= 7 * 60) & ((minutes % 1440) < 23 * 60)
+        walking = awake & (rng.random(len(minutes)) < 0.15)
+        steps = walking * rng.poisson(40, len(minutes))
+        if arm == ARMS[0]:  # strength
+            session_steps = rng.poisson(5, len(minutes))
+        elif arm == ARMS[1]:  # aerobic
+            session_steps = rng.poisson(120, len(minutes))
+        else:  # combined: alternate every 10 minutes
+            session_steps = np.where(
+                (minutes // 10) % 2 == 0,
+                rng.poisson(120, len(minutes)),
+                rng.poisson(5, len(minutes)),
+            )
+        steps = np.where(in_session, session_steps, steps)
+        keep = ~missing_hours[minutes // 60]
+        steps_df = pd.DataFrame(
+            {"ActivityMinute": steps_time[keep], "Steps": steps[keep]}
+        )
+
+        hr_df["Time"] = hr_df["Time"].dt.strftime(FITABASE_DATETIME_FORMAT)
+        hr_df.to_csv(
+            os.path.join(
+                export_dir, f"{participant_id}_heartrate_seconds_{date_suffix}.csv"
+            ),
+            index=False,
+        )
+        steps_df["ActivityMinute"] = steps_df["ActivityMinute"].dt.strftime(
+            FITABASE_DATETIME_FORMAT
+        )
+        steps_df.to_csv(
+            os.path.join(
+                export_dir, f"{participant_id}_minuteStepsNarrow_{date_suffix}.csv"
+            ),
+            index=False,
+        )
+
+    labels_path = os.path.join(labels_dir, LABELS_FILE)
+    pd.DataFrame(labels).to_csv(labels_path, index=False)
+
+    return (export_dir, labels_path)
+
+
+def _in_sessions(time, session_starts, duration=np.timedelta64(1, "h")):
+    """Boolean mask of the timestamps that fall within a gym session"""
+    i = np.searchsorted(session_starts, time, side="right") - 1
+    return (i >= 0) & (time - session_starts[np.maximum(i, 0)] < duration)
+
+
+if __name__ == "__main__":
+    main()
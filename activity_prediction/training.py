@@ -2,14 +2,24 @@ import pandas as pd
 import numpy as np
 import pickle
 import random
+import hashlib
 import json
+import time
+import os
 import click
+from joblib import Parallel, delayed
+from scipy.stats import rankdata
 
 random.seed(0)
 
+from sklearn.base import clone
 from sklearn.ensemble import RandomForestClassifier
+from sklearn.metrics import get_scorer
 from sklearn.model_selection import GridSearchCV
 from sklearn.model_selection import GroupKFold
+from sklearn.model_selection import ParameterGrid
+
+from preprocessing import instrumentation
 
 # random forest parameter values to test in the grid search
 PARAM_GRID = {
@@ -30,8 +40,23 @@ NUM_SPLITS = 10
     "--save_path", help="Path for saving the grid search results as a pickle file.",
 )
 @click.option("--binary/--not-binary")  # TODO
+@click.option(
+    "--report_path",
+    default=None,
+    help="Optional path for saving a json report with the wall time, CPU time, peak memory and row counts of each step (including the fit times of each grid search candidate).",
+)
+@click.option(
+    "--cache_dir",
+    default=None,
+    help="Optional directory for caching the result of every (parameters, fold) fit of the grid search, keyed by a hash of the training data, the fold and the parameters. A rerun only fits the combinations that aren't cached yet, e.g. after adding values to PARAM_GRID.",
+)
+@click.option(
+    "--cache_models/--no-cache_models",
+    default=False,
+    help="Also cache the fitted models of every fold and the refitted best model (with --cache_dir). This can take a lot of disk space.",
+)
 # TODO: docs
-def main(merged_features_path, save_path, binary):
+def main(merged_features_path, save_path, binary, report_path, cache_dir, cache_models):
     """Train and select the best random forest on the feature set in the
     input file
 
@@ -78,14 +103,25 @@ def main(merged_features_path, save_path, binary):
     y_train = y.loc[split_dict["train"]]
 
     # perform grid search
-    grid_search = grouped_grid_search(X_train, y_train, PARAM_GRID, NUM_SPLITS)
+    grid_search = grouped_grid_search(
+        X_train,
+        y_train,
+        PARAM_GRID,
+        NUM_SPLITS,
+        cache_dir=cache_dir,
+        cache_models=cache_models,
+    )
 
     with open(save_path, "wb") as f:
         pickle.dump(grid_search, f)
     print(f"Saved the grid search results to {save_path}.")
 
+    instrumentation.write_report(report_path)
+
 
-def grouped_grid_search(X, y, param_grid, n_splits):
+def grouped_grid_search(
+    X, y, param_grid, n_splits, n_estimators=1000, cache_dir=None, cache_models=False
+):
     """Perform a grid search over random forest parameters using grouped
     cross validation
 
@@ -101,6 +137,13 @@ def grouped_grid_search(X, y, param_grid, n_splits):
     :param y: [description]
     :param param_grid: [description]
     :param n_splits: [description], defaults to 10
+    :param n_estimators: number of trees in each random forest, defaults
+        to 1000
+    :param cache_dir: optional directory for caching the result of every
+        (parameters, fold) fit (see ``cached_grid_search``). Defaults to
+        None, which fits all combinations with GridSearchCV.fit.
+    :param cache_models: whether to also cache the fitted models (with
+        ``cache_dir``), defaults to False
     :returns: [description]
     """
 
@@ -111,7 +154,7 @@ def grouped_grid_search(X, y, param_grid, n_splits):
 
     # random forest and grid
     rf = RandomForestClassifier(
-        n_estimators=1000,
+        n_estimators=n_estimators,
         criterion="gini",
         bootstrap=True,
         n_jobs=-1,
@@ -127,10 +170,278 @@ def grouped_grid_search(X, y, param_grid, n_splits):
         verbose=1,
     )
 
-    grid_search.fit(X, y, groups=groups)
+    with instrumentation.span("grouped_grid_search", rows=X.shape[0]):
+        if cache_dir is None:
+            grid_search.fit(X, y, groups=groups)
+        else:
+            cached_grid_search(grid_search, X, y, groups, cache_dir, cache_models)
+
+        # the individual fits run in worker processes, so record their
+        # (per-candidate) timings from the cross-validation results
+        results = grid_search.cv_results_
+        for i, params in enumerate(results["params"]):
+            instrumentation.record(
+                "grid_search_fit",
+                params=params,
+                n_splits=n_splits,
+                mean_fit_seconds=results["mean_fit_time"][i],
+                std_fit_seconds=results["std_fit_time"][i],
+                mean_score_seconds=results["mean_score_time"][i],
+                mean_test_score=results["mean_test_score"][i],
+            )
+
+    return grid_search
+
+
+def cached_grid_search(grid_search, X, y, groups, cache_dir, cache_models=False):
+    """Fit a GridSearchCV with a persistent cache of the individual fits
+
+    Every (parameters, fold) combination is cached in its own pickle file
+    in ``cache_dir``, named by a hash of the training data, the groups in
+    the validation fold and the estimator's parameters (see
+    ``get_fit_key``), as soon as it is fitted. A rerun only fits the
+    combinations that aren't cached yet, e.g. new values in the parameter
+    grid or the folds of a changed data set, so an interrupted grid
+    search also resumes where it stopped.
+
+    Afterwards, ``grid_search`` has the same fitted attributes as after
+    ``grid_search.fit`` (``cv_results_``, ``best_params_``,
+    ``best_estimator_``, etc.), so it can be saved and used in the same
+    way. Only a single scoring metric and ``refit=True`` are supported.
+
+    :param grid_search: unfitted sklearn.model_selection.GridSearchCV
+    :param X: pandas dataframe of features
+    :param y: pandas series of labels
+    :param groups: group (participant ID) of every row, passed to the
+        ``cv`` splitter of ``grid_search``
+    :param cache_dir: directory of the cached fits (created if needed)
+    :param cache_models: whether to also cache the fitted models of every
+        fold and the refitted best model, defaults to False. Without
+        them, the best model is refitted on every run.
+    :returns: ``grid_search``
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    estimator = grid_search.estimator
+    scorer = get_scorer(grid_search.scoring)
+    candidates = list(ParameterGrid(grid_search.param_grid))
+    folds = list(grid_search.cv.split(X, y, groups))
+    groups = np.asarray(groups)
+    data_hash = get_data_hash(X, y)
+
+    # load the cached fits and collect the missing ones
+    results = [[None] * len(folds) for _ in candidates]
+    missing = []
+    for i, params in enumerate(candidates):
+        for k, (train, test) in enumerate(folds):
+            cache_path = os.path.join(
+                cache_dir,
+                get_fit_key(data_hash, groups[test], estimator, params) + ".pickle",
+            )
+            if os.path.exists(cache_path):
+                with open(cache_path, "rb") as f:
+                    result = pickle.load(f)
+                if "estimator" in result or not cache_models:
+                    results[i][k] = result
+                    continue
+            missing.append((i, k, cache_path))
+
+    n_fits = len(candidates) * len(folds)
+    print(
+        f"Found {n_fits - len(missing)} of {n_fits} fits ({len(candidates)} candidates x {len(folds)} folds) in {cache_dir}, fitting the remaining {len(missing)}."
+    )
+    fitted = Parallel(n_jobs=grid_search.n_jobs, verbose=grid_search.verbose)(
+        delayed(fit_and_score)(
+            estimator,
+            X,
+            y,
+            folds[k][0],
+            folds[k][1],
+            candidates[i],
+            scorer,
+            cache_path=cache_path,
+            cache_model=cache_models,
+        )
+        for i, k, cache_path in missing
+    )
+    for (i, k, _), result in zip(missing, fitted):
+        results[i][k] = result
+
+    cv_results = get_cv_results(candidates, results)
+    best_index = int(cv_results["rank_test_score"].argmin())
+    best_params = candidates[best_index]
+
+    # refit the best candidate on all the data
+    refit_path = os.path.join(
+        cache_dir, get_fit_key(data_hash, None, estimator, best_params) + ".pickle"
+    )
+    if cache_models and os.path.exists(refit_path):
+        print(f"Loading the refitted best estimator from {refit_path}.")
+        with open(refit_path, "rb") as f:
+            refit = pickle.load(f)
+    else:
+        refit = fit_and_score(
+            estimator,
+            X,
+            y,
+            np.arange(len(X)),
+            None,
+            best_params,
+            cache_path=refit_path if cache_models else None,
+            cache_model=True,
+        )
+
+    grid_search.cv_results_ = cv_results
+    grid_search.best_index_ = best_index
+    grid_search.best_params_ = best_params
+    grid_search.best_score_ = cv_results["mean_test_score"][best_index]
+    grid_search.best_estimator_ = refit["estimator"]
+    grid_search.refit_time_ = refit["fit_time"]
+    grid_search.scorer_ = scorer
+    grid_search.multimetric_ = False
+    grid_search.n_splits_ = len(folds)
+    if hasattr(refit["estimator"], "feature_names_in_"):
+        grid_search.feature_names_in_ = refit["estimator"].feature_names_in_
 
     return grid_search
 
 
+def get_data_hash(X, y):
+    """Hash of the features (including the index and column names) and
+    labels"""
+    sha = hashlib.sha256()
+    sha.update(json.dumps([str(c) for c in X.columns]).encode())
+    sha.update(pd.util.hash_pandas_object(X, index=True).values.tobytes())
+    sha.update(pd.util.hash_pandas_object(y, index=False).values.tobytes())
+    return sha.hexdigest()
+
+
+def get_fit_key(data_hash, test_groups, estimator, params):
+    """Cache key of one fit of a grid search
+
+    :param data_hash: hash of the features and labels (see
+        ``get_data_hash``)
+    :param test_groups: groups in the validation fold, or None for the
+        refit on all the data
+    :param estimator: unfitted estimator
+    :param params: dict of the candidate's parameters
+    :returns: hex digest of the data, the fold and all parameters of the
+        estimator (except ``n_jobs`` and ``verbose``, which don't change
+        the fitted model)
+    """
+    estimator_params = clone(estimator).set_params(**params).get_params()
+    estimator_params = {
+        name: repr(value)
+        for name, value in estimator_params.items()
+        if name not in ["n_jobs", "verbose"]
+    }
+    fold = None if test_groups is None else sorted(str(g) for g in set(test_groups))
+    sha = hashlib.sha256()
+    sha.update(
+        json.dumps(
+            [data_hash, fold, type(estimator).__name__, estimator_params],
+            sort_keys=True,
+        ).encode()
+    )
+    return sha.hexdigest()
+
+
+def fit_and_score(
+    estimator,
+    X,
+    y,
+    train,
+    test,
+    params,
+    scorer=None,
+    cache_path=None,
+    cache_model=False,
+):
+    """Fit a clone of an estimator on some rows and score it on others
+
+    :param estimator: unfitted estimator
+    :param X: pandas dataframe of features
+    :param y: pandas series of labels
+    :param train: positions of the training rows
+    :param test: positions of the validation rows, or None to skip
+        scoring
+    :param params: dict of parameters to set before fitting
+    :param scorer: sklearn scorer, e.g. ``get_scorer("f1_macro")``
+    :param cache_path: optional path for saving the result as a pickle
+        file
+    :param cache_model: whether to include the fitted model in the
+        result, defaults to False
+    :returns: dict with the "params", "test_score", "fit_time" and
+        "score_time" (and "estimator" if ``cache_model``)
+    """
+    estimator = clone(estimator).set_params(**params)
+    start = time.perf_counter()
+    estimator.fit(X.iloc[train], y.iloc[train])
+    fit_time = time.perf_counter() - start
+
+    test_score = score_time = np.nan
+    if test is not None:
+        start = time.perf_counter()
+        test_score = float(scorer(estimator, X.iloc[test], y.iloc[test]))
+        score_time = time.perf_counter() - start
+
+    result = {
+        "params": params,
+        "test_score": test_score,
+        "fit_time": fit_time,
+        "score_time": score_time,
+    }
+    if cache_model:
+        result["estimator"] = estimator
+
+    if cache_path is not None:
+        # write to a temporary file first, so that an interrupted write
+        # doesn't leave a broken cache entry
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(result, f)
+        os.replace(tmp_path, cache_path)
+
+    return result
+
+
+def get_cv_results(candidates, results):
+    """Summarize the fits of a grid search like GridSearchCV.cv_results_
+
+    :param candidates: list of parameter dicts (in ParameterGrid order)
+    :param results: list (per candidate) of lists (per fold) of
+        ``fit_and_score`` results
+    :returns: dict with the keys "mean_fit_time", "std_fit_time",
+        "mean_score_time", "std_score_time", "param_<name>", "params",
+        "split<k>_test_score", "mean_test_score", "std_test_score" and
+        "rank_test_score"
+    """
+    get = lambda key: np.array([[r[key] for r in row] for row in results])
+    fit_time, score_time, scores = get("fit_time"), get("score_time"), get("test_score")
+
+    cv_results = {
+        "mean_fit_time": fit_time.mean(axis=1),
+        "std_fit_time": fit_time.std(axis=1),
+        "mean_score_time": score_time.mean(axis=1),
+        "std_score_time": score_time.std(axis=1),
+    }
+    names = sorted({name for params in candidates for name in params})
+    for name in names:
+        values = np.ma.MaskedArray(np.empty(len(candidates), dtype=object), mask=True)
+        for i, params in enumerate(candidates):
+            if name in params:
+                values[i] = params[name]
+        cv_results[f"param_{name}"] = values
+    cv_results["params"] = candidates
+    for k in range(scores.shape[1]):
+        cv_results[f"split{k}_test_score"] = scores[:, k]
+    cv_results["mean_test_score"] = scores.mean(axis=1)
+    cv_results["std_test_score"] = scores.std(axis=1)
+    cv_results["rank_test_score"] = rankdata(
+        -cv_results["mean_test_score"], method="min"
+    ).astype(np.int32)
+
+    return cv_results
+
+
 if __name__ == "__main__":
     main()